@@ -0,0 +1,58 @@
+"""
+Measure what API key authentication costs per request: the salted SHA-256
+check of a secret, and authenticating valid tokens and tokens with a wrong
+secret, which cost the same.
+
+    python -m benchmarks.bench_auth --requests 100000
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import tempfile
+import time
+
+from conda_server.auth import Authenticator, KeyScope, generate_api_key, verify_api_key
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--requests", type=int, default=100000)
+    parser.add_argument("--keys", type=int, default=100)
+    args = parser.parse_args()
+
+    tokens = []
+    keys = []
+    for i in range(args.keys):
+        token, key = generate_api_key(f"key{i}")
+        key.scopes = [KeyScope(access="upload")]
+        tokens.append(token)
+        keys.append(key.model_dump())
+
+    with tempfile.TemporaryDirectory() as directory:
+        keys_file = os.path.join(directory, "keys.json")
+        with open(keys_file, "w") as f:
+            json.dump({"keys": keys}, f)
+        authenticator = Authenticator(keys_file)
+
+        secret = tokens[0].partition(".")[2]
+        started = time.perf_counter()
+        for _ in range(args.requests):
+            verify_api_key(secret, keys[0]["hash"])
+        elapsed = (time.perf_counter() - started) / args.requests
+        print(f"{'hash check':<36} {elapsed * 1e6:10.2f} us per request")
+
+        for label, candidates in (
+            ("authenticate, valid token", tokens),
+            ("authenticate, wrong secret", [f"{token}x" for token in tokens]),
+        ):
+            started = time.perf_counter()
+            for i in range(args.requests):
+                await authenticator.authenticate(candidates[i % len(candidates)])
+            elapsed = (time.perf_counter() - started) / args.requests
+            print(f"{label:<36} {elapsed * 1e6:10.2f} us per request")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,71 @@
+"""
+Compare the per-request cost of validating package file names with the
+previous chain of regexes and with the cached single-pass parser.
+
+    python -m benchmarks.bench_filenames --distinct 1000 --requests 200000
+"""
+
+import argparse
+import time
+
+from conda_server.validation import (
+    FILE_EXTENSION_REGEX,
+    FORMAT_REGEX,
+    PACKAGE_BUILD_REGEX,
+    PACKAGE_NAME_REGEX,
+    VERSION_REGEX,
+    _parse_package_filename,
+    parse_package_filename,
+)
+
+
+def regex_chain(filename: str) -> tuple[str, str, str, str]:
+    # The previous validate_package_name, without the HTTPException
+    match_ = FORMAT_REGEX.match(filename)
+    if not match_:
+        raise ValueError(filename)
+    package_name, package_version, package_build, file_extension = match_.groups()
+    if (
+        not PACKAGE_NAME_REGEX.match(package_name)
+        or not VERSION_REGEX.match(package_version)
+        or not PACKAGE_BUILD_REGEX.match(package_build)
+        or not FILE_EXTENSION_REGEX.match(file_extension)
+    ):
+        raise ValueError(filename)
+    return package_name, package_version, package_build, file_extension
+
+
+def uncached(filename: str):
+    return _parse_package_filename.__wrapped__(filename, VERSION_REGEX)
+
+
+def measure(label: str, func, values: list[str]) -> None:
+    started = time.perf_counter()
+    for value in values:
+        func(value)
+    elapsed = time.perf_counter() - started
+    print(f"{label:<28} {elapsed / len(values) * 1e9:8.0f} ns per call")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--distinct", type=int, default=1000)
+    parser.add_argument("--requests", type=int, default=200000)
+    args = parser.parse_args()
+
+    # Requests for a working set of popular packages, like a busy channel sees
+    filenames = [
+        f"package-{i % 97}-{i % 13}.{i % 7}.{i}-py311h{i:07x}_0."
+        + ("conda" if i % 2 else "tar.bz2")
+        for i in range(args.distinct)
+    ]
+    requests = [filenames[i * 7919 % args.distinct] for i in range(args.requests)]
+
+    _parse_package_filename.cache_clear()
+    measure("regex chain", regex_chain, requests)
+    measure("single pass, uncached", uncached, requests)
+    measure("single pass, cached", parse_package_filename, requests)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""
+Measure the overhead the rate limiter adds to each request and to each chunk
+of a throttled response, with the in-process and the shared SQLite backend.
+
+    python -m benchmarks.bench_ratelimit --requests 100000
+"""
+
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+from httpx import ASGITransport, AsyncClient
+from starlette.applications import Starlette
+from starlette.responses import PlainTextResponse
+from starlette.routing import Route
+
+from conda_server.ratelimit import (
+    MemoryBackend,
+    RateLimiter,
+    RateLimitMiddleware,
+    SQLiteBackend,
+)
+
+
+async def measure_checks(label: str, rate_limiter: RateLimiter, requests: int):
+    clients = [f"ip:10.0.{i // 256}.{i % 256}" for i in range(1000)]
+    started = time.perf_counter()
+    for i in range(requests):
+        await rate_limiter.check_request(clients[i % len(clients)])
+    elapsed = time.perf_counter() - started
+    print(f"{label:<36} {elapsed / requests * 1e6:8.2f} us per request")
+
+
+async def measure_chunks(label: str, rate_limiter: RateLimiter, chunks: int):
+    async def generate():
+        chunk = b"x" * 65536
+        for _ in range(chunks):
+            yield chunk
+
+    started = time.perf_counter()
+    async for _ in rate_limiter.throttle("ip:10.0.0.1", generate()):
+        pass
+    elapsed = time.perf_counter() - started
+    print(f"{label:<36} {elapsed / chunks * 1e6:8.2f} us per 64 KiB chunk")
+
+
+async def measure_app(label: str, rate_limiter: RateLimiter | None, requests: int):
+    app = Starlette(routes=[Route("/", lambda request: PlainTextResponse("ok"))])
+    if rate_limiter is not None:
+        app.add_middleware(RateLimitMiddleware, rate_limiter=rate_limiter)
+    async with AsyncClient(
+        transport=ASGITransport(app), base_url="http://test"
+    ) as client:
+        started = time.perf_counter()
+        for _ in range(requests):
+            await client.get("/")
+        elapsed = time.perf_counter() - started
+    print(f"{label:<36} {elapsed / requests * 1e6:8.2f} us per request")
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--requests", type=int, default=100000)
+    args = parser.parse_args()
+
+    # Limits high enough that nothing waits, to measure the bookkeeping alone
+    limits = {"requests_per_second": 1e9, "bytes_per_second": 1e15}
+    with tempfile.TemporaryDirectory() as directory:
+        memory = RateLimiter(**limits, backend=MemoryBackend())
+        sqlite = RateLimiter(
+            **limits, backend=SQLiteBackend(os.path.join(directory, "ratelimit.db"))
+        )
+        await measure_checks("request check, memory", memory, args.requests)
+        await measure_checks("request check, sqlite", sqlite, args.requests // 10)
+        await measure_chunks("throttle, memory", memory, args.requests)
+        await measure_chunks("throttle, sqlite", sqlite, args.requests // 10)
+        await measure_app("app, no middleware", None, args.requests // 10)
+        await measure_app(
+            "app, middleware, limits off", RateLimiter(), args.requests // 10
+        )
+        await measure_app("app, middleware, memory", memory, args.requests // 10)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
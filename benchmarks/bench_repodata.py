@@ -0,0 +1,132 @@
+"""
+Compare assembling repodata.json from stored records with building it as a
+dict, the way conda-index does, on a synthetic subdir.
+
+    python -m benchmarks.bench_repodata --records 100000
+"""
+
+import argparse
+import bz2
+import hashlib
+import json
+import os
+import tempfile
+import time
+import tracemalloc
+from contextlib import closing
+
+import zstandard
+
+from conda_server.repodata import ZSTD_COMPRESS_LEVEL, RepodataStore
+
+
+def make_metadata(i: int) -> dict:
+    name = f"package-{i % 5000}"
+    version = f"{i // 5000}.{i % 7}.{i % 3}"
+    return {
+        "build": f"py311h{i:07x}_0",
+        "build_number": 0,
+        "constrains": [f"{name}-base {version}"],
+        "depends": [
+            "python >=3.11,<3.12.0a0",
+            "libgcc-ng >=12",
+            f"package-{(i + 1) % 5000} >=1.0",
+        ],
+        "license": "BSD-3-Clause",
+        "md5": hashlib.md5(str(i).encode()).hexdigest(),
+        "name": name,
+        "sha256": hashlib.sha256(str(i).encode()).hexdigest(),
+        "size": 100000 + i,
+        "subdir": "linux-64",
+        "timestamp": 1700000000000 + i,
+        "version": version,
+    }
+
+
+def populate(repodata_store: RepodataStore, records: int) -> None:
+    # The records don't need package files, any stat will do
+    stat = os.stat(__file__)
+    with closing(repodata_store.connect()) as connection, connection:
+        for i in range(records):
+            metadata = make_metadata(i)
+            extension = "conda" if i % 2 else "tar.bz2"
+            fn = f"{metadata['name']}-{metadata['version']}-{metadata['build']}.{extension}"
+            repodata_store._upsert(connection, "linux-64", fn, stat, metadata)
+
+
+def build_as_dict(repodata_store: RepodataStore, subdir_dir: str | None) -> None:
+    # What conda-index does: load every record, then serialize and compress
+    # the whole document
+    repodata: dict = {
+        "info": {"subdir": "linux-64"},
+        "packages": {},
+        "packages.conda": {},
+        "removed": [],
+        "repodata_version": 1,
+    }
+    with closing(repodata_store.connect()) as connection:
+        for fn, record in connection.execute(
+            "SELECT fn, record FROM packages WHERE subdir = 'linux-64' ORDER BY fn"
+        ):
+            key = "packages.conda" if fn.endswith(".conda") else "packages"
+            repodata[key][fn] = json.loads(record)
+    content = json.dumps(repodata, sort_keys=True, separators=(",", ":")).encode()
+    if subdir_dir is None:
+        return
+
+    path = os.path.join(subdir_dir, "repodata.json")
+    with open(path, "wb") as f:
+        f.write(content)
+    with open(f"{path}.bz2", "wb") as f:
+        f.write(bz2.compress(content))
+    with open(f"{path}.zst", "wb") as f:
+        f.write(
+            zstandard.ZstdCompressor(level=ZSTD_COMPRESS_LEVEL, threads=-1).compress(
+                content
+            )
+        )
+
+
+def stream(repodata_store: RepodataStore) -> None:
+    for _ in repodata_store.iter_repodata("linux-64"):
+        pass
+
+
+def measure(label: str, func, *args) -> None:
+    # Time without tracing, which slows down Python code, then trace memory
+    started = time.perf_counter()
+    cpu_started = time.process_time()
+    func(*args)
+    cpu = time.process_time() - cpu_started
+    wall = time.perf_counter() - started
+
+    tracemalloc.start()
+    func(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(
+        f"{label:<24} wall {wall:7.2f} s  cpu {cpu:7.2f} s  "
+        f"peak python memory {peak / 2**20:8.1f} MiB"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--records", type=int, default=100000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as channel_dir:
+        subdir_dir = os.path.join(channel_dir, "linux-64")
+        os.makedirs(subdir_dir)
+        repodata_store = RepodataStore(channel_dir)
+        populate(repodata_store, args.records)
+        measure("dict, json only", build_as_dict, repodata_store, None)
+        measure("streamed, json only", stream, repodata_store)
+        measure("dict, compressed", build_as_dict, repodata_store, subdir_dir)
+        size = os.path.getsize(os.path.join(subdir_dir, "repodata.json"))
+        measure("streamed, compressed", repodata_store.write_repodata, "linux-64")
+        print(f"{args.records} records, repodata.json is {size / 2**20:.1f} MiB")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,5 @@
 import os
+import secrets
 import shutil
 import tempfile
 from contextlib import contextmanager, suppress
@@ -82,6 +83,27 @@ def atomic_write(path: str, mode="w", encoding=None):
             pass
 
 
+def atomic_link(source: str, path: str) -> None:
+    """
+    Atomically hardlink a file into place.
+    The link is created under a temporary name in the same directory as the
+    target file and then renamed over it, so readers either see the previous
+    file or the linked file. Uses the same lock file as `atomic_write`.
+    """
+
+    temp_path = f"{path}.{secrets.token_hex(8)}.tmp"
+    try:
+        with FileLock(f"{path}.lock"):
+            os.link(source, temp_path)
+            os.replace(temp_path, path)
+    finally:
+        safely_remove_lock_file(f"{path}.lock")
+        try:
+            os.remove(temp_path)
+        except FileNotFoundError:
+            pass
+
+
 def safely_remove_lock_file(lock_file_path: str):
     lock_file = Path(lock_file_path)
 
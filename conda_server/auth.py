@@ -0,0 +1,183 @@
+import argparse
+import hashlib
+import hmac
+import logging
+import os
+import secrets
+import time
+from typing import Literal
+
+from fastapi.concurrency import run_in_threadpool
+from pydantic import BaseModel
+
+logger = logging.getLogger(__name__)
+
+Access = Literal["download", "upload"]
+
+# Secrets are 256-bit random tokens, so a salted hash is enough to keep them
+# out of the keys file; key stretching would only make checks expensive
+HASH_ALGORITHM = "sha256"
+
+
+class KeyScope(BaseModel):
+    """
+    What a key may access. `channel` is a channel name, None for the default
+    channel or "*" for every channel, and `subdir` is a subdir or "*". Upload
+    access includes download access.
+    """
+
+    access: Access = "download"
+    channel: str | None = "*"
+    subdir: str = "*"
+
+    def allows(self, access: Access, channel: str | None, subdir: str | None) -> bool:
+        # Requests that aren't for a subdir need access to all of them
+        return (
+            (self.access == "upload" or access == "download")
+            and self.channel in ("*", channel)
+            and self.subdir in ("*", subdir)
+        )
+
+
+class APIKey(BaseModel):
+    # Tokens are of the form `<id>.<secret>`, and only the secret is hashed
+    id: str
+    hash: str
+    scopes: list[KeyScope] = []
+    revoked: bool = False
+
+    def allows(self, access: Access, channel: str | None, subdir: str | None) -> bool:
+        return any(scope.allows(access, channel, subdir) for scope in self.scopes)
+
+    def has_access(self, access: Access) -> bool:
+        return any(scope.access in (access, "upload") for scope in self.scopes)
+
+
+class APIKeysFile(BaseModel):
+    keys: list[APIKey] = []
+
+
+def hash_api_key(secret: str) -> str:
+    salt = secrets.token_hex(16)
+    digest = hashlib.sha256(bytes.fromhex(salt) + secret.encode()).hexdigest()
+    return f"{HASH_ALGORITHM}${salt}${digest}"
+
+
+def verify_api_key(secret: str, key_hash: str) -> bool:
+    try:
+        algorithm, salt, expected = key_hash.split("$")
+        if algorithm != HASH_ALGORITHM:
+            return False
+        digest = hashlib.sha256(bytes.fromhex(salt) + secret.encode()).hexdigest()
+    except ValueError:
+        return False
+    return hmac.compare_digest(digest, expected)
+
+
+def generate_api_key(key_id: str) -> tuple[str, APIKey]:
+    """Generate a token and the hashed key that verifies it."""
+    secret = secrets.token_urlsafe(32)
+    return f"{key_id}.{secret}", APIKey(id=key_id, hash=hash_api_key(secret))
+
+
+class Authenticator:
+    """
+    Verifies API keys against the hashed keys of a keys file. Checking a hash
+    is cheap, so tokens are checked on every request and revoking or
+    replacing a key takes effect immediately. The keys file is reloaded when
+    it changes, which is checked every `reload_interval` seconds. Without a
+    keys file, nothing requires a key.
+    """
+
+    def __init__(
+        self,
+        keys_file: str | None,
+        require_download=False,
+        require_upload=True,
+        reload_interval=5.0,
+    ) -> None:
+        self._keys_file = keys_file
+        self._require_download = require_download
+        self._require_upload = require_upload
+        self._reload_interval = reload_interval
+        self._keys: dict[str, APIKey] = {}
+        self._revoked: set[str] = set()
+        self._mtime: int | None = None
+        self._next_reload = 0.0
+        if keys_file is not None:
+            self._load()
+
+    @property
+    def enabled(self) -> bool:
+        return self._keys_file is not None
+
+    def requires(self, access: Access) -> bool:
+        if not self.enabled:
+            return False
+        return self._require_upload if access == "upload" else self._require_download
+
+    async def authenticate(self, token: str) -> APIKey | None:
+        """The key of a token, or None if the token is invalid."""
+        await self._reload_if_due()
+        return self._verify(token)
+
+    def identify(self, token: str) -> str | None:
+        """
+        The id of the key of a token, or None if the token is invalid. Doesn't
+        reload the keys file, so that callers ahead of authentication, e.g.
+        rate limits, never wait for it.
+        """
+        key = self._verify(token)
+        return key.id if key is not None else None
+
+    def _verify(self, token: str) -> APIKey | None:
+        key_id, _, secret = token.partition(".")
+        key = self._keys.get(key_id)
+        if key is None or not secret or not verify_api_key(secret, key.hash):
+            return None
+        return key
+
+    def revoke(self, key_id: str) -> None:
+        """Revoke a key in this process, even if the keys file still has it."""
+        self._revoked.add(key_id)
+        self._keys.pop(key_id, None)
+
+    def reload(self) -> None:
+        """Load the keys file again if it changed."""
+        try:
+            self._load()
+        except (OSError, ValueError) as e:
+            logger.error("Loading API keys from %s failed: %s", self._keys_file, e)
+
+    def _load(self) -> None:
+        assert self._keys_file is not None
+        mtime = os.stat(self._keys_file).st_mtime_ns
+        if mtime == self._mtime:
+            return
+        with open(self._keys_file, "rb") as f:
+            keys_file = APIKeysFile.model_validate_json(f.read())
+
+        self._keys = {
+            key.id: key
+            for key in keys_file.keys
+            if not key.revoked and key.id not in self._revoked
+        }
+        self._mtime = mtime
+        logger.info("Loaded %d API keys from %s", len(self._keys), self._keys_file)
+
+    async def _reload_if_due(self) -> None:
+        if self._keys_file is None or time.monotonic() < self._next_reload:
+            return
+        self._next_reload = time.monotonic() + self._reload_interval
+        await run_in_threadpool(self.reload)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Generate an API key and the entry to add to the keys file"
+    )
+    parser.add_argument("id")
+    args = parser.parse_args()
+    token, api_key = generate_api_key(args.id)
+    print(token)
+    print(api_key.model_dump_json(indent=2))
@@ -0,0 +1,120 @@
+import functools
+import logging
+import os
+import secrets
+import tarfile
+from contextlib import suppress
+from typing import Any, BinaryIO, Callable, Iterable
+
+from .blobs import BlobStore, StagedBlob
+from .uploads import UploadTooLarge
+
+logger = logging.getLogger(__name__)
+
+
+def stage_tar_stream(
+    blob_store: BlobStore,
+    fileobj: BinaryIO,
+    validate_name: Callable[[str], object],
+    inspect: Callable[[BinaryIO, str], Any] | None = None,
+    max_size: int | None = None,
+) -> dict[str, StagedBlob]:
+    """
+    Stage every regular file of a (possibly compressed) tar stream in the blob
+    store, keyed by file name. The stream is read once, front to back. Each
+    file is passed to `inspect` with its name while it is staged. Staged
+    blobs are discarded if any member is invalid, or larger than `max_size`.
+    """
+    staged_blobs: dict[str, StagedBlob] = {}
+    try:
+        with tarfile.open(fileobj=fileobj, mode="r|*") as tar:
+            for member in tar:
+                if not member.isfile():
+                    continue
+                filename = os.path.basename(member.name)
+                validate_name(filename)
+                if filename in staged_blobs:
+                    raise ValueError(f"Duplicate file {filename}")
+                # Tar headers carry the size, so nothing is written
+                if max_size is not None and member.size > max_size:
+                    raise UploadTooLarge(max_size)
+                member_file = tar.extractfile(member)
+                assert member_file is not None
+                staged_blobs[filename] = blob_store.stage(
+                    member_file,  # type: ignore
+                    inspect=(
+                        functools.partial(inspect, filename=filename)
+                        if inspect is not None
+                        else None
+                    ),
+                )
+    except BaseException:
+        for staged_blob in staged_blobs.values():
+            blob_store.discard(staged_blob)
+        raise
+    return staged_blobs
+
+
+def commit_batch(blob_store: BlobStore, staged_blobs: dict[str, StagedBlob]) -> None:
+    """
+    Link staged blobs to their paths. Either all paths are updated or, if any
+    link fails, the paths that were already updated are restored.
+    """
+    backups: dict[str, str] = {}
+    committed: list[str] = []
+    try:
+        for path, staged_blob in staged_blobs.items():
+            if os.path.exists(path):
+                backups[path] = f"{path}.{secrets.token_hex(8)}.tmp"
+                os.link(path, backups[path])
+            blob_store.commit(staged_blob, path)
+            committed.append(path)
+    except BaseException:
+        logger.warning("Rolling back batch of %d packages", len(staged_blobs))
+        # Staged files are links to the blobs they were committed to, so they
+        # go first for the blobs to be released
+        for staged_blob in staged_blobs.values():
+            blob_store.discard(staged_blob)
+        for path in reversed(committed):
+            if path in backups:
+                # Keep the committed file until it's replaced, so that its
+                # blob can be released
+                rolled_back = f"{path}.{secrets.token_hex(8)}.tmp"
+                os.link(path, rolled_back)
+                os.replace(backups.pop(path), path)
+                blob_store.release(rolled_back)
+            else:
+                blob_store.release(path)
+        raise
+    finally:
+        for staged_blob in staged_blobs.values():
+            blob_store.discard(staged_blob)
+        # Backups of replaced packages are the last references to their blobs
+        for backup in backups.values():
+            with suppress(FileNotFoundError):
+                blob_store.release(backup)
+
+
+def delete_batch(blob_store: BlobStore, paths: Iterable[str]) -> None:
+    """
+    Delete package files. The files are first moved aside, so that either all
+    of them are deleted or, if any can't be moved, none are.
+    """
+    moved: list[tuple[str, str]] = []
+    try:
+        for path in paths:
+            temp_path = f"{path}.{secrets.token_hex(8)}.tmp"
+            os.rename(path, temp_path)
+            moved.append((path, temp_path))
+    except BaseException:
+        for path, temp_path in reversed(moved):
+            os.rename(temp_path, path)
+        raise
+
+    for path, temp_path in moved:
+        try:
+            blob_store.release(temp_path)
+        except OSError:
+            logger.exception("Error releasing %s", path)
+        with suppress(FileNotFoundError):
+            os.remove(f"{path}.lock")
@@ -0,0 +1,300 @@
+import hashlib
+import io
+import json
+import logging
+import os
+import secrets
+import shutil
+import tempfile
+from typing import Any, BinaryIO, Callable, NamedTuple
+
+from filelock import FileLock
+
+from .atomic import atomic_link, atomic_write, safely_remove_lock_file
+from .hash import sha256_in_chunks
+
+logger = logging.getLogger(__name__)
+
+
+class StagedBlob(NamedTuple):
+    digest: str
+    size: int
+    temp_path: str
+    md5: str
+    metadata: Any = None
+
+
+class _CopyingReader(io.RawIOBase):
+    # Copies and hashes everything that is read through it, so that the content
+    # can be inspected in the same pass that writes it
+    def __init__(self, fileobj: BinaryIO, destination: BinaryIO) -> None:
+        self._fileobj = fileobj
+        self._destination = destination
+        self.sha256_hash = hashlib.sha256()
+        self.md5_hash = hashlib.md5()
+        self.size = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def read(self, size: int | None = -1) -> bytes:
+        data = self._fileobj.read(size)
+        self.sha256_hash.update(data)
+        self.md5_hash.update(data)
+        self._destination.write(data)
+        self.size += len(data)
+        return data
+
+    def readinto(self, buffer) -> int:
+        data = self.read(len(buffer))
+        buffer[: len(data)] = data
+        return len(data)
+
+
+class BlobStore:
+    """
+    Content-addressed store of package files keyed by their sha256 digest.
+    Package files in the channel subdirs are hardlinks to the blobs, so the
+    link count of a blob is its reference count: a blob with a single link
+    is not referenced by any subdir and can be removed.
+    """
+
+    def __init__(self, root: str) -> None:
+        self._root = root
+
+    @property
+    def root(self) -> str:
+        return self._root
+
+    def blob_path(self, digest: str) -> str:
+        return os.path.join(self._root, "sha256", digest[:2], digest)
+
+    def has(self, digest: str) -> bool:
+        return os.path.isfile(self.blob_path(digest))
+
+    def store(
+        self,
+        fileobj: BinaryIO,
+        path: str,
+        expected_digest: str | None = None,
+        inspect: Callable[[BinaryIO], Any] | None = None,
+    ) -> str:
+        """
+        Copy the content of `fileobj` into the store and link it to `path`.
+        Returns the sha256 digest of the content. Raises `ValueError` without
+        touching `path` if the digest does not match `expected_digest`.
+        """
+        staged_blob = self.stage(fileobj, expected_digest, inspect)
+        try:
+            self.commit(staged_blob, path)
+        finally:
+            self.discard(staged_blob)
+        return staged_blob.digest
+
+    def stage(
+        self,
+        fileobj: BinaryIO,
+        expected_digest: str | None = None,
+        inspect: Callable[[BinaryIO], Any] | None = None,
+        chunk_size=65536,
+    ) -> StagedBlob:
+        """
+        Copy the content of `fileobj` to a temporary file in the store without
+        linking it anywhere. The staged blob must be committed or discarded.
+        If given, `inspect` reads the content as it is copied and its result
+        is stored as the metadata of the blob on commit.
+        """
+        temp_dir = os.path.join(self._root, "tmp")
+        os.makedirs(temp_dir, exist_ok=True)
+
+        with tempfile.NamedTemporaryFile(
+            "wb", suffix=".tmp", dir=temp_dir, delete=False
+        ) as temp_file:
+            temp_path = temp_file.name
+            reader = _CopyingReader(fileobj, temp_file)  # type: ignore
+            try:
+                metadata = inspect(reader) if inspect is not None else None  # type: ignore
+                for _ in iter(lambda: reader.read(chunk_size), b""):
+                    pass
+                temp_file.flush()
+                os.fsync(temp_file.fileno())
+            except BaseException:
+                temp_file.close()
+                os.remove(temp_path)
+                raise
+
+        digest = reader.sha256_hash.hexdigest()
+        if expected_digest is not None and digest != expected_digest:
+            os.remove(temp_path)
+            raise ValueError(
+                f"Digest mismatch: expected {expected_digest}, got {digest}"
+            )
+        return StagedBlob(
+            digest, reader.size, temp_path, reader.md5_hash.hexdigest(), metadata
+        )
+
+    def commit(self, staged_blob: StagedBlob, path: str) -> None:
+        if staged_blob.metadata is not None and not os.path.isfile(
+            self.metadata_path(staged_blob.digest)
+        ):
+            self.write_metadata(
+                staged_blob.digest,
+                {
+                    "md5": staged_blob.md5,
+                    "sha256": staged_blob.digest,
+                    "size": staged_blob.size,
+                    **staged_blob.metadata,
+                },
+            )
+        self._link(staged_blob.digest, path, staged_blob.temp_path)
+
+    def discard(self, staged_blob: StagedBlob) -> None:
+        try:
+            os.remove(staged_blob.temp_path)
+        except FileNotFoundError:
+            pass
+
+    def metadata_path(self, digest: str) -> str:
+        return f"{self.blob_path(digest)}.json"
+
+    def read_metadata(self, digest: str) -> dict | None:
+        """
+        Metadata stored with a blob, e.g. the index.json of a package, so that
+        it doesn't have to be extracted again.
+        """
+        try:
+            with open(self.metadata_path(digest), encoding="utf-8") as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def write_metadata(self, digest: str, metadata: dict) -> None:
+        metadata_path = self.metadata_path(digest)
+        os.makedirs(os.path.dirname(metadata_path), exist_ok=True)
+        with atomic_write(metadata_path) as f:
+            json.dump(metadata, f)
+
+    def link(self, digest: str, path: str) -> None:
+        """
+        Link an existing blob to `path`. Raises `FileNotFoundError` if the
+        store does not have a blob for `digest`.
+        """
+        self._link(digest, path)
+
+    def release(self, path: str, digest: str | None = None) -> None:
+        """
+        Remove `path` and drop the blob it references if it was the last
+        reference to it. Passing the digest of the file, if known, saves
+        hashing it.
+        """
+        # A file with a single link was not stored as a blob
+        if os.stat(path).st_nlink == 1:
+            os.remove(path)
+            return
+
+        digest = digest or sha256_in_chunks(path)
+        blob_path = self.blob_path(digest)
+        if not os.path.isfile(blob_path):
+            os.remove(path)
+            return
+
+        try:
+            # Links to a blob are only added and removed under its lock, so
+            # that concurrent releases can't both miss the last reference
+            with FileLock(f"{blob_path}.lock"):
+                stat = os.stat(path)
+                os.remove(path)
+                blob_stat = os.stat(blob_path)
+                if blob_stat.st_ino == stat.st_ino and blob_stat.st_nlink == 1:
+                    logger.info("Removing unreferenced blob %s", digest)
+                    os.remove(blob_path)
+                    self._remove_metadata(digest)
+        except FileNotFoundError:
+            pass
+        finally:
+            safely_remove_lock_file(f"{blob_path}.lock")
+
+    def collect_garbage(self) -> int:
+        """
+        Remove blobs that are not referenced by any package file. Returns the
+        number of blobs removed.
+        """
+        removed = 0
+        blobs_dir = os.path.join(self._root, "sha256")
+        if not os.path.isdir(blobs_dir):
+            return removed
+
+        for dirpath, _, filenames in os.walk(blobs_dir):
+            for filename in filenames:
+                if filename.endswith(".lock"):
+                    continue
+                if filename.endswith(".json"):
+                    # Metadata whose blob was never committed
+                    digest = filename.removesuffix(".json")
+                    if not os.path.exists(os.path.join(dirpath, digest)):
+                        self._remove_metadata(digest)
+                    continue
+                blob_path = os.path.join(dirpath, filename)
+                try:
+                    with FileLock(f"{blob_path}.lock"):
+                        if os.stat(blob_path).st_nlink == 1:
+                            os.remove(blob_path)
+                            self._remove_metadata(filename)
+                            removed += 1
+                except FileNotFoundError:
+                    pass
+                finally:
+                    safely_remove_lock_file(f"{blob_path}.lock")
+        return removed
+
+    def _remove_metadata(self, digest: str) -> None:
+        try:
+            os.remove(self.metadata_path(digest))
+        except FileNotFoundError:
+            pass
+
+    def _link(self, digest: str, path: str, source: str | None = None) -> None:
+        blob_path = self.blob_path(digest)
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+
+        # Keep a link to the file being replaced, if any, so that its blob can
+        # be released once the path no longer references it
+        replaced_path: str | None = f"{path}.{secrets.token_hex(8)}.tmp"
+        try:
+            os.link(path, replaced_path)
+        except FileNotFoundError:
+            replaced_path = None
+
+        try:
+            # Hold the blob lock so that the blob can't be released while it's
+            # being linked into place
+            with FileLock(f"{blob_path}.lock"):
+                if source is not None and not os.path.exists(blob_path):
+                    os.link(source, blob_path)
+                elif not os.path.exists(blob_path):
+                    raise FileNotFoundError(f"Blob {digest} not found")
+
+                try:
+                    atomic_link(blob_path, path)
+                except OSError as e:
+                    # Hardlinks are not supported across filesystems. Fall back to
+                    # copying the blob into place.
+                    logger.warning(
+                        "Could not link blob %s to %s, copying instead: %s",
+                        digest,
+                        path,
+                        e,
+                    )
+                    with open(blob_path, "rb") as blob, atomic_write(
+                        path, mode="wb"
+                    ) as buffer:
+                        shutil.copyfileobj(blob, buffer)
+        except BaseException:
+            if replaced_path is not None:
+                os.remove(replaced_path)
+            raise
+        finally:
+            safely_remove_lock_file(f"{blob_path}.lock")
+
+        if replaced_path is not None:
+            self.release(replaced_path)
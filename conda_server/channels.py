@@ -0,0 +1,225 @@
+import asyncio
+import logging
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Callable
+
+from .index import IndexManager
+from .mirror import Mirror, Upstream
+from .utils import (
+    get_channel_dir,
+    get_channel_idle_timeout,
+    get_channels_dir,
+    get_upstream_ttl,
+    get_upstream_url,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class Channel:
+    """
+    A channel served by this process. The default channel is named `None` and
+    lives in `$CONDA_CHANNEL_DIR`; named channels live in subdirectories of
+    `$CONDA_SERVER_CHANNELS_DIR`. Everything a channel caches hangs off this
+    object, so it is released when the channel is closed. A channel with an
+    upstream is a read-only mirror that serves the upstream's index instead of
+    indexing its directory, and a replica serves the index that a follower
+    replicates from its leader.
+    """
+
+    def __init__(
+        self,
+        name: str | None,
+        directory: str,
+        upstream: Upstream | None = None,
+        replica=False,
+    ) -> None:
+        self._name = name
+        self._directory = directory
+        self._replica = replica
+        self._users = 0
+        self._last_used = time.monotonic()
+        self._catch_up_task: asyncio.Task[None] | None = None
+        self.index_manager = IndexManager(directory)
+        self.mirror = (
+            Mirror(upstream, directory, ttl=get_upstream_ttl()) if upstream else None
+        )
+
+    @property
+    def name(self) -> str | None:
+        return self._name
+
+    @property
+    def directory(self) -> str:
+        return self._directory
+
+    @property
+    def is_default(self) -> bool:
+        return self._name is None
+
+    @property
+    def in_use(self) -> bool:
+        return self._users > 0
+
+    def idle_for(self) -> float:
+        if self.in_use:
+            return 0.0
+        return time.monotonic() - self._last_used
+
+    @property
+    def is_mirror(self) -> bool:
+        return self.mirror is not None
+
+    @property
+    def is_replica(self) -> bool:
+        return self._replica
+
+    def open(self, catch_up: bool = False) -> None:
+        # Indexing a mirror or a replica would overwrite the index files fetched
+        # from upstream or from the leader
+        if self.is_mirror or self.is_replica:
+            return
+        self.index_manager.watch_channel_dir()
+        if catch_up:
+            # Changes made while the channel was closed were not seen by a watcher
+            self._catch_up_task = asyncio.create_task(
+                self.index_manager.generate_index()
+            )
+
+    async def close(self) -> None:
+        self.index_manager.stop_watching()
+        if self._catch_up_task is not None:
+            self._catch_up_task.cancel()
+            self._catch_up_task = None
+        if self.mirror is not None:
+            await self.mirror.aclose()
+
+    def _acquire(self) -> None:
+        self._users += 1
+
+    def _release(self) -> None:
+        self._users -= 1
+        self._last_used = time.monotonic()
+
+
+class ChannelRegistry:
+    """
+    Opens channels on first use and closes named channels after they have been
+    idle for `$CONDA_SERVER_CHANNEL_IDLE_TIMEOUT` seconds. The default channel
+    stays open for the lifetime of the registry. The channels of a `replica`
+    registry are replicas.
+    """
+
+    def __init__(
+        self,
+        channels_dir: str | None = None,
+        idle_timeout: float | None = None,
+        on_open: Callable[[Channel], None] | None = None,
+        replica=False,
+    ) -> None:
+        self._channels_dir = channels_dir or get_channels_dir()
+        # Called when a channel is opened, e.g. to attach services to it
+        self._on_open = on_open
+        self._idle_timeout = (
+            get_channel_idle_timeout() if idle_timeout is None else idle_timeout
+        )
+        self._replica = replica
+        self._channels: dict[str | None, Channel] = {}
+        self._reap_task: asyncio.Task[None] | None = None
+
+    @property
+    def is_started(self) -> bool:
+        return self._reap_task is not None
+
+    def channel_dir(self, name: str | None) -> str:
+        if name is None:
+            return get_channel_dir()
+        return os.path.join(self._channels_dir, name)
+
+    def get(self, name: str | None = None) -> Channel:
+        """
+        Return the channel with the given name, opening it if necessary. Raises
+        `FileNotFoundError` if a named channel has no directory.
+        """
+        if channel := self._channels.get(name):
+            return channel
+
+        directory = self.channel_dir(name)
+        if name is not None and not os.path.isdir(directory):
+            raise FileNotFoundError(f"Channel {name} not found")
+
+        upstream_url = get_upstream_url(name)
+        channel = Channel(
+            name,
+            directory,
+            Upstream(upstream_url) if upstream_url else None,
+            replica=self._replica,
+        )
+        self._channels[name] = channel
+        if self.is_started:
+            logger.info("Opening channel %s", name or "<default>")
+            self._open(channel)
+        return channel
+
+    @asynccontextmanager
+    async def use(self, name: str | None = None) -> AsyncIterator[Channel]:
+        """
+        Use a channel for the duration of the context. A channel in use is never
+        closed for being idle.
+        """
+        channel = self.get(name)
+        channel._acquire()
+        try:
+            yield channel
+        finally:
+            channel._release()
+
+    def start(self) -> None:
+        if self.is_started:
+            return
+        self.get(None)
+        for channel in self._channels.values():
+            self._open(channel)
+        self._reap_task = asyncio.create_task(self._reap_idle_channels())
+
+    def _open(self, channel: Channel) -> None:
+        channel.open(catch_up=not channel.is_default)
+        if self._on_open is not None:
+            self._on_open(channel)
+
+    async def stop(self) -> None:
+        if self._reap_task is not None:
+            self._reap_task.cancel()
+            self._reap_task = None
+        for channel in self._channels.values():
+            await channel.close()
+        self._channels.clear()
+
+    async def close_idle_channels(self) -> int:
+        closed = 0
+        for name, channel in list(self._channels.items()):
+            if (
+                channel.is_default
+                or channel.in_use
+                or channel.idle_for() < self._idle_timeout
+            ):
+                continue
+            logger.info("Closing idle channel %s", name)
+            del self._channels[name]
+            await channel.close()
+            closed += 1
+        return closed
+
+    async def _reap_idle_channels(self) -> None:
+        while True:
+            await asyncio.sleep(max(self._idle_timeout / 2, 1))
+            await self.close_idle_channels()
+
+    async def __aenter__(self) -> "ChannelRegistry":
+        self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback) -> None:
+        await self.stop()
@@ -0,0 +1,49 @@
+from starlette.convertors import Convertor, register_url_convertor
+
+from .utils import get_platforms
+
+# Top-level path segments that are served by the server itself and can't be
+# used as channel names
+RESERVED_CHANNEL_NAMES = {"blobs", "replication"}
+
+
+class PlatformConvertor(Convertor[str]):
+    regex = "|".join(sorted(get_platforms()))
+
+    def convert(self, value: str) -> str:
+        return value
+
+    def to_string(self, value: str) -> str:
+        return value
+
+
+class ChannelConvertor(Convertor[str]):
+    # Channel names must not shadow platforms, otherwise `/{platform}/...` routes
+    # of the default channel would be ambiguous
+    regex = (
+        f"(?!(?:{'|'.join(sorted(get_platforms() | RESERVED_CHANNEL_NAMES))})(?:/|$))"
+        r"[a-z0-9][a-z0-9_-]*"
+    )
+
+    def convert(self, value: str) -> str:
+        return value
+
+    def to_string(self, value: str) -> str:
+        return value
+
+
+class PackageFileConvertor(Convertor[str]):
+    regex = r"[^/]+\.(?:tar\.bz2|conda)"
+
+    def convert(self, value: str) -> str:
+        return value
+
+    def to_string(self, value: str) -> str:
+        return value
+
+
+def register_convertors() -> None:
+    # Convertors must be registered before any route that uses them is declared
+    register_url_convertor("platform", PlatformConvertor())
+    register_url_convertor("channel", ChannelConvertor())
+    register_url_convertor("package", PackageFileConvertor())
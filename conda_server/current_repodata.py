@@ -0,0 +1,102 @@
+import logging
+from typing import Any, Callable, Iterable, NamedTuple
+
+from .specs import parse_dependency
+from .validation import version_key
+
+logger = logging.getLogger(__name__)
+
+
+class PackageRecord(NamedTuple):
+    fn: str
+    name: str
+    version: str
+    build: str
+    depends: tuple[str, ...]
+    has_features: bool
+
+    @classmethod
+    def from_record(cls, fn: str, record: dict) -> "PackageRecord":
+        return cls(
+            fn=fn,
+            name=record["name"],
+            version=record["version"],
+            build=record.get("build", ""),
+            depends=tuple(record.get("depends", ())),
+            has_features=bool(record.get("track_features") or record.get("features")),
+        )
+
+
+class CurrentRecords(NamedTuple):
+    # Files of the subdir that current_repodata.json includes for a name
+    fns: set[str]
+    # Names whose packages the included files were chosen from
+    requires: set[str]
+
+
+def ordering_key(package_version: str) -> tuple[int, Any]:
+    """
+    Sort key of a package version under the configured versioning scheme.
+    Versions that can't be parsed sort before all others.
+    """
+    try:
+        return 1, version_key(package_version)
+    except ValueError:
+        return 0, package_version
+
+
+def latest_records(records: Iterable[PackageRecord]) -> list[PackageRecord]:
+    """All builds of the latest version among `records`."""
+    records = list(records)
+    if not records:
+        return []
+    latest = max(ordering_key(record.version) for record in records)
+    return [record for record in records if ordering_key(record.version) == latest]
+
+
+def current_records(
+    name: str, load_records: Callable[[str], list[PackageRecord]]
+) -> CurrentRecords:
+    """
+    Select the packages that current_repodata.json includes for a package name,
+    the same way conda-index does: all builds of its latest version, the newest
+    version without features if the latest one has features, and for each
+    dependency that the latest versions of the other names can't satisfy, the
+    newest version that can, recursively. `load_records` returns the records of
+    the subdir with a given package name.
+    """
+    records = load_records(name)
+    included = {record.fn: record for record in latest_records(records)}
+    requires = {name}
+
+    if any(record.has_features for record in included.values()):
+        featureless = [record for record in records if not record.has_features]
+        for record in latest_records(featureless):
+            included.setdefault(record.fn, record)
+
+    pending = list(included.values())
+    while pending:
+        record = pending.pop()
+        for dependency in record.depends:
+            try:
+                dependency_name, matches = parse_dependency(dependency)
+            except ValueError:
+                logger.warning("Ignoring dependency %r of %s", dependency, record.fn)
+                continue
+            requires.add(dependency_name)
+            candidates = load_records(dependency_name)
+            if not candidates:
+                continue
+
+            available = latest_records(candidates) + [
+                candidate for candidate in candidates if candidate.fn in included
+            ]
+            if any(matches(c.version, c.build) for c in available):
+                continue
+            matching = [c for c in candidates if matches(c.version, c.build)]
+            for candidate in latest_records(matching):
+                if candidate.fn not in included:
+                    included[candidate.fn] = candidate
+                    pending.append(candidate)
+
+    return CurrentRecords(fns=set(included), requires=requires)
@@ -0,0 +1,207 @@
+import asyncio
+import logging
+import os
+import sqlite3
+import time
+from collections import Counter
+from contextlib import closing, suppress
+from typing import Literal
+
+from fastapi.concurrency import run_in_threadpool
+
+from .validation import parse_package_filename
+
+logger = logging.getLogger(__name__)
+
+# Counts are kept per hour, the finest granularity they can be queried at
+BUCKET_SECONDS = 3600
+
+GroupBy = Literal["package", "file", "subdir", "bucket"]
+_GROUP_COLUMNS = {
+    "package": "name",
+    "file": "fn",
+    "subdir": "subdir",
+    "bucket": "bucket",
+}
+
+# (channel, subdir, fn, bucket)
+_CounterKey = tuple[str, str, str, int]
+
+
+class DownloadCounter:
+    """
+    Counts package downloads in memory and adds them to a SQLite database in
+    batches, every `flush_interval` seconds or once `flush_threshold` downloads
+    are pending, whichever comes first. Counts are added to the stored ones, so
+    the workers of a server can share a database. A crash loses at most the
+    pending counts.
+    """
+
+    def __init__(
+        self,
+        db_path: str,
+        flush_interval: float = 10.0,
+        flush_threshold: int = 1000,
+    ) -> None:
+        self._db_path = db_path
+        self._flush_interval = flush_interval
+        self._flush_threshold = flush_threshold
+        self._pending: Counter[_CounterKey] = Counter()
+        self._pending_total = 0
+        self._flush_requested = asyncio.Event()
+        self._flush_task: asyncio.Task[None] | None = None
+
+    @property
+    def pending(self) -> int:
+        return self._pending_total
+
+    def connect(self) -> sqlite3.Connection:
+        os.makedirs(os.path.dirname(self._db_path), exist_ok=True)
+        connection = sqlite3.connect(self._db_path, timeout=30.0)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("""
+            CREATE TABLE IF NOT EXISTS downloads (
+                channel TEXT NOT NULL,
+                subdir TEXT NOT NULL,
+                fn TEXT NOT NULL,
+                bucket INTEGER NOT NULL,
+                name TEXT NOT NULL,
+                count INTEGER NOT NULL,
+                PRIMARY KEY (channel, subdir, fn, bucket)
+            ) WITHOUT ROWID
+            """)
+        return connection
+
+    def record(
+        self, channel: str | None, subdir: str, fn: str, now: float | None = None
+    ) -> None:
+        """Count a download. Never blocks; the count is written later."""
+        now = time.time() if now is None else now
+        bucket = int(now) // BUCKET_SECONDS * BUCKET_SECONDS
+        self._pending[(channel or "", subdir, fn, bucket)] += 1
+        self._pending_total += 1
+        if self._pending_total >= self._flush_threshold:
+            self._flush_requested.set()
+
+    async def flush(self) -> None:
+        """Write the pending counts to the database."""
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, Counter()
+        self._pending_total = 0
+        try:
+            await run_in_threadpool(self._write, pending)
+        except sqlite3.Error as e:
+            # Keep the counts for the next flush
+            logger.error("Flushing download counts failed: %s", e)
+            self._pending.update(pending)
+            self._pending_total += pending.total()
+
+    def _write(self, pending: Counter[_CounterKey]) -> None:
+        rows = []
+        for (channel, subdir, fn, bucket), count in pending.items():
+            try:
+                name = parse_package_filename(fn).name
+            except ValueError:
+                name = fn
+            rows.append((channel, subdir, fn, bucket, name, count))
+        with closing(self.connect()) as connection, connection:
+            connection.executemany(
+                """
+                INSERT INTO downloads (channel, subdir, fn, bucket, name, count)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (channel, subdir, fn, bucket)
+                DO UPDATE SET count = count + excluded.count
+                """,
+                rows,
+            )
+
+    def query(
+        self,
+        channel: str | None,
+        group_by: GroupBy = "package",
+        subdir: str | None = None,
+        package: str | None = None,
+        since: float | None = None,
+        until: float | None = None,
+        bucket_seconds: int = BUCKET_SECONDS,
+    ) -> list[tuple[str | int, int]]:
+        """
+        Download counts of a channel, optionally only of a subdir or package
+        name and within a time range, summed per group in descending order of
+        counts. Time buckets are summed into buckets of `bucket_seconds`, and
+        are ordered by time instead.
+        """
+        conditions = ["channel = ?"]
+        parameters: list[str | float] = [channel or ""]
+        if subdir is not None:
+            conditions.append("subdir = ?")
+            parameters.append(subdir)
+        if package is not None:
+            conditions.append("name = ?")
+            parameters.append(package)
+        if since is not None:
+            conditions.append("bucket >= ?")
+            parameters.append(int(since) // BUCKET_SECONDS * BUCKET_SECONDS)
+        if until is not None:
+            conditions.append("bucket < ?")
+            parameters.append(until)
+
+        if group_by == "bucket":
+            group = f"bucket / {int(bucket_seconds)} * {int(bucket_seconds)}"
+            order = "key"
+        else:
+            group = _GROUP_COLUMNS[group_by]
+            order = "total DESC, key"
+        with closing(self.connect()) as connection:
+            return connection.execute(
+                f"""
+                SELECT {group} AS key, SUM(count) AS total FROM downloads
+                WHERE {" AND ".join(conditions)}
+                GROUP BY key ORDER BY {order}
+                """,
+                parameters,
+            ).fetchall()
+
+    def most_downloaded(
+        self, channel: str | None, since: float | None = None, limit: int = 100
+    ) -> list[tuple[str, str, int]]:
+        """The most downloaded files of a channel, as (subdir, fn, count)."""
+        conditions = ["channel = ?"]
+        parameters: list[str | int] = [channel or ""]
+        if since is not None:
+            conditions.append("bucket >= ?")
+            parameters.append(int(since) // BUCKET_SECONDS * BUCKET_SECONDS)
+        with closing(self.connect()) as connection:
+            return connection.execute(
+                f"""
+                SELECT subdir, fn, SUM(count) AS total FROM downloads
+                WHERE {" AND ".join(conditions)}
+                GROUP BY subdir, fn ORDER BY total DESC, subdir, fn LIMIT ?
+                """,
+                [*parameters, limit],
+            ).fetchall()
+
+    async def _run(self) -> None:
+        while True:
+            with suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(
+                    self._flush_requested.wait(), self._flush_interval
+                )
+            self._flush_requested.clear()
+            await self.flush()
+
+    async def __aenter__(self) -> "DownloadCounter":
+        self._flush_requested = asyncio.Event()
+        if self._pending_total >= self._flush_threshold:
+            self._flush_requested.set()
+        self._flush_task = asyncio.create_task(self._run())
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback) -> None:
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._flush_task
+            self._flush_task = None
+        await self.flush()
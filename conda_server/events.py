@@ -0,0 +1,230 @@
+import asyncio
+import hashlib
+import logging
+import os
+import secrets
+from collections import deque
+from typing import AsyncIterator, NamedTuple
+
+from fastapi.concurrency import run_in_threadpool
+
+from .channels import Channel
+from .repodata import read_published_packages
+from .utils import get_platforms
+
+logger = logging.getLogger(__name__)
+
+# Index files whose new ETags are published with each generation
+SUBDIR_INDEX_FILES = (
+    "repodata.json",
+    "repodata.json.bz2",
+    "repodata.json.zst",
+    "current_repodata.json",
+    "current_repodata.json.bz2",
+    "current_repodata.json.zst",
+)
+CHANNEL_INDEX_FILES = ("channeldata.json",)
+
+
+class ChannelEvent(NamedTuple):
+    id: int
+    channel: str | None
+    data: dict
+
+
+def file_etag(stat: os.stat_result) -> str:
+    # The ETag that `FileResponse` sends for a file with this stat
+    etag_base = f"{stat.st_mtime}-{stat.st_size}"
+    return f'"{hashlib.md5(etag_base.encode(), usedforsecurity=False).hexdigest()}"'
+
+
+class EventHub:
+    """
+    Publishes what the index generations of channels change as events: an
+    "added" event for every package a generation published or replaced and a
+    "removed" event for every package it dropped, followed by a "published"
+    event with the indexed subdirs and the new ETags of their index files.
+
+    The last `capacity` events are kept in a ring shared by all subscribers,
+    and a subscriber is only a position in it, so idle subscribers cost
+    nothing but their connection and every publish wakes them through a
+    single event. A subscriber's backlog is bounded by the ring: one that
+    falls further behind gets a "reset" event and should refetch the index.
+    Event tokens resume a subscription from where it left off, within this
+    process.
+    """
+
+    def __init__(self, capacity=10000) -> None:
+        self._epoch = secrets.token_hex(4)
+        self._events: deque[ChannelEvent] = deque(maxlen=capacity)
+        self._next_id = 1
+        self._published = asyncio.Event()
+        self._closed = False
+        self._lock = asyncio.Lock()
+        self._tasks: set[asyncio.Task[None]] = set()
+        # (channel dir, subdir) -> fn -> (sha256, size) as of the last event
+        self._packages: dict[tuple[str, str], dict] = {}
+
+    def attach(self, channel: Channel) -> None:
+        """Publish the changes of each index generation of a channel."""
+        # The packages published so far are the baseline of the first events
+        self._schedule(channel.name, channel.directory, None, publish=False)
+        channel.index_manager.add_generation_listener(
+            lambda subdirs: self._schedule(channel.name, channel.directory, subdirs)
+        )
+
+    def _schedule(
+        self,
+        channel: str | None,
+        channel_dir: str,
+        subdirs: set[str] | None,
+        publish=True,
+    ) -> None:
+        task = asyncio.create_task(
+            self.publish_generation(channel, channel_dir, subdirs, publish)
+        )
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def publish_generation(
+        self,
+        channel: str | None,
+        channel_dir: str,
+        subdirs: set[str] | None,
+        publish=True,
+    ) -> None:
+        # Generations are diffed one at a time, in the order they finished
+        async with self._lock:
+            try:
+                events = await run_in_threadpool(
+                    self._diff_generation, channel_dir, subdirs
+                )
+            except OSError as e:
+                logger.error("Reading index of %s failed: %s", channel_dir, e)
+                return
+        if publish:
+            for data in events:
+                self._append(channel, data)
+            self._wake()
+
+    def _diff_generation(self, channel_dir: str, subdirs: set[str] | None) -> list:
+        if subdirs is None:
+            subdirs = {
+                subdir
+                for subdir in get_platforms()
+                if os.path.isdir(os.path.join(channel_dir, subdir))
+            } | {
+                subdir
+                for directory, subdir in self._packages
+                if directory == channel_dir
+            }
+
+        events = []
+        etags = {}
+        for subdir in sorted(subdirs):
+            published = read_published_packages(channel_dir, subdir)
+            previous = self._packages.get((channel_dir, subdir), {})
+            self._packages[(channel_dir, subdir)] = published
+            for fn in sorted(previous.keys() - published.keys()):
+                events.append({"type": "removed", "subdir": subdir, "fn": fn})
+            for fn, (sha256, size) in sorted(published.items()):
+                if previous.get(fn) != (sha256, size):
+                    events.append(
+                        {
+                            "type": "added",
+                            "subdir": subdir,
+                            "fn": fn,
+                            "sha256": sha256,
+                            "size": size,
+                        }
+                    )
+            etags.update(_etags(channel_dir, subdir, SUBDIR_INDEX_FILES))
+        etags.update(_etags(channel_dir, "", CHANNEL_INDEX_FILES))
+        events.append({"type": "published", "subdirs": sorted(subdirs), "etags": etags})
+        return events
+
+    def _append(self, channel: str | None, data: dict) -> None:
+        self._events.append(ChannelEvent(self._next_id, channel, data))
+        self._next_id += 1
+
+    def _wake(self) -> None:
+        self._published.set()
+        self._published = asyncio.Event()
+
+    def token(self, event_id: int) -> str:
+        return f"{self._epoch}-{event_id}"
+
+    def _resume_position(self, token: str | None) -> int | None:
+        # The id of the first event to send, or None if the events after the
+        # token are gone
+        if token is None:
+            return self._next_id
+        epoch, _, event_id = token.partition("-")
+        if epoch != self._epoch or not event_id.isdigit():
+            return None
+        position = int(event_id) + 1
+        first_id = self._events[0].id if self._events else self._next_id
+        if not first_id <= position <= self._next_id:
+            return None
+        return position
+
+    def subscribe(
+        self, channel: str | None, token: str | None = None, keepalive=15.0
+    ) -> AsyncIterator[ChannelEvent | None]:
+        """
+        The events of a channel after `token`, or from now on without one,
+        until the hub is closed. Yields None every `keepalive` seconds without
+        events, so that idle connections stay open.
+        """
+        # The position is taken now, not when the events are first read
+        return self._iter_events(channel, self._resume_position(token), keepalive)
+
+    async def _iter_events(
+        self, channel: str | None, position: int | None, keepalive: float
+    ) -> AsyncIterator[ChannelEvent | None]:
+        while True:
+            # The ring moves on while events are yielded, so the position is
+            # checked against it before each event
+            while True:
+                first_id = self._events[0].id if self._events else self._next_id
+                if position is None or position < first_id:
+                    position = self._next_id
+                    yield ChannelEvent(position - 1, channel, {"type": "reset"})
+                    continue
+                if position >= self._next_id:
+                    break
+                event = self._events[position - first_id]
+                position += 1
+                if event.channel == channel:
+                    yield event
+            if self._closed:
+                return
+            published = self._published
+            try:
+                await asyncio.wait_for(published.wait(), keepalive)
+            except asyncio.TimeoutError:
+                yield None
+
+    def close(self) -> None:
+        self._closed = True
+        self._wake()
+
+    async def __aenter__(self) -> "EventHub":
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback) -> None:
+        # Subscribers end their streams, so that the server can shut down
+        self.close()
+        for task in self._tasks:
+            task.cancel()
+
+
+def _etags(channel_dir: str, subdir: str, filenames: tuple[str, ...]) -> dict:
+    etags = {}
+    for filename in filenames:
+        name = f"{subdir}/{filename}" if subdir else filename
+        try:
+            etags[name] = file_etag(os.stat(os.path.join(channel_dir, name)))
+        except FileNotFoundError:
+            pass
+    return etags
@@ -1,29 +1,57 @@
 import asyncio
 import logging
-from typing import Iterable
+import os
+import time
+from contextlib import asynccontextmanager, suppress
+from typing import AsyncIterator, Callable, Iterable
 
-from conda_index.cli import cli
+from conda_index.index import ChannelIndex
 from fastapi.concurrency import run_in_threadpool
 from filelock import FileLock
-from watchfiles import Change, awatch
+from watchfiles import Change
 
 from .atomic import safely_remove_lock_file
-from .utils import get_channel_dir
+from .repodata import RepodataStore
+from .utils import (
+    get_channel_dir,
+    get_max_concurrent_indexing,
+    get_platforms,
+    get_watch_mode,
+    get_watch_poll_interval,
+    get_watch_rescan_interval,
+)
+from .watcher import ChangeQueue, ChannelWatcher
 
 logger = logging.getLogger(__name__)
 
+# Shared by the index managers of all channels, so that a busy channel can't
+# starve the others of indexing capacity
+_index_slots = asyncio.Semaphore(get_max_concurrent_indexing())
+
 
 # See https://github.com/conda/conda-index
 class IndexManager:
-    def __init__(self) -> None:
+    def __init__(self, channel_dir: str | None = None) -> None:
+        self._channel_dir = channel_dir or get_channel_dir()
         self._pending_index_generation_lock = FileLock(
-            f"{get_channel_dir()}/.pending_index_generation.lock"
+            f"{self._channel_dir}/.pending_index_generation.lock"
         )
         self._index_generation_lock = FileLock(
-            f"{get_channel_dir()}/.index_generation.lock"
+            f"{self._channel_dir}/.index_generation.lock"
         )
         self._watch_task: asyncio.Task[None] | None = None
         self._stop_watching_event = asyncio.Event()
+        self._ignored_paths: dict[str, float] = {}
+        # Subdirs to index in the next generation, or None for all of them
+        self._pending_subdirs: set[str] | None = set()
+        self.repodata = RepodataStore(self._channel_dir)
+        self._generation_listeners: list[Callable[[set[str] | None], None]] = []
+        # Held while index files are written, within this process
+        self._publish_lock = asyncio.Lock()
+
+    @property
+    def channel_dir(self) -> str:
+        return self._channel_dir
 
     @property
     def is_watching(self) -> bool:
@@ -32,6 +60,10 @@ class IndexManager:
     async def generate_index(
         self, file_changes: set[tuple[Change, str]] | None = None
     ) -> None:
+        # Only the subdirs with changes are indexed. Generations that are canceled
+        # below leave their subdirs to the pending generation.
+        self._add_pending_subdirs(file_changes)
+
         # Only allow one executing generation and one follow-up pending generation to
         # be executing at the same time.
         if self._pending_index_generation_lock.is_locked:
@@ -48,52 +80,180 @@ class IndexManager:
                 self._pending_index_generation_lock.acquire()
 
             try:
+                # The file lock is reentrant within the process, so a pending
+                # generation waits for the running one on the publish lock,
+                # before it takes one of the shared slots
                 with self._index_generation_lock:
-                    logger.info("Generating index.")
-                    await run_in_threadpool(
-                        cli.callback,  # type: ignore
-                        get_channel_dir(),  # type: ignore
-                        channeldata=True,
-                        bz2=True,
-                        zst=True,
-                        rss=True,
-                    )
+                    async with self._publish_lock, _index_slots:
+                        subdirs, self._pending_subdirs = self._pending_subdirs, set()
+                        logger.info(
+                            "Generating index for %s (%s).",
+                            self._channel_dir,
+                            ", ".join(sorted(subdirs)) if subdirs else "all subdirs",
+                        )
+                        await run_in_threadpool(self._write_repodata, subdirs)
+                        await run_in_threadpool(self._write_channeldata, subdirs)
+                        self.notify_published(subdirs)
             finally:
-                safely_remove_lock_file(f"{get_channel_dir()}/.index_generation.lock")
+                safely_remove_lock_file(f"{self._channel_dir}/.index_generation.lock")
 
             if self._pending_index_generation_lock.is_locked:
                 self._pending_index_generation_lock.release()
         finally:
             if self._pending_index_generation_lock.is_locked:
                 safely_remove_lock_file(
-                    f"{get_channel_dir()}/.pending_index_generation.lock"
+                    f"{self._channel_dir}/.pending_index_generation.lock"
                 )
 
+    @asynccontextmanager
+    async def published(self) -> AsyncIterator[None]:
+        """
+        Hold off index generations, so that the index files of the channel
+        stay those of the last published generation.
+        """
+        async with self._publish_lock:
+            yield
+
+    def add_generation_listener(
+        self, listener: Callable[[set[str] | None], None]
+    ) -> None:
+        """
+        Call `listener` with the indexed subdirs, or None for all of them, after
+        each index generation. Listeners must not block.
+        """
+        self._generation_listeners.append(listener)
+
+    def notify_published(self, subdirs: set[str] | None) -> None:
+        """
+        Call the generation listeners, for callers that publish index files
+        without generating them.
+        """
+        for listener in self._generation_listeners:
+            listener(subdirs)
+
+    def _resolve_subdirs(self, subdirs: set[str] | None) -> set[str]:
+        if subdirs:
+            return subdirs
+        return {
+            subdir
+            for subdir in get_platforms()
+            if os.path.isdir(os.path.join(self._channel_dir, subdir))
+        } | {"noarch"}
+
+    def _write_repodata(self, subdirs: set[str] | None) -> None:
+        for subdir in sorted(self._resolve_subdirs(subdirs)):
+            self.repodata.update(subdir)
+            self.repodata.write_repodata(subdir)
+            # current_repodata.json is only rewritten if its packages changed
+            current_path = os.path.join(
+                self._channel_dir, subdir, "current_repodata.json"
+            )
+            if self.repodata.update_current(subdir) or not os.path.exists(current_path):
+                self.repodata.write_current_repodata(subdir)
+
+    def _write_channeldata(self, subdirs: set[str] | None) -> None:
+        # conda-index only updates channeldata.json and rss.xml, from the
+        # repodata.json just written. Its cache of package metadata, e.g.
+        # about.json, is updated from the packages that changed, but it
+        # doesn't build or write repodata.
+        channel_index = ChannelIndex(
+            self._channel_dir,
+            channel_name=None,
+            subdirs=sorted(self._resolve_subdirs(subdirs)),
+            write_current_repodata=False,
+        )
+        for subdir in channel_index.detect_subdirs():
+            subdir_path = os.path.join(self._channel_dir, subdir)
+            cache = channel_index.cache_for_subdir(subdir)
+            cache.save_fs_state(subdir_path)
+            channel_index.extract_subdir_to_cache(
+                subdir, False, False, subdir_path, cache
+            )
+        channel_index.update_channeldata(rss=True)
+
+    def _add_pending_subdirs(
+        self, file_changes: set[tuple[Change, str]] | None
+    ) -> None:
+        if self._pending_subdirs is None:
+            return
+        if not file_changes:
+            self._pending_subdirs = None
+            return
+        for _, path in file_changes:
+            subdir = os.path.relpath(os.path.dirname(path), self._channel_dir)
+            if subdir not in get_platforms():
+                self._pending_subdirs = None
+                return
+            self._pending_subdirs.add(subdir)
+
+    def ignore_changes(self, paths: Iterable[str], timeout: float = 10.0) -> None:
+        """
+        Ignore the next watcher event for each of the given paths, for callers
+        that change files and generate the index themselves. Paths that don't
+        see an event within `timeout` seconds are no longer ignored.
+        """
+        deadline = time.monotonic() + timeout
+        for path in paths:
+            self._ignored_paths[os.path.abspath(path)] = deadline
+
+    def _filter_ignored_changes(
+        self, changes: set[tuple[Change, str]]
+    ) -> set[tuple[Change, str]]:
+        now = time.monotonic()
+        self._ignored_paths = {
+            path: deadline
+            for path, deadline in self._ignored_paths.items()
+            if deadline >= now
+        }
+        remaining_changes = set()
+        for change, path in changes:
+            if os.path.abspath(path) not in self._ignored_paths:
+                remaining_changes.add((change, path))
+        for _, path in changes - remaining_changes:
+            self._ignored_paths.pop(os.path.abspath(path), None)
+        return remaining_changes
+
     def watch_channel_dir(self) -> None:
         if self.is_watching:
             logger.info("Already watching the channel directory.")
             return
         # Start watching the channel directory for changes
-        logger.info("Watching the channel directory for changes.")
+        logger.info("Watching %s for changes.", self._channel_dir)
+        self._stop_watching_event = asyncio.Event()
         self._watch_task = asyncio.create_task(self._watch_channel_dir())
         self._watch_task.add_done_callback(self._on_watch_done)
 
     def stop_watching(self) -> None:
         if not self.is_watching:
             return
+        # The event is replaced when watching starts again, so it stays set until
+        # the watch task has seen it
         self._stop_watching_event.set()
-        logger.info("Stopped watching the channel directory.")
-        self._stop_watching_event.clear()
+        logger.info("Stopped watching %s.", self._channel_dir)
 
     async def _watch_channel_dir(self) -> None:
-        # Watch the channel directory for changes
-        async for change in awatch(
-            get_channel_dir(),
-            stop_event=self._stop_watching_event,
-            watch_filter=FileExtensionFilter([".tar.bz2", ".conda"]),
-        ):
-            # Generate the index when a change is detected
-            await self.generate_index(change)
+        # The watcher produces changes into a queue while the index is
+        # generated, so that neither waits for the other. Changes made during a
+        # generation are merged per path and indexed by the next one.
+        changes_queue = ChangeQueue()
+        watcher = ChannelWatcher(
+            self._channel_dir,
+            mode=get_watch_mode(),
+            poll_interval=get_watch_poll_interval(),
+            rescan_interval=get_watch_rescan_interval(),
+        )
+        producer = asyncio.create_task(
+            watcher.run(changes_queue, self._stop_watching_event)
+        )
+        try:
+            while (changes := await changes_queue.get()) is not None:
+                changes = self._filter_ignored_changes(changes)
+                if changes:
+                    await self.generate_index(changes)
+        finally:
+            producer.cancel()
+            with suppress(asyncio.CancelledError):
+                await producer
 
     def _on_watch_done(self, task: asyncio.Task[None]) -> None:
         self._watch_task = None
@@ -104,11 +264,3 @@ class IndexManager:
 
     def __exit__(self, exc_type, exc_value, traceback) -> None:
         self.stop_watching()
-
-
-class FileExtensionFilter:
-    def __init__(self, file_extensions: Iterable[str]) -> None:
-        self._select_file_extensions = file_extensions
-
-    def __call__(self, change: Change, path: str) -> bool:
-        return any(path.endswith(ext) for ext in self._select_file_extensions)
@@ -0,0 +1,230 @@
+import asyncio
+import hashlib
+import html
+import json
+import math
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Callable, NamedTuple
+
+from fastapi.concurrency import run_in_threadpool
+
+from .channels import Channel
+
+# (inode, size, mtime_ns) of an index file. Index files are replaced, never
+# rewritten in place, so a new generation always changes the signature.
+Signature = tuple[int, int, int]
+
+
+class Page(NamedTuple):
+    body: bytes
+    etag: str
+
+
+class ListedPackage(NamedTuple):
+    # Only what a listing shows is kept of a repodata record, so that cached
+    # listings of large subdirs stay small
+    fn: str
+    size: int | None
+    timestamp: int | None
+    sha256: str
+
+
+class _CachedFile:
+    def __init__(self, signature: Signature, digest: str, data: Any) -> None:
+        self.signature = signature
+        self.digest = digest
+        self.data = data
+        # Rendered listing pages by page number
+        self.pages: dict[int, Page] = {}
+
+
+class ListingCache:
+    """
+    In-memory cache of the pages rendered from the index files of channels:
+    the HTML listings of subdirs, `page_size` packages per page, and the RSS
+    feeds of channels. Entries are keyed on the signature of the index file
+    they come from, so a request never gets a page older than the published
+    index, and each page has an ETag for conditional requests. The index files
+    of cached pages are read again after each index generation, so that the
+    first request after it doesn't wait for the index to be read. At most
+    `max_entries` index files are cached.
+    """
+
+    def __init__(self, page_size=500, max_entries=256) -> None:
+        self._page_size = page_size
+        self._max_entries = max_entries
+        self._entries: OrderedDict[str, _CachedFile] = OrderedDict()
+        self._tasks: set[asyncio.Task[None]] = set()
+
+    @property
+    def page_size(self) -> int:
+        return self._page_size
+
+    def attach(self, channel: Channel) -> None:
+        """Refresh the cached pages of a channel after each index generation."""
+        channel.index_manager.add_generation_listener(
+            lambda subdirs: self.schedule(channel.directory)
+        )
+
+    def schedule(self, channel_dir: str) -> None:
+        task = asyncio.create_task(self.refresh(channel_dir))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def refresh(self, channel_dir: str) -> None:
+        # Reading and parsing the index files is the expensive part; pages
+        # are rendered on request
+        prefix = os.path.join(channel_dir, "")
+        for path in [path for path in self._entries if path.startswith(prefix)]:
+            await self._load(
+                path, _read_packages if path.endswith("repodata.json") else None
+            )
+
+    async def listing(
+        self, channel_dir: str, subdir: str, page: int, title: str | None = None
+    ) -> Page | None:
+        """
+        A page of the HTML listing of a subdir, or None if the subdir has no
+        index or the page is past the last one.
+        """
+        cached = await self._load(
+            os.path.join(channel_dir, subdir, "repodata.json"), _read_packages
+        )
+        if cached is None:
+            return None
+        pages = max(1, math.ceil(len(cached.data) / self._page_size))
+        if page > pages:
+            return None
+        if (rendered := cached.pages.get(page)) is None:
+            start = (page - 1) * self._page_size
+            body = render_listing(
+                title or subdir,
+                cached.data[start : start + self._page_size],
+                page,
+                pages,
+                len(cached.data),
+            )
+            rendered = Page(body.encode(), f'"{cached.digest}-{page}"')
+            cached.pages[page] = rendered
+        return rendered
+
+    async def feed(self, channel_dir: str) -> Page | None:
+        """The RSS feed of a channel, or None if it has none."""
+        cached = await self._load(os.path.join(channel_dir, "rss.xml"), None)
+        if cached is None:
+            return None
+        return Page(cached.data, f'"{cached.digest}"')
+
+    async def _load(
+        self, path: str, parse: Callable[[bytes], Any] | None
+    ) -> _CachedFile | None:
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            self._entries.pop(path, None)
+            return None
+        signature = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        cached = self._entries.get(path)
+        if cached is None or cached.signature != signature:
+            try:
+                cached = await run_in_threadpool(_read_file, path, parse)
+            except FileNotFoundError:
+                return None
+            self._entries[path] = cached
+        self._entries.move_to_end(path)
+        while len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
+        return cached
+
+    async def __aenter__(self) -> "ListingCache":
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback) -> None:
+        for task in self._tasks:
+            task.cancel()
+
+
+def _read_file(path: str, parse: Callable[[bytes], Any] | None) -> _CachedFile:
+    # The signature is taken from the open file, so that it matches the
+    # content even if the file is replaced while it is read
+    with open(path, "rb") as f:
+        stat = os.fstat(f.fileno())
+        content = f.read()
+    return _CachedFile(
+        (stat.st_ino, stat.st_size, stat.st_mtime_ns),
+        hashlib.sha256(content).hexdigest()[:32],
+        parse(content) if parse is not None else content,
+    )
+
+
+def _read_packages(content: bytes) -> list[ListedPackage]:
+    repodata = json.loads(content)
+    packages = [
+        ListedPackage(
+            fn, record.get("size"), record.get("timestamp"), record.get("sha256", "")
+        )
+        for section in ("packages", "packages.conda")
+        for fn, record in repodata.get(section, {}).items()
+    ]
+    packages.sort()
+    return packages
+
+
+def render_listing(
+    title: str, packages: list[ListedPackage], page: int, pages: int, total: int
+) -> str:
+    rows = "\n".join(
+        "<tr>"
+        f'<td><a href="{html.escape(package.fn)}">{html.escape(package.fn)}</a></td>'
+        f"<td>{html.escape(_format_size(package.size))}</td>"
+        f"<td>{html.escape(_format_timestamp(package.timestamp))}</td>"
+        f"<td><code>{html.escape(package.sha256)}</code></td>"
+        "</tr>"
+        for package in packages
+    )
+    links = []
+    if page > 1:
+        links.append('<a href="?page=1">first</a>')
+        links.append(f'<a href="?page={page - 1}">previous</a>')
+    if page < pages:
+        links.append(f'<a href="?page={page + 1}">next</a>')
+        links.append(f'<a href="?page={pages}">last</a>')
+    title = html.escape(title)
+    return f"""<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>{title}</title>
+</head>
+<body>
+<h1>{title}</h1>
+<p>{total} packages, page {page} of {pages}</p>
+<table>
+<tr><th>Filename</th><th>Size</th><th>Last modified</th><th>SHA256</th></tr>
+{rows}
+</table>
+<p>{" ".join(links)}</p>
+</body>
+</html>
+"""
+
+
+def _format_size(size: float | None) -> str:
+    if size is None:
+        return ""
+    if size < 1024:
+        return f"{size:.0f} B"
+    for unit in ("KB", "MB", "GB"):
+        size /= 1024
+        if size < 1024:
+            break
+    return f"{size:.1f} {unit}"
+
+
+def _format_timestamp(timestamp: int | None) -> str:
+    # conda timestamps are in milliseconds
+    if not timestamp:
+        return ""
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(timestamp / 1000))
@@ -1,27 +1,99 @@
 import asyncio
+import functools
+import json
 import logging
 import os
-import shutil
+import sqlite3
+import tarfile
 from contextlib import asynccontextmanager, suppress
+from typing import AsyncIterator
 
-from fastapi import FastAPI, File, HTTPException, Path, Security, UploadFile
+import httpx
+from fastapi import (
+    BackgroundTasks,
+    Depends,
+    FastAPI,
+    File,
+    Header,
+    HTTPException,
+    Path,
+    Query,
+    Request,
+    Response,
+    Security,
+    UploadFile,
+)
 from fastapi.concurrency import run_in_threadpool
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, StreamingResponse
 from fastapi.security.api_key import APIKeyHeader
 from prometheus_fastapi_instrumentator import Instrumentator
+from pydantic import BaseModel
+from starlette.types import Receive, Scope, Send
+from watchfiles import Change
 
-from .atomic import atomic_write
+from .auth import Access, APIKey, Authenticator
+from .batch import commit_batch, delete_batch, stage_tar_stream
+from .blobs import BlobStore, StagedBlob
+from .channels import Channel, ChannelRegistry
+from .convertors import register_convertors
+from .downloads import BUCKET_SECONDS, DownloadCounter, GroupBy
+from .events import EventHub
 from .hash import md5_in_chunks, sha256_in_chunks
-from .index import IndexManager
-from .utils import get_channel_dir, get_platforms
-from .validation import PLATFORM_REGEX, validate_package_name
-
-# TODO: add custom metrics for package downloads
-# TODO: validate uploaded file is a valid conda package - at least validate platform
-# TODO: implement authentication - should be configurable for both download and upload
+from .listings import ListingCache, Page
+from .mirror import Upstream
+from .packages import PackageError, check_index_json, inspect_package
+from .ratelimit import (
+    RateLimiter,
+    RateLimitMiddleware,
+    SQLiteBackend,
+    ThrottledFileResponse,
+    scope_client,
+)
+from .replication import ChangeLog, Follower
+from .retention import RetentionPolicy, plan_retention
+from .snapshot import (
+    ChannelSnapshot,
+    SnapshotConflict,
+    commit_snapshot,
+    pin_snapshot,
+    release_stale_snapshots,
+    stage_snapshot,
+)
+from .streams import iter_file, open_async_iterator
+from .uploads import UploadLimiter, UploadLimitMiddleware, UploadTooLarge
+from .utils import (
+    get_api_keys_file,
+    get_auth_download,
+    get_auth_upload,
+    get_blob_dir,
+    get_channel_dir,
+    get_downloads_db,
+    get_downloads_flush_interval,
+    get_downloads_flush_threshold,
+    get_event_buffer_size,
+    get_event_keepalive,
+    get_listing_page_size,
+    get_max_concurrent_uploads,
+    get_max_upload_bytes_in_flight,
+    get_max_upload_size,
+    get_platforms,
+    get_rate_limit_bandwidth,
+    get_rate_limit_bandwidth_burst,
+    get_rate_limit_db,
+    get_rate_limit_request_burst,
+    get_rate_limit_requests,
+    get_replicate_from,
+    get_replication_api_key,
+    get_replication_db,
+    get_replication_log_size,
+    get_replication_state_file,
+    get_replication_wait,
+    get_warmup_bytes,
+    get_warmup_rate,
+)
+from .validation import SHA256_REGEX, PackageFilename, parse_package_filename
+from .warmup import CacheWarmer
 
-# TODO: implement rate limiting - should be configurable
-# TODO: add configurable file size limit
 # TODO: implement search endpoints
 # TODO: abstract away the file system to make it easier to implement other backing stores - look into fuse and alternatives
 # TODO: implement s3 backing store
@@ -31,8 +103,8 @@ from .validation import PLATFORM_REGEX, validate_package_name
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 
-API_KEY = os.getenv("CONDA_SERVER_API_KEY", "default")
 API_KEY_NAME = "X-API-Key"
+TAR_MEDIA_TYPES = {"application/x-tar", "application/x-bzip2", "application/gzip"}
 
 
 # TODO: clean up lock files and tmp files on startup
@@ -51,119 +123,785 @@ async def lifespan(app: FastAPI):
     # Expose prometheus metrics endpoint
     instrumentator.expose(app)
 
-    # Start watching the channel directory for changes
-    with index_manager:
-        yield
+    # Pins of snapshots that a crashed process was streaming keep their blobs
+    # from being collected
+    await run_in_threadpool(release_stale_snapshots, blob_store)
+
+    # Start watching the channel directories for changes, flushing the
+    # download counts, warming the page cache and replicating
+    async with cache_warmer, listing_cache, channel_registry, download_counter:
+        async with event_hub, replication:
+            yield
 
 
+register_convertors()
 app = FastAPI(
     lifespan=lifespan,  # type: ignore
 )
 loop = asyncio.get_event_loop()
-index_manager = IndexManager()
+blob_store = BlobStore(get_blob_dir())
+download_counter = DownloadCounter(
+    get_downloads_db(),
+    flush_interval=get_downloads_flush_interval(),
+    flush_threshold=get_downloads_flush_threshold(),
+)
+cache_warmer = CacheWarmer(
+    download_counter, budget=get_warmup_bytes(), rate=get_warmup_rate()
+)
+listing_cache = ListingCache(page_size=get_listing_page_size())
+event_hub = EventHub(capacity=get_event_buffer_size())
+
+
+def attach_channel(channel: Channel) -> None:
+    cache_warmer.attach(channel)
+    listing_cache.attach(channel)
+    event_hub.attach(channel)
+    if change_log is not None:
+        change_log.attach(channel)
+
+
+# A node either leads, indexing its channels and logging each generation, or
+# follows a leader, serving the channels it replicates without indexing them
+channel_registry = ChannelRegistry(
+    on_open=attach_channel, replica=get_replicate_from() is not None
+)
+change_log: ChangeLog | None = None
+follower: Follower | None = None
+if leader_url := get_replicate_from():
+    follower = Follower(
+        Upstream(
+            leader_url,
+            client=httpx.AsyncClient(
+                headers=(
+                    {API_KEY_NAME: api_key}
+                    if (api_key := get_replication_api_key())
+                    else None
+                ),
+                timeout=httpx.Timeout(30.0, read=get_replication_wait() + 300.0),
+            ),
+        ),
+        channel_registry,
+        blob_store,
+        get_replication_state_file(),
+        wait=get_replication_wait(),
+    )
+else:
+    change_log = ChangeLog(get_replication_db(), max_entries=get_replication_log_size())
+replication = follower or change_log
+rate_limiter = RateLimiter(
+    requests_per_second=get_rate_limit_requests(),
+    request_burst=get_rate_limit_request_burst(),
+    bytes_per_second=get_rate_limit_bandwidth(),
+    bytes_burst=get_rate_limit_bandwidth_burst(),
+    backend=SQLiteBackend(db) if (db := get_rate_limit_db()) else None,
+)
+authenticator = Authenticator(
+    get_api_keys_file(),
+    require_download=get_auth_download(),
+    require_upload=get_auth_upload(),
+)
+app.add_middleware(
+    RateLimitMiddleware, rate_limiter=rate_limiter, identify_key=authenticator.identify
+)
+upload_limiter = UploadLimiter(
+    max_concurrent=get_max_concurrent_uploads(),
+    max_bytes=get_max_upload_bytes_in_flight(),
+)
+app.add_middleware(UploadLimitMiddleware, upload_limiter=upload_limiter)
 instrumentator = Instrumentator().instrument(app)
+api_key_header = APIKeyHeader(name=API_KEY_NAME, auto_error=False)
 
 
-def get_api_key(
-    api_key_header: str = Security(APIKeyHeader(name=API_KEY_NAME)),
-):
-    if api_key_header == API_KEY:
-        return api_key_header
-    raise HTTPException(status_code=400, detail="API Key was not provided")
+async def authorize(
+    api_key: str | None,
+    access: Access,
+    channel: str | None,
+    subdir: str | None,
+    any_scope=False,
+) -> APIKey | None:
+    if not authenticator.requires(access):
+        return None
+    if not api_key:
+        raise HTTPException(status_code=401, detail="API key was not provided")
+    key = await authenticator.authenticate(api_key)
+    if key is None:
+        raise HTTPException(status_code=401, detail="Invalid API key")
+    if not (
+        key.has_access(access) if any_scope else key.allows(access, channel, subdir)
+    ):
+        raise HTTPException(status_code=403, detail="API key is not allowed access")
+    return key
 
 
+async def authorize_download(
+    request: Request, api_key: str | None = Security(api_key_header)
+) -> APIKey | None:
+    return await authorize(
+        api_key,
+        "download",
+        request.path_params.get("channel"),
+        request.path_params.get("platform"),
+    )
+
+
+async def authorize_upload(
+    request: Request, api_key: str | None = Security(api_key_header)
+) -> APIKey | None:
+    return await authorize(
+        api_key,
+        "upload",
+        request.path_params.get("channel"),
+        request.path_params.get("platform"),
+    )
+
+
+async def authorize_replication(
+    api_key: str | None = Security(api_key_header),
+) -> APIKey | None:
+    # Followers replicate every channel, so they need access to all of them
+    return await authorize(api_key, "download", "*", None)
+
+
+async def authorize_blob_check(
+    api_key: str | None = Security(api_key_header),
+) -> APIKey | None:
+    # Blobs are shared by all channels, so any key that can upload may check them
+    return await authorize(api_key, "upload", None, None, any_scope=True)
+
+
+async def get_channel(request: Request) -> AsyncIterator[Channel]:
+    # Routes without a channel segment serve the default channel
+    name = request.path_params.get("channel")
+    try:
+        channel_registry.get(name)
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=404, detail="Channel not found") from e
+
+    async with channel_registry.use(name) as channel:
+        yield channel
+
+
+def validate_package_name(filename: str) -> PackageFilename:
+    try:
+        return parse_package_filename(filename)
+    except ValueError:
+        raise HTTPException(
+            status_code=400, detail="Invalid package file name format"
+        ) from None
+
+
+def ensure_writable(channel: Channel) -> None:
+    if channel.is_mirror:
+        raise HTTPException(status_code=403, detail="Channel is a read-only mirror")
+    if channel.is_replica:
+        raise HTTPException(status_code=403, detail="Channel is a read-only replica")
+
+
+async def refresh_mirror(channel: Channel, path: str) -> None:
+    # Mirrored channels revalidate their index files with the upstream
+    if channel.mirror is None:
+        return
+    try:
+        await channel.mirror.refresh(path)
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=404, detail="File not found") from e
+    except httpx.HTTPError as e:
+        raise HTTPException(
+            status_code=502, detail=f"Error fetching from upstream: {str(e)}"
+        ) from e
+
+
+@app.post("/{channel:channel}/build-index")
 @app.post("/build-index")
 async def build_index(
-    # api_key: APIKeyHeader = Depends(get_api_key),
+    api_key: APIKey | None = Depends(authorize_upload),
+    channel: Channel = Depends(get_channel),
 ):
-    await index_manager.generate_index()
+    ensure_writable(channel)
+    await channel.index_manager.generate_index()
     return {"message": "Index built successfully"}
 
 
-@app.get("/{platform}/{package_file}")
+@app.get("/{channel:channel}/{platform:platform}/{package_file:package}")
+@app.get("/{platform:platform}/{package_file:package}")
 async def fetch_package(
+    request: Request,
     package_file: str,
-    platform: str = Path(pattern=PLATFORM_REGEX),
+    platform: str,
+    api_key: APIKey | None = Depends(authorize_download),
+    channel: Channel = Depends(get_channel),
 ):
     # Validate the package file name
-    _, _, _, file_extension = validate_package_name(package_file)
-    file_path = os.path.join(get_channel_dir(), platform, package_file)
+    file_extension = validate_package_name(package_file).file_extension
+    file_path = os.path.join(channel.directory, platform, package_file)
     media_type = (
         "application/x-tar"
         if file_extension == "tar.bz2"
         else "application/octet-stream"
     )
 
+    # On a miss, mirrored channels fetch the package from their upstream
+    if not os.path.isfile(file_path):
+        if channel.mirror is None:
+            raise HTTPException(status_code=404, detail="File not found")
+        try:
+            response = await channel.mirror.fetch_package(
+                f"{platform}/{package_file}", media_type, package_file
+            )
+            download_counter.record(channel.name, platform, package_file)
+            return limit_bandwidth(request, response)
+        except FileNotFoundError as e:
+            raise HTTPException(status_code=404, detail="File not found") from e
+        except httpx.HTTPError as e:
+            raise HTTPException(
+                status_code=502, detail=f"Error fetching from upstream: {str(e)}"
+            ) from e
+
     try:
         # Return the file as a response
-        return FileResponse(
+        response = FileResponse(
             path=file_path, media_type=media_type, filename=package_file
         )
     except FileNotFoundError as e:
         raise HTTPException(status_code=404, detail="File not found") from e
+    download_counter.record(channel.name, platform, package_file)
+    return limit_bandwidth(request, response)
+
 
+def limit_bandwidth(
+    request: Request, response: FileResponse | StreamingResponse
+) -> FileResponse | StreamingResponse:
+    if not rate_limiter.limits_bandwidth:
+        return response
+    client = scope_client(request.scope, authenticator.identify)
 
-@app.put("/{platform}/{package_file}")
+    if isinstance(response, FileResponse):
+        return ThrottledFileResponse(response, rate_limiter, client)
+    response.body_iterator = rate_limiter.throttle(client, response.body_iterator)
+    return response
+
+
+@app.put("/{channel:channel}/{platform:platform}/{package_file:package}")
+@app.put("/{platform:platform}/{package_file:package}")
 async def upload_package(
+    request: Request,
     package_file: str,
-    platform: str = Path(pattern=PLATFORM_REGEX),
-    file: UploadFile = File(...),
-    # api_key: APIKeyHeader = Depends(get_api_key),
+    platform: str,
+    api_key: APIKey | None = Depends(authorize_upload),
+    channel: Channel = Depends(get_channel),
+    file: UploadFile | None = File(None),
+    sha256: str | None = Header(None, alias="X-Content-Sha256", pattern=SHA256_REGEX),
 ):
     # Validate the package file name
     validate_package_name(package_file)
-    file_path = os.path.join(get_channel_dir(), platform, package_file)
+    file_path = os.path.join(channel.directory, platform, package_file)
+    ensure_writable(channel)
 
     # Make sure the directory exists before we start writing files to it
-    os.makedirs(os.path.join(get_channel_dir(), platform), exist_ok=True)
+    os.makedirs(os.path.join(channel.directory, platform), exist_ok=True)
 
-    def save_uploaded_file():
-        # Open a file and write the uploaded content to it
-        with atomic_write(file_path, mode="wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
+    # A raw request body is written to the blob store as it streams in,
+    # without being spooled to a temporary file first
+    if file is None and has_body(request):
+        upload = open_async_iterator(request.stream())
+    elif file is not None:
+        upload = file.file
+    # Without a file, the upload can only be satisfied by linking a blob that
+    # the server already has
+    else:
+        if sha256 is None:
+            raise HTTPException(status_code=400, detail="File was not provided")
+        try:
+            await run_in_threadpool(
+                link_package_blob, sha256, file_path, package_file, platform
+            )
+            await run_in_threadpool(add_repodata_records, channel, {file_path: sha256})
+        except FileNotFoundError as e:
+            raise HTTPException(status_code=404, detail="Blob not found") from e
+        except PackageError as e:
+            raise HTTPException(status_code=400, detail=str(e)) from e
+        return {"message": "Package linked successfully", "sha256": sha256}
+
+    def save_uploaded_file() -> str:
+        # Store the uploaded content in the blob store and link it into the subdir.
+        # The package is validated while it is written.
+        digest = blob_store.store(
+            upload,
+            file_path,
+            expected_digest=sha256,
+            inspect=functools.partial(
+                inspect_package, filename=package_file, platform=platform
+            ),
+        )
+        add_repodata_records(channel, {file_path: digest})
+        return digest
 
     try:
-        await run_in_threadpool(save_uploaded_file)
-        return {"message": "Package uploaded successfully"}
+        digest = await run_in_threadpool(save_uploaded_file)
+        return {"message": "Package uploaded successfully", "sha256": digest}
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e)) from e
     except Exception as e:
         raise HTTPException(
             status_code=500, detail=f"Error writing to file: {str(e)}"
         ) from e
     finally:
         # Always close the file, even if an error occurs
-        file.file.close()
+        upload.close()
+
+
+def has_body(request: Request) -> bool:
+    return (
+        request.headers.get("Content-Length", "0") != "0"
+        or "Transfer-Encoding" in request.headers
+    )
+
+
+def link_package_blob(digest: str, path: str, package_file: str, platform: str):
+    # Blobs stored before packages were validated have no metadata yet
+    if (metadata := blob_store.read_metadata(digest)) is not None:
+        check_index_json(metadata, package_file, platform)
+    else:
+        with open(blob_store.blob_path(digest), "rb") as f:
+            inspect_package(f, package_file, platform)
+    blob_store.link(digest, path)
+
+
+def add_repodata_records(channel: Channel, digests: dict[str, str]) -> None:
+    # Record the repodata of uploaded packages from the metadata extracted while
+    # they were written, so that indexing doesn't have to read them again
+    try:
+        for path, digest in digests.items():
+            if (metadata := blob_store.read_metadata(digest)) is not None:
+                channel.index_manager.repodata.add(path, metadata)
+    except sqlite3.Error:
+        logger.exception("Error recording repodata, deferring to indexing")
 
 
-@app.delete("/{platform}/{package_file}")
+@app.delete("/{channel:channel}/{platform:platform}/{package_file:package}")
+@app.delete("/{platform:platform}/{package_file:package}")
 async def delete_package(
     package_file: str,
-    platform: str = Path(pattern=PLATFORM_REGEX),
-    # api_key: APIKeyHeader = Depends(get_api_key),
+    platform: str,
+    api_key: APIKey | None = Depends(authorize_upload),
+    channel: Channel = Depends(get_channel),
 ):
     # Validate the package file name
     validate_package_name(package_file)
-    file_path = os.path.join(get_channel_dir(), platform, package_file)
+    file_path = os.path.join(channel.directory, platform, package_file)
+    ensure_writable(channel)
 
     # Check if file exists
     if not os.path.isfile(file_path):
         raise HTTPException(status_code=404, detail="File not found")
 
-    # Remove the file
-    os.remove(file_path)
+    # Remove the file and release its blob
+    await run_in_threadpool(blob_store.release, file_path)
     with suppress(FileNotFoundError):
         os.remove(f"{file_path}.lock")
 
     return {"message": "Package deleted successfully"}
 
 
-@app.get("/{platform}/{package_file}/hash/sha256")
+@app.post("/{channel:channel}/{platform:platform}/batch")
+@app.post("/{platform:platform}/batch")
+async def upload_packages(
+    request: Request,
+    platform: str,
+    background_tasks: BackgroundTasks,
+    api_key: APIKey | None = Depends(authorize_upload),
+    channel: Channel = Depends(get_channel),
+    files: list[UploadFile] | None = File(None),
+):
+    ensure_writable(channel)
+    platform_dir = os.path.join(channel.directory, platform)
+    os.makedirs(platform_dir, exist_ok=True)
+
+    try:
+        # Packages are either uploaded as multipart files or as a tar stream
+        if files:
+            staged_blobs = await stage_uploaded_files(files, platform)
+        elif request.headers.get("Content-Type") in TAR_MEDIA_TYPES:
+            staged_blobs = await run_in_threadpool(
+                stage_tar_stream,
+                blob_store,
+                open_async_iterator(request.stream()),
+                parse_package_filename,
+                functools.partial(inspect_package, platform=platform),
+                max_size=get_max_upload_size(platform),
+            )
+        else:
+            raise HTTPException(status_code=400, detail="Files were not provided")
+    except UploadTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e)) from e
+    except (tarfile.TarError, ValueError) as e:
+        raise HTTPException(status_code=400, detail=str(e)) from e
+    finally:
+        for file in files or []:
+            file.file.close()
+
+    # Commit all packages or none, then index the whole batch once
+    paths = {
+        os.path.join(platform_dir, filename): staged_blob
+        for filename, staged_blob in staged_blobs.items()
+    }
+    channel.index_manager.ignore_changes(paths)
+    try:
+        await run_in_threadpool(commit_batch, blob_store, paths)
+    except Exception as e:
+        raise HTTPException(
+            status_code=500, detail=f"Error writing to file: {str(e)}"
+        ) from e
+    await run_in_threadpool(
+        add_repodata_records,
+        channel,
+        {path: staged_blob.digest for path, staged_blob in paths.items()},
+    )
+    background_tasks.add_task(
+        channel.index_manager.generate_index,
+        {(Change.added, path) for path in paths},
+    )
+
+    return {
+        "message": "Packages uploaded successfully",
+        "packages": {
+            filename: {"sha256": staged_blob.digest, "size": staged_blob.size}
+            for filename, staged_blob in staged_blobs.items()
+        },
+    }
+
+
+async def stage_uploaded_files(
+    files: list[UploadFile], platform: str
+) -> dict[str, StagedBlob]:
+    # Validate every package file name before writing anything
+    filenames = [file.filename or "" for file in files]
+    for filename in filenames:
+        validate_package_name(filename)
+    if len(set(filenames)) != len(filenames):
+        raise HTTPException(status_code=400, detail="Duplicate package files")
+    max_size = get_max_upload_size(platform)
+    if max_size is not None and any((file.size or 0) > max_size for file in files):
+        raise UploadTooLarge(max_size)
+
+    # Write the files to the blob store in parallel, validating them as they
+    # are written
+    results = await asyncio.gather(
+        *(
+            run_in_threadpool(
+                blob_store.stage,
+                file.file,
+                inspect=functools.partial(
+                    inspect_package, filename=filename, platform=platform
+                ),
+            )
+            for file, filename in zip(files, filenames)
+        ),
+        return_exceptions=True,
+    )
+    staged_blobs = [result for result in results if isinstance(result, StagedBlob)]
+    for result in results:
+        if isinstance(result, BaseException):
+            for staged_blob in staged_blobs:
+                blob_store.discard(staged_blob)
+            raise result
+    return dict(zip(filenames, staged_blobs))
+
+
+class PackageFiles(BaseModel):
+    files: list[str]
+
+
+@app.post("/{channel:channel}/{platform:platform}/batch/delete")
+@app.post("/{platform:platform}/batch/delete")
+async def delete_packages(
+    package_files: PackageFiles,
+    platform: str,
+    background_tasks: BackgroundTasks,
+    api_key: APIKey | None = Depends(authorize_upload),
+    channel: Channel = Depends(get_channel),
+):
+    ensure_writable(channel)
+
+    # Validate the package file names
+    for package_file in package_files.files:
+        validate_package_name(package_file)
+    paths = [
+        os.path.join(channel.directory, platform, package_file)
+        for package_file in dict.fromkeys(package_files.files)
+    ]
+
+    # Check if all files exist before deleting any of them
+    if missing := [os.path.basename(p) for p in paths if not os.path.isfile(p)]:
+        raise HTTPException(
+            status_code=404, detail=f"Files not found: {', '.join(missing)}"
+        )
+
+    # Delete all packages or none, then index the whole batch once
+    channel.index_manager.ignore_changes(paths)
+    await run_in_threadpool(delete_batch, blob_store, paths)
+    background_tasks.add_task(
+        channel.index_manager.generate_index,
+        {(Change.deleted, path) for path in paths},
+    )
+
+    return {"message": "Packages deleted successfully"}
+
+
+@app.post("/{channel:channel}/retention")
+@app.post("/retention")
+async def apply_retention(
+    policy: RetentionPolicy,
+    background_tasks: BackgroundTasks,
+    dry_run: bool = True,
+    api_key: APIKey | None = Depends(authorize_upload),
+    channel: Channel = Depends(get_channel),
+):
+    ensure_writable(channel)
+    report = await run_in_threadpool(
+        plan_retention,
+        channel.directory,
+        policy,
+        repodata=channel.index_manager.repodata,
+    )
+
+    # Delete the packages in one batch and index the affected subdirs once
+    if not dry_run and report.paths:
+        channel.index_manager.ignore_changes(report.paths)
+        await run_in_threadpool(delete_batch, blob_store, report.paths)
+        background_tasks.add_task(
+            channel.index_manager.generate_index,
+            {(Change.deleted, path) for path in report.paths},
+        )
+
+    return {
+        "dry_run": dry_run,
+        "packages": [os.path.relpath(path, channel.directory) for path in report.paths],
+        "bytes_saved": report.bytes_saved,
+        "index_entries_saved": report.index_entries_saved,
+    }
+
+
+@app.get("/{channel:channel}/downloads")
+@app.get("/downloads")
+async def get_downloads(
+    group_by: GroupBy = "package",
+    subdir: str | None = None,
+    package: str | None = None,
+    since: float | None = None,
+    until: float | None = None,
+    bucket_seconds: int = Query(BUCKET_SECONDS, ge=BUCKET_SECONDS),
+    api_key: APIKey | None = Depends(authorize_download),
+    channel: Channel = Depends(get_channel),
+):
+    # Include the counts of this worker that haven't been flushed yet
+    await download_counter.flush()
+    rows = await run_in_threadpool(
+        download_counter.query,
+        channel.name,
+        group_by=group_by,
+        subdir=subdir,
+        package=package,
+        since=since,
+        until=until,
+        bucket_seconds=bucket_seconds,
+    )
+    return {
+        "downloads": [{group_by: key, "count": count} for key, count in rows],
+        "total": sum(count for _, count in rows),
+    }
+
+
+@app.get("/{channel:channel}/events")
+@app.get("/events")
+async def stream_events(
+    since: str | None = None,
+    last_event_id: str | None = Header(None),
+    api_key: APIKey | None = Depends(authorize_download),
+    channel: Channel = Depends(get_channel),
+):
+    # Server-sent events, resumed from the token of the last event a client
+    # saw, which browsers send as Last-Event-ID when they reconnect
+    events = event_hub.subscribe(
+        channel.name, since or last_event_id, keepalive=get_event_keepalive()
+    )
+
+    async def iter_events() -> AsyncIterator[bytes]:
+        async for event in events:
+            if event is None:
+                yield b": keepalive\n\n"
+                continue
+            yield (
+                f"id: {event_hub.token(event.id)}\n"
+                f"event: {event.data['type']}\n"
+                f"data: {json.dumps(event.data)}\n\n"
+            ).encode()
+
+    return StreamingResponse(
+        iter_events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.get("/{channel:channel}/snapshot")
+@app.get("/snapshot")
+async def export_snapshot(
+    request: Request,
+    api_key: APIKey | None = Depends(authorize_download),
+    channel: Channel = Depends(get_channel),
+):
+    if channel.is_mirror:
+        raise HTTPException(status_code=400, detail="Mirrors can't be exported")
+
+    # Pin the files of the last published generation, then stream them while
+    # indexing carries on
+    async with channel.index_manager.published():
+        snapshot = await run_in_threadpool(pin_snapshot, blob_store, channel.directory)
+    response = SnapshotResponse(snapshot, f"{channel.name or 'channel'}-snapshot.tar")
+    try:
+        return limit_bandwidth(request, response)
+    except BaseException:
+        await run_in_threadpool(snapshot.release)
+        raise
+
+
+class SnapshotResponse(StreamingResponse):
+    # Releases the pins of a snapshot once the response is done with, even if
+    # the client went away before its body was read
+    def __init__(self, snapshot: ChannelSnapshot, filename: str) -> None:
+        super().__init__(
+            iter_snapshot(snapshot),
+            media_type="application/x-tar",
+            headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+        )
+        self.snapshot = snapshot
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            await run_in_threadpool(self.snapshot.release)
+
+
+async def iter_snapshot(snapshot: ChannelSnapshot) -> AsyncIterator[bytes]:
+    for part in snapshot.parts():
+        if isinstance(part, bytes):
+            yield part
+        else:
+            async for chunk in iter_file(part[0], chunk_size=2**20):
+                yield chunk
+
+
+@app.put("/{channel:channel}/snapshot")
+@app.put("/snapshot")
+async def import_snapshot(
+    request: Request,
+    api_key: APIKey | None = Depends(authorize_upload),
+    channel: Channel = Depends(get_channel),
+):
+    ensure_writable(channel)
+    try:
+        staged = await run_in_threadpool(
+            stage_snapshot,
+            blob_store,
+            channel.directory,
+            open_async_iterator(request.stream()),
+        )
+    except (tarfile.TarError, ValueError) as e:
+        raise HTTPException(status_code=400, detail=str(e)) from e
+
+    # The snapshot brings its own index files, so the channel isn't indexed
+    channel.index_manager.ignore_changes(staged.packages)
+    try:
+        async with channel.index_manager.published():
+            await run_in_threadpool(
+                commit_snapshot, blob_store, channel.index_manager.repodata, staged
+            )
+            channel.index_manager.notify_published(None)
+    except SnapshotConflict as e:
+        raise HTTPException(status_code=409, detail=str(e)) from e
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e)) from e
+    except Exception as e:
+        raise HTTPException(
+            status_code=500, detail=f"Error writing to file: {str(e)}"
+        ) from e
+
+    return {
+        "message": "Snapshot imported successfully",
+        "packages": len(staged.packages),
+        "index_files": len(staged.index_files),
+    }
+
+
+@app.get("/replication/changes")
+async def get_replication_changes(
+    since: int = Query(0, ge=0),
+    wait: float = Query(0, ge=0, le=60),
+    limit: int = Query(1000, ge=1, le=10000),
+    api_key: APIKey | None = Depends(authorize_replication),
+):
+    if change_log is None:
+        raise HTTPException(status_code=404, detail="Node is not a leader")
+    # Long-poll, so that followers hear of changes as soon as they are logged
+    await change_log.wait(since, wait)
+    return await run_in_threadpool(change_log.read, since, limit)
+
+
+@app.get("/{channel:channel}/replication/index")
+@app.get("/replication/index")
+async def export_replication_index(
+    api_key: APIKey | None = Depends(authorize_replication),
+    channel: Channel = Depends(get_channel),
+):
+    if channel.is_mirror:
+        raise HTTPException(status_code=400, detail="Mirrors can't be replicated")
+
+    # A snapshot of the published index files, without the packages they
+    # list, which followers fetch by digest if they don't have them yet
+    async with channel.index_manager.published():
+        snapshot = await run_in_threadpool(
+            pin_snapshot, blob_store, channel.directory, include_packages=False
+        )
+    return SnapshotResponse(snapshot, f"{channel.name or 'channel'}-index.tar")
+
+
+@app.get("/blobs/sha256/{digest}")
+async def fetch_blob(
+    digest: str = Path(pattern=SHA256_REGEX),
+    api_key: APIKey | None = Depends(authorize_replication),
+):
+    # Followers fetch the packages they don't have yet by digest
+    if not blob_store.has(digest):
+        raise HTTPException(status_code=404, detail="Blob not found")
+    return FileResponse(
+        path=blob_store.blob_path(digest), media_type="application/octet-stream"
+    )
+
+
+@app.head("/blobs/sha256/{digest}")
+async def check_blob(
+    digest: str = Path(pattern=SHA256_REGEX),
+    api_key: APIKey | None = Depends(authorize_blob_check),
+):
+    # Let clients check whether an upload can skip transferring the file
+    if not blob_store.has(digest):
+        raise HTTPException(status_code=404, detail="Blob not found")
+    return Response(status_code=200)
+
+
+@app.get("/{channel:channel}/{platform:platform}/{package_file:package}/hash/sha256")
+@app.get("/{platform:platform}/{package_file:package}/hash/sha256")
 async def fetch_sha256(
     package_file: str,
-    platform: str = Path(pattern=PLATFORM_REGEX),
+    platform: str,
+    api_key: APIKey | None = Depends(authorize_download),
+    channel: Channel = Depends(get_channel),
 ):
     # Validate the package file name
     validate_package_name(package_file)
-    file_path = os.path.join(get_channel_dir(), platform, package_file)
+    file_path = os.path.join(channel.directory, platform, package_file)
 
     # Check if file exists
     if not os.path.isfile(file_path):
@@ -176,14 +914,17 @@ async def fetch_sha256(
     return {"sha256": sha256_hash}
 
 
-@app.get("/{platform}/{package_file}/hash/md5")
+@app.get("/{channel:channel}/{platform:platform}/{package_file:package}/hash/md5")
+@app.get("/{platform:platform}/{package_file:package}/hash/md5")
 async def fetch_md5(
     package_file: str,
-    platform: str = Path(pattern=PLATFORM_REGEX),
+    platform: str,
+    api_key: APIKey | None = Depends(authorize_download),
+    channel: Channel = Depends(get_channel),
 ):
     # Validate the package file name
     validate_package_name(package_file)
-    file_path = os.path.join(get_channel_dir(), platform, package_file)
+    file_path = os.path.join(channel.directory, platform, package_file)
 
     # Check if file exists
     if not os.path.isfile(file_path):
@@ -196,8 +937,46 @@ async def fetch_md5(
     return {"md5": md5_hash}
 
 
-@app.get("/{platform}/{filename}")
-async def fetch_repodata(filename: str, platform: str = Path(pattern=PLATFORM_REGEX)):
+@app.get("/{channel:channel}/{platform:platform}/")
+@app.get("/{channel:channel}/{platform:platform}/index.html")
+@app.get("/{platform:platform}/")
+@app.get("/{platform:platform}/index.html")
+async def fetch_subdir_listing(
+    platform: str,
+    page: int = Query(1, ge=1),
+    if_none_match: str | None = Header(None),
+    api_key: APIKey | None = Depends(authorize_download),
+    channel: Channel = Depends(get_channel),
+):
+    # The listing is rendered from repodata.json, a page at a time, instead of
+    # serving the full listing that conda-index writes
+    await refresh_mirror(channel, f"{platform}/repodata.json")
+    title = f"{channel.name}/{platform}" if channel.name else platform
+    listing = await listing_cache.listing(channel.directory, platform, page, title)
+    if listing is None:
+        raise HTTPException(status_code=404, detail="Page not found")
+    return cached_response(listing, "text/html; charset=utf-8", if_none_match)
+
+
+def cached_response(page: Page, media_type: str, if_none_match: str | None) -> Response:
+    # Clients revalidate with the ETag before using a cached copy
+    headers = {"ETag": page.etag, "Cache-Control": "no-cache"}
+    if if_none_match is not None and (
+        if_none_match.strip() == "*"
+        or page.etag in (etag.strip() for etag in if_none_match.split(","))
+    ):
+        return Response(status_code=304, headers=headers)
+    return Response(page.body, media_type=media_type, headers=headers)
+
+
+@app.get("/{channel:channel}/{platform:platform}/{filename}")
+@app.get("/{platform:platform}/{filename}")
+async def fetch_repodata(
+    filename: str,
+    platform: str,
+    api_key: APIKey | None = Depends(authorize_download),
+    channel: Channel = Depends(get_channel),
+):
     if not filename in {
         "current_repodata.json",
         "current_repodata.json.bz2",
@@ -215,7 +994,10 @@ async def fetch_repodata(filename: str, platform: str = Path(pattern=PLATFORM_RE
         raise HTTPException(status_code=404, detail="File not found")
 
     # Construct the filepath
-    file_path = os.path.join(get_channel_dir(), platform, filename)
+    file_path = os.path.join(channel.directory, platform, filename)
+    await refresh_mirror(channel, f"{platform}/{filename}")
+    if not os.path.isfile(file_path):
+        raise HTTPException(status_code=404, detail="File not found")
 
     try:
         # Return the file as a response
@@ -226,16 +1008,32 @@ async def fetch_repodata(filename: str, platform: str = Path(pattern=PLATFORM_RE
         raise HTTPException(status_code=404, detail="File not found") from e
 
 
+@app.get("/{channel:channel}/{filename}")
 @app.get("/{filename}")
-async def fetch_channeldata(filename: str):
+async def fetch_channeldata(
+    filename: str,
+    if_none_match: str | None = Header(None),
+    api_key: APIKey | None = Depends(authorize_download),
+    channel: Channel = Depends(get_channel),
+):
     if not filename in {
         "channeldata.json",
         "rss.xml",
     }:
         raise HTTPException(status_code=404, detail="File not found")
+    await refresh_mirror(channel, filename)
+
+    # Feed readers poll often, so the feed is served from memory
+    if filename == "rss.xml":
+        feed = await listing_cache.feed(channel.directory)
+        if feed is None:
+            raise HTTPException(status_code=404, detail="File not found")
+        return cached_response(feed, "application/rss+xml", if_none_match)
 
     # Construct the filepath
-    file_path = os.path.join(get_channel_dir(), "channeldata.json")
+    file_path = os.path.join(channel.directory, "channeldata.json")
+    if not os.path.isfile(file_path):
+        raise HTTPException(status_code=404, detail="File not found")
 
     try:
         # Return the file as a response
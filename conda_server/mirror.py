@@ -0,0 +1,334 @@
+import asyncio
+import functools
+import json
+import logging
+import os
+import queue
+import time
+from contextlib import asynccontextmanager, suppress
+from email.utils import formatdate
+from typing import AsyncIterator, Callable
+
+import httpx
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse, StreamingResponse
+
+from .atomic import atomic_write
+
+logger = logging.getLogger(__name__)
+
+
+class Upstream:
+    """
+    An upstream conda channel reachable over HTTP. The HTTP client can be
+    injected to point the mirror at a different transport, e.g. a local
+    stand-in in tests.
+    """
+
+    def __init__(self, url: str, client: httpx.AsyncClient | None = None) -> None:
+        self._url = url.rstrip("/")
+        self._client = client or httpx.AsyncClient(
+            timeout=httpx.Timeout(30.0, read=300.0), follow_redirects=True
+        )
+
+    @property
+    def url(self) -> str:
+        return self._url
+
+    @asynccontextmanager
+    async def stream(
+        self, path: str, headers: dict[str, str] | None = None
+    ) -> AsyncIterator[httpx.Response]:
+        async with self._client.stream(
+            "GET", f"{self._url}/{path}", headers=headers
+        ) as response:
+            yield response
+
+    async def aclose(self) -> None:
+        await self._client.aclose()
+
+
+# Chunks fetched but not written yet, before the fetch waits for the disk
+MAX_BUFFERED_CHUNKS = 64
+
+
+class _Download:
+    def __init__(self) -> None:
+        self.started: asyncio.Future[httpx.Headers] = (
+            asyncio.get_running_loop().create_future()
+        )
+        self.task: asyncio.Task[bool] | None = None
+        # The temporary file the download is written to and how many bytes of
+        # it are written, for requests that stream the download as it goes
+        self.temp_path: str | None = None
+        self.written = 0
+        self._progress = asyncio.Event()
+
+    def advance(self, temp_path: str, written: int) -> None:
+        self.temp_path, self.written = temp_path, written
+        self._progress.set()
+        self._progress = asyncio.Event()
+
+    async def progress(self, *others: asyncio.Future) -> None:
+        """Wait for more of the download to be written, or for `others`."""
+        waiter = asyncio.ensure_future(self._progress.wait())
+        try:
+            await asyncio.wait({waiter, *others}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            waiter.cancel()
+
+
+class Mirror:
+    """
+    Pull-through cache of an upstream channel. Files missing from the channel
+    directory are fetched from the upstream once and served locally afterwards.
+    Concurrent requests for the same file share a single upstream fetch, which
+    is written to disk at the upstream's pace: clients streaming it read what
+    was written so far, so a slow client never holds up the fetch.
+    """
+
+    def __init__(
+        self, upstream: Upstream, directory: str, ttl: float = 60.0, chunk_size=65536
+    ) -> None:
+        self._upstream = upstream
+        self._directory = directory
+        self._ttl = ttl
+        self._chunk_size = chunk_size
+        self._downloads: dict[str, _Download] = {}
+
+    @property
+    def upstream(self) -> Upstream:
+        return self._upstream
+
+    async def fetch_package(
+        self, path: str, media_type: str, filename: str
+    ) -> FileResponse | StreamingResponse:
+        """
+        Fetch a package from the upstream. The first request streams the bytes
+        from the upstream while they are written to the channel directory, later
+        requests wait for the write and serve the local file. Raises
+        `FileNotFoundError` if the upstream does not have the package.
+        """
+        local_path = os.path.join(self._directory, path)
+
+        if download := self._downloads.get(path):
+            await asyncio.shield(download.task)  # type: ignore
+            return FileResponse(
+                path=local_path, media_type=media_type, filename=filename
+            )
+
+        download = self._start_download(path)
+        upstream_headers = await asyncio.shield(download.started)
+
+        headers = {"Content-Disposition": f'attachment; filename="{filename}"'}
+        content_length = upstream_headers.get("Content-Length")
+        if content_length and "Content-Encoding" not in upstream_headers:
+            headers["Content-Length"] = content_length
+        return StreamingResponse(
+            self._stream(download, local_path), media_type=media_type, headers=headers
+        )
+
+    async def refresh(self, path: str) -> None:
+        """
+        Make sure the local copy of an index file is at most `ttl` seconds old.
+        Stale copies are revalidated with a conditional request. If the upstream
+        can't be reached, a stale local copy is kept. Raises `FileNotFoundError`
+        if there is no local copy and the upstream does not have the file.
+        """
+        local_path = os.path.join(self._directory, path)
+
+        if download := self._downloads.get(path):
+            await asyncio.shield(download.task)  # type: ignore
+            return
+
+        state = await run_in_threadpool(self._load_state, path)
+        has_local_copy = os.path.isfile(local_path)
+        if has_local_copy and time.time() - state.get("checked", 0) < self._ttl:
+            return
+
+        headers = {}
+        if has_local_copy:
+            if etag := state.get("etag"):
+                headers["If-None-Match"] = etag
+            headers["If-Modified-Since"] = state.get(
+                "last_modified", formatdate(os.path.getmtime(local_path), usegmt=True)
+            )
+
+        download = self._start_download(path, headers=headers)
+        try:
+            await asyncio.shield(download.task)  # type: ignore
+        except httpx.HTTPError as e:
+            if not has_local_copy:
+                raise
+            logger.warning("Serving stale %s, upstream failed: %s", path, e)
+            return
+
+        # A 304 response may omit the validators, so keep the previous ones
+        upstream_headers = download.started.result()
+        state["checked"] = time.time()
+        if etag := upstream_headers.get("ETag"):
+            state["etag"] = etag
+        if last_modified := upstream_headers.get("Last-Modified"):
+            state["last_modified"] = last_modified
+        await run_in_threadpool(self._save_state, path, state)
+
+    async def aclose(self) -> None:
+        for download in list(self._downloads.values()):
+            if download.task is not None:
+                download.task.cancel()
+        await self._upstream.aclose()
+
+    def _start_download(
+        self, path: str, headers: dict[str, str] | None = None
+    ) -> _Download:
+        download = _Download()
+        download.task = asyncio.create_task(self._download(path, download, headers))
+        download.task.add_done_callback(
+            functools.partial(self._on_download_done, download)
+        )
+        self._downloads[path] = download
+        return download
+
+    async def _download(
+        self, path: str, download: _Download, headers: dict[str, str] | None
+    ) -> bool:
+        local_path = os.path.join(self._directory, path)
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+
+        try:
+            async with self._upstream.stream(path, headers=headers) as response:
+                if response.status_code == 304:
+                    download.started.set_result(response.headers)
+                    return False
+                if response.status_code == 404:
+                    raise FileNotFoundError(f"{path} not found upstream")
+                response.raise_for_status()
+                download.started.set_result(response.headers)
+
+                logger.info("Fetching %s from %s", path, self._upstream.url)
+                loop = asyncio.get_running_loop()
+                chunks: queue.Queue[bytes | Exception | None] = queue.Queue()
+                writer = asyncio.ensure_future(
+                    run_in_threadpool(
+                        _write_chunks,
+                        local_path,
+                        chunks,
+                        lambda *progress: loop.call_soon_threadsafe(
+                            download.advance, *progress
+                        ),
+                    )
+                )
+                try:
+                    received = 0
+                    async for chunk in response.aiter_bytes(self._chunk_size):
+                        chunks.put(chunk)
+                        received += len(chunk)
+                        # Only the disk holds up the fetch, never the clients
+                        while (
+                            received - download.written
+                            > MAX_BUFFERED_CHUNKS * self._chunk_size
+                            and not writer.done()
+                        ):
+                            await download.progress(writer)
+                except BaseException:
+                    # Abort the write so that a partial file is never published
+                    chunks.put(IOError(f"Fetching {path} was interrupted"))
+                    with suppress(Exception):
+                        await asyncio.shield(writer)
+                    raise
+                chunks.put(None)
+                await writer
+                return True
+        except BaseException as e:
+            if not download.started.done():
+                download.started.set_exception(e)
+            raise
+        finally:
+            del self._downloads[path]
+
+    async def _stream(
+        self, download: _Download, local_path: str
+    ) -> AsyncIterator[bytes]:
+        # Reads the file the download is written to at the client's own pace
+        assert download.task is not None
+        fd = None
+        offset = 0
+        try:
+            while True:
+                if download.task.done():
+                    # Raise if the download failed, which truncates the response
+                    download.task.result()
+                if offset < download.written:
+                    if fd is None:
+                        fd = await run_in_threadpool(
+                            _open_download, download.temp_path, local_path
+                        )
+                    chunk = await run_in_threadpool(
+                        os.pread,
+                        fd,
+                        min(self._chunk_size, download.written - offset),
+                        offset,
+                    )
+                    if not chunk:
+                        raise IOError(f"{local_path} was truncated")
+                    offset += len(chunk)
+                    yield chunk
+                elif download.task.done():
+                    return
+                else:
+                    await download.progress(download.task)
+        finally:
+            if fd is not None:
+                os.close(fd)
+
+    def _on_download_done(self, download: _Download, task: asyncio.Task[bool]) -> None:
+        # Retrieve the exceptions so that they are not reported as unhandled;
+        # they are raised to the requests waiting for the download instead
+        if download.started.done() and not download.started.cancelled():
+            download.started.exception()
+        if not task.cancelled() and (e := task.exception()):
+            if not isinstance(e, FileNotFoundError):
+                logger.error("Fetching from %s failed: %s", self._upstream.url, e)
+
+    def _state_path(self, path: str) -> str:
+        return os.path.join(self._directory, ".mirror", f"{path}.json")
+
+    def _load_state(self, path: str) -> dict:
+        try:
+            with open(self._state_path(path), encoding="utf-8") as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def _save_state(self, path: str, state: dict) -> None:
+        state_path = self._state_path(path)
+        os.makedirs(os.path.dirname(state_path), exist_ok=True)
+        with atomic_write(state_path) as f:
+            json.dump(state, f)
+
+
+def _write_chunks(
+    path: str,
+    chunks: "queue.Queue[bytes | Exception | None]",
+    on_write: Callable[[str, int], None],
+) -> None:
+    # Runs in a single worker thread, because the lock taken by atomic_write
+    # must be released by the thread that acquired it
+    with atomic_write(path, mode="wb") as buffer:
+        written = 0
+        while (chunk := chunks.get()) is not None:
+            if isinstance(chunk, Exception):
+                raise chunk
+            buffer.write(chunk)
+            # Make the chunk visible to the requests reading the download
+            buffer.flush()
+            written += len(chunk)
+            on_write(buffer.name, written)
+
+
+def _open_download(temp_path: str | None, local_path: str) -> int:
+    # The temporary file is moved into place once the download is complete
+    if temp_path is not None:
+        with suppress(FileNotFoundError):
+            return os.open(temp_path, os.O_RDONLY)
+    return os.open(local_path, os.O_RDONLY)
@@ -0,0 +1,178 @@
+import io
+import json
+import struct
+import tarfile
+from typing import BinaryIO, Iterator
+
+import zstandard
+
+from .validation import parse_package_filename
+
+ZIP_LOCAL_FILE_SIGNATURE = b"PK\x03\x04"
+ZIP_LOCAL_FILE_HEADER = struct.Struct("<HHHHHIIIHH")
+ZIP64_EXTRA_FIELD_ID = 0x0001
+
+
+class PackageError(ValueError):
+    pass
+
+
+def inspect_package(fileobj: BinaryIO, filename: str, platform: str) -> dict:
+    """
+    Read `info/index.json` from the stream of a conda package and check that it
+    matches the file name and the platform the package is uploaded to. The
+    stream is read front to back and only as far as needed, so it can be the
+    stream that writes the upload. Raises `PackageError` if the package is
+    invalid.
+    """
+    index_json = read_index_json(fileobj, filename)
+    check_index_json(index_json, filename, platform)
+    return index_json
+
+
+def read_index_json(fileobj: BinaryIO, filename: str) -> dict:
+    """
+    Read `info/index.json` from the stream of a conda package without checking
+    it. Raises `PackageError` if the package is invalid.
+    """
+    try:
+        if filename.endswith(".tar.bz2"):
+            with tarfile.open(fileobj=fileobj, mode="r|bz2") as tar:
+                return _read_index_json(tar)
+        if filename.endswith(".conda"):
+            return _read_conda_index_json(fileobj)
+    except (tarfile.TarError, zstandard.ZstdError, EOFError, OSError) as e:
+        raise PackageError(f"Invalid package archive: {str(e)}") from e
+    raise PackageError(f"Unsupported package format: {filename}")
+
+
+def check_index_json(index_json: dict, filename: str, platform: str) -> None:
+    try:
+        parsed = parse_package_filename(filename)
+    except ValueError as e:
+        raise PackageError(str(e)) from e
+
+    expected = {
+        "name": parsed.name,
+        "version": parsed.version,
+        "build": parsed.build,
+        "subdir": platform,
+    }
+    for key, value in expected.items():
+        if index_json.get(key) != value:
+            raise PackageError(
+                f"Package {key} {index_json.get(key)!r} does not match {value!r}"
+            )
+
+
+def _read_index_json(tar: tarfile.TarFile) -> dict:
+    for member in tar:
+        if member.name.removeprefix("./") != "info/index.json":
+            continue
+        member_file = tar.extractfile(member)
+        if member_file is None:
+            break
+        try:
+            index_json = json.load(member_file)
+        except (UnicodeDecodeError, json.JSONDecodeError) as e:
+            raise PackageError(f"Invalid info/index.json: {str(e)}") from e
+        if not isinstance(index_json, dict):
+            raise PackageError("Invalid info/index.json")
+        return index_json
+    raise PackageError("Package does not contain info/index.json")
+
+
+def _read_conda_index_json(fileobj: BinaryIO) -> dict:
+    # A .conda package is an uncompressed zip of zstd-compressed tarballs.
+    # The metadata is in the info-*.tar.zst component, which may be stored
+    # before or after the much larger pkg-*.tar.zst component.
+    index_json = None
+    for name, entry in _iter_zip_entries(fileobj):
+        if name.startswith("info-") and name.endswith(".tar.zst"):
+            reader = zstandard.ZstdDecompressor().stream_reader(entry, closefd=False)
+            with tarfile.open(fileobj=reader, mode="r|") as tar:  # type: ignore
+                index_json = _read_index_json(tar)
+        if index_json is not None:
+            return index_json
+    raise PackageError("Package does not contain an info component")
+
+
+def _iter_zip_entries(fileobj: BinaryIO) -> Iterator[tuple[str, BinaryIO]]:
+    # Zip archives are meant to be read from the central directory at the end,
+    # but each entry is also preceded by a local header, which lets the entries
+    # be read from a stream
+    while _read_exact(fileobj, 4) == ZIP_LOCAL_FILE_SIGNATURE:
+        (
+            _,
+            flags,
+            method,
+            _,
+            _,
+            _,
+            compressed_size,
+            _,
+            name_length,
+            extra_length,
+        ) = ZIP_LOCAL_FILE_HEADER.unpack(
+            _read_exact(fileobj, ZIP_LOCAL_FILE_HEADER.size)
+        )
+        name = _read_exact(fileobj, name_length).decode("utf-8")
+        extra = _read_exact(fileobj, extra_length)
+
+        if flags & 0x08:
+            raise PackageError("Zip entries without sizes are not supported")
+        if method != 0:
+            raise PackageError("Compressed zip entries are not supported")
+        if compressed_size == 0xFFFFFFFF:
+            compressed_size = _zip64_size(extra)
+
+        entry = _LimitedReader(fileobj, compressed_size)
+        yield name, entry  # type: ignore
+        entry.skip()
+
+
+def _zip64_size(extra: bytes) -> int:
+    offset = 0
+    while offset + 4 <= len(extra):
+        field_id, field_size = struct.unpack_from("<HH", extra, offset)
+        if field_id == ZIP64_EXTRA_FIELD_ID and field_size >= 16:
+            # The uncompressed size comes first, then the compressed size
+            return struct.unpack_from("<Q", extra, offset + 12)[0]
+        offset += 4 + field_size
+    raise PackageError("Invalid zip64 entry")
+
+
+def _read_exact(fileobj: BinaryIO, size: int) -> bytes:
+    data = b""
+    while len(data) < size:
+        chunk = fileobj.read(size - len(data))
+        if not chunk:
+            raise PackageError("Unexpected end of package archive")
+        data += chunk
+    return data
+
+
+class _LimitedReader(io.RawIOBase):
+    def __init__(self, fileobj: BinaryIO, size: int) -> None:
+        self._fileobj = fileobj
+        self._remaining = size
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        size = min(len(buffer), self._remaining)
+        if size == 0:
+            return 0
+        data = self._fileobj.read(size)
+        if not data:
+            raise PackageError("Unexpected end of package archive")
+        buffer[: len(data)] = data
+        self._remaining -= len(data)
+        return len(data)
+
+    def skip(self, chunk_size=65536) -> None:
+        while self._remaining:
+            size = min(chunk_size, self._remaining)
+            _read_exact(self._fileobj, size)
+            self._remaining -= size
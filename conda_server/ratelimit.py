@@ -0,0 +1,277 @@
+import asyncio
+import math
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import AsyncIterable, AsyncIterator, Callable
+
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse, JSONResponse
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+API_KEY_HEADER = b"x-api-key"
+
+
+class MemoryBackend:
+    """
+    Token buckets of the clients of this process. The least recently used
+    buckets are evicted once there are `max_clients` of them; an evicted
+    client starts over with a full bucket.
+    """
+
+    blocking = False
+
+    def __init__(self, max_clients=100000) -> None:
+        self._max_clients = max_clients
+        # key -> [tokens, updated]
+        self._buckets: OrderedDict[str, list[float]] = OrderedDict()
+
+    def take(
+        self, key: str, rate: float, capacity: float, amount: float, debt: bool
+    ) -> float:
+        now = time.monotonic()
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = [capacity, now]
+            if len(self._buckets) > self._max_clients:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+        tokens = min(capacity, bucket[0] + (now - bucket[1]) * rate)
+        bucket[1] = now
+        wait = _take(tokens, rate, amount)
+        bucket[0] = tokens - amount if wait == 0 or debt else tokens
+        return wait
+
+
+class SQLiteBackend:
+    """
+    Token buckets shared by the workers of a server through a SQLite database.
+    Each take is one short write transaction, so it runs in a worker thread.
+    """
+
+    blocking = True
+
+    def __init__(self, db_path: str) -> None:
+        self._db_path = db_path
+        self._local = threading.local()
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self._db_path)), exist_ok=True)
+            connection = sqlite3.connect(
+                self._db_path, timeout=5.0, isolation_level=None
+            )
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=OFF")
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS buckets (
+                    key TEXT PRIMARY KEY,
+                    tokens REAL NOT NULL,
+                    updated REAL NOT NULL
+                ) WITHOUT ROWID
+                """)
+            self._local.connection = connection
+        return connection
+
+    def take(
+        self, key: str, rate: float, capacity: float, amount: float, debt: bool
+    ) -> float:
+        # Wall clock time, as monotonic clocks aren't comparable across processes
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            now = time.time()
+            row = connection.execute(
+                "SELECT tokens, updated FROM buckets WHERE key = ?", (key,)
+            ).fetchone()
+            tokens = capacity if row is None else row[0] + (now - row[1]) * rate
+            tokens = min(capacity, tokens)
+            wait = _take(tokens, rate, amount)
+            connection.execute(
+                "INSERT OR REPLACE INTO buckets (key, tokens, updated) VALUES (?, ?, ?)",
+                (key, tokens - amount if wait == 0 or debt else tokens, now),
+            )
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        return wait
+
+
+def _take(tokens: float, rate: float, amount: float) -> float:
+    # Seconds until the bucket holds `amount` tokens. Bandwidth is taken on
+    # credit and paid back by waiting, requests are refused until they fit.
+    if tokens >= amount:
+        return 0.0
+    return (amount - tokens) / rate
+
+
+class RateLimiter:
+    """
+    Token bucket rate limits per client: a request rate, enforced when a
+    request arrives, and a bandwidth, enforced while a response streams. A
+    limit of 0 disables it.
+    """
+
+    def __init__(
+        self,
+        requests_per_second: float = 0.0,
+        request_burst: float | None = None,
+        bytes_per_second: float = 0.0,
+        bytes_burst: float | None = None,
+        backend: MemoryBackend | SQLiteBackend | None = None,
+    ) -> None:
+        self._requests_per_second = requests_per_second
+        self._request_burst = request_burst or max(1.0, requests_per_second)
+        self._bytes_per_second = bytes_per_second
+        self._bytes_burst = bytes_burst or bytes_per_second
+        self._backend = backend or MemoryBackend()
+
+    @property
+    def limits_requests(self) -> bool:
+        return self._requests_per_second > 0
+
+    @property
+    def limits_bandwidth(self) -> bool:
+        return self._bytes_per_second > 0
+
+    async def check_request(self, client: str) -> float:
+        """
+        Count a request of a client. Returns 0 if the request is allowed, or
+        the number of seconds after which it would be.
+        """
+        if not self.limits_requests:
+            return 0.0
+        return await self._take(
+            f"requests:{client}",
+            self._requests_per_second,
+            self._request_burst,
+            1.0,
+            debt=False,
+        )
+
+    async def throttle(
+        self, client: str, chunks: AsyncIterable[bytes]
+    ) -> AsyncIterator[bytes]:
+        """Pass the chunks of a response through at the client's bandwidth."""
+        async for chunk in chunks:
+            await self.consume(client, len(chunk))
+            yield chunk
+
+    async def consume(self, client: str, size: int) -> None:
+        """Wait until a client's bandwidth allows sending `size` bytes."""
+        if not self.limits_bandwidth:
+            return
+        wait = await self._take(
+            f"bytes:{client}",
+            self._bytes_per_second,
+            self._bytes_burst,
+            size,
+            debt=True,
+        )
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    async def _take(
+        self, key: str, rate: float, capacity: float, amount: float, debt: bool
+    ) -> float:
+        if self._backend.blocking:
+            return await run_in_threadpool(
+                self._backend.take, key, rate, capacity, amount, debt
+            )
+        return self._backend.take(key, rate, capacity, amount, debt)
+
+
+class ThrottledFileResponse(FileResponse):
+    """
+    A file response whose body is sent at a client's bandwidth. Everything
+    else, e.g. the Content-Length, ETag and Last-Modified headers and the
+    handling of range requests, is left to `FileResponse`.
+    """
+
+    def __init__(
+        self, response: FileResponse, rate_limiter: RateLimiter, client: str
+    ) -> None:
+        # Takes over a response that was already set up, headers included
+        self.__dict__.update(response.__dict__)
+        self._rate_limiter = rate_limiter
+        self._client = client
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        async def throttled_send(message: Message) -> None:
+            if message["type"] == "http.response.body":
+                await self._rate_limiter.consume(
+                    self._client, len(message.get("body", b""))
+                )
+            await send(message)
+
+        # Without the pathsend extension, the body goes through send
+        extensions = {
+            name: extension
+            for name, extension in scope.get("extensions", {}).items()
+            if name != "http.response.pathsend"
+        }
+        await super().__call__(
+            {**scope, "extensions": extensions}, receive, throttled_send
+        )
+
+
+class RateLimitMiddleware:
+    """
+    Refuses HTTP requests of clients over their request rate with a 429 and a
+    Retry-After header. Implemented as plain ASGI middleware, so that allowed
+    requests pay for a bucket update and nothing else. Requests are limited
+    ahead of authentication, so API keys only identify clients once
+    `identify_key` knows them to be valid.
+    """
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        rate_limiter: RateLimiter,
+        identify_key: Callable[[str], str | None] | None = None,
+    ) -> None:
+        self._app = app
+        self._rate_limiter = rate_limiter
+        self._identify_key = identify_key
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] == "http" and self._rate_limiter.limits_requests:
+            retry_after = await self._rate_limiter.check_request(
+                scope_client(scope, self._identify_key)
+            )
+            if retry_after > 0:
+                response = JSONResponse(
+                    {"detail": "Too many requests"},
+                    status_code=429,
+                    headers={"Retry-After": str(math.ceil(retry_after))},
+                )
+                await response(scope, receive, send)
+                return
+        await self._app(scope, receive, send)
+
+
+def scope_client(
+    scope: Scope, identify_key: Callable[[str], str | None] | None = None
+) -> str:
+    key_id = None
+    if identify_key is not None:
+        for name, value in scope["headers"]:
+            if name == API_KEY_HEADER:
+                key_id = identify_key(value.decode("latin-1"))
+                break
+    client = scope.get("client")
+    return client_key(key_id, client[0] if client else None)
+
+
+def client_key(key_id: str | None, host: str | None) -> str:
+    # Clients are identified by the id of a verified API key, or else by their
+    # address. Unverified keys would let a client pick a new bucket for every
+    # request.
+    if key_id:
+        return f"key:{key_id}"
+    return f"ip:{host or 'unknown'}"
@@ -0,0 +1,553 @@
+import asyncio
+import functools
+import json
+import logging
+import os
+import secrets
+import shutil
+import sqlite3
+import time
+from contextlib import closing, suppress
+from typing import TYPE_CHECKING, NamedTuple
+
+from fastapi.concurrency import run_in_threadpool
+
+from .atomic import atomic_write
+from .batch import commit_batch
+from .blobs import BlobStore, StagedBlob
+from .mirror import Upstream
+from .packages import inspect_package
+from .repodata import read_published_packages
+from .snapshot import StagedSnapshot, replace_index_files, stage_snapshot
+from .streams import open_async_iterator
+from .utils import get_platforms
+
+if TYPE_CHECKING:
+    from .channels import Channel, ChannelRegistry
+
+logger = logging.getLogger(__name__)
+
+PACKAGE_EXTENSIONS = (".tar.bz2", ".conda")
+
+
+class ChangeLog:
+    """
+    Ordered log of what the index generations of the channels of a leader
+    published, kept in a SQLite database for followers to pull. Each
+    generation appends an "upload" for every package it added or replaced and
+    a "delete" for every package it dropped, followed by an "index" entry for
+    the generation itself. Only the last `max_entries` are kept; followers
+    that fall further behind resynchronize every channel. The workers of a
+    server can share a database.
+    """
+
+    def __init__(self, db_path: str, max_entries=100000) -> None:
+        self._db_path = db_path
+        self._max_entries = max_entries
+        self._changed = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._tasks: set[asyncio.Task[None]] = set()
+
+    def connect(self) -> sqlite3.Connection:
+        os.makedirs(os.path.dirname(self._db_path), exist_ok=True)
+        connection = sqlite3.connect(self._db_path, timeout=30.0)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("""
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL
+            ) WITHOUT ROWID
+            """)
+        # The log is identified by a random epoch, so that followers notice
+        # when it is recreated and its sequence numbers start over
+        connection.execute(
+            "INSERT OR IGNORE INTO meta (key, value) VALUES ('epoch', ?)",
+            (secrets.token_hex(8),),
+        )
+        connection.execute("""
+            CREATE TABLE IF NOT EXISTS changes (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                channel TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                path TEXT,
+                sha256 TEXT,
+                size INTEGER,
+                subdirs TEXT,
+                created REAL NOT NULL
+            )
+            """)
+        # The packages published as of the last logged generation
+        connection.execute("""
+            CREATE TABLE IF NOT EXISTS packages (
+                channel TEXT NOT NULL,
+                subdir TEXT NOT NULL,
+                fn TEXT NOT NULL,
+                sha256 TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                PRIMARY KEY (channel, subdir, fn)
+            ) WITHOUT ROWID
+            """)
+        connection.commit()
+        return connection
+
+    def attach(self, channel: "Channel") -> None:
+        """
+        Log each index generation of a channel. A channel the log doesn't know
+        yet, e.g. one published before the log existed, has its published
+        index logged as a baseline, so that followers replicate it without
+        waiting for it to be indexed.
+        """
+        channel.index_manager.add_generation_listener(
+            lambda subdirs: self.schedule(channel.name, channel.directory, subdirs)
+        )
+        self.schedule(channel.name, channel.directory, None, baseline=True)
+
+    def schedule(
+        self,
+        channel: str | None,
+        channel_dir: str,
+        subdirs: set[str] | None,
+        baseline=False,
+    ) -> None:
+        task = asyncio.create_task(self.record(channel, channel_dir, subdirs, baseline))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def record(
+        self,
+        channel: str | None,
+        channel_dir: str,
+        subdirs: set[str] | None,
+        baseline=False,
+    ) -> int:
+        """
+        Log the packages that the published index of `subdirs`, or of every
+        subdir if None, added and dropped since the last logged generation.
+        With `baseline`, nothing is logged if the log already knows the
+        channel. Returns the number of entries appended.
+        """
+        try:
+            async with self._lock:
+                appended = await run_in_threadpool(
+                    self._record, channel or "", channel_dir, subdirs, baseline
+                )
+        except (OSError, sqlite3.Error) as e:
+            logger.error("Logging index generation of %s failed: %s", channel_dir, e)
+            return 0
+        self._changed.set()
+        self._changed = asyncio.Event()
+        return appended
+
+    def _record(
+        self,
+        channel: str,
+        channel_dir: str,
+        subdirs: set[str] | None,
+        baseline=False,
+    ) -> int:
+        now = time.time()
+        with closing(self.connect()) as connection, connection:
+            connection.execute("BEGIN IMMEDIATE")
+            # Checked in the transaction, so that workers attaching the same
+            # channel log a single baseline
+            if (
+                baseline
+                and connection.execute(
+                    "SELECT 1 FROM changes WHERE channel = ? "
+                    "UNION ALL SELECT 1 FROM packages WHERE channel = ? LIMIT 1",
+                    (channel, channel),
+                ).fetchone()
+            ):
+                return 0
+            indexed = subdirs
+            if indexed is None:
+                indexed = {
+                    subdir
+                    for subdir in get_platforms()
+                    if os.path.isdir(os.path.join(channel_dir, subdir))
+                } | {
+                    subdir
+                    for subdir, in connection.execute(
+                        "SELECT DISTINCT subdir FROM packages WHERE channel = ?",
+                        (channel,),
+                    )
+                }
+
+            entries = []
+            for subdir in sorted(indexed):
+                published = read_published_packages(channel_dir, subdir)
+                logged = {
+                    fn: (sha256, size)
+                    for fn, sha256, size in connection.execute(
+                        "SELECT fn, sha256, size FROM packages "
+                        "WHERE channel = ? AND subdir = ?",
+                        (channel, subdir),
+                    )
+                }
+                for fn in sorted(logged.keys() - published.keys()):
+                    entries.append((channel, "delete", f"{subdir}/{fn}", None, None))
+                for fn, (sha256, size) in sorted(published.items()):
+                    if logged.get(fn) != (sha256, size):
+                        entries.append(
+                            (channel, "upload", f"{subdir}/{fn}", sha256, size)
+                        )
+                connection.execute(
+                    "DELETE FROM packages WHERE channel = ? AND subdir = ?",
+                    (channel, subdir),
+                )
+                connection.executemany(
+                    "INSERT INTO packages (channel, subdir, fn, sha256, size) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    [
+                        (channel, subdir, fn, sha256, size)
+                        for fn, (sha256, size) in published.items()
+                    ],
+                )
+
+            connection.executemany(
+                "INSERT INTO changes (channel, kind, path, sha256, size, created) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                [(*entry, now) for entry in entries],
+            )
+            connection.execute(
+                "INSERT INTO changes (channel, kind, subdirs, created) "
+                "VALUES (?, 'index', ?, ?)",
+                (channel, ",".join(sorted(subdirs)) if subdirs else None, now),
+            )
+            connection.execute(
+                "DELETE FROM changes WHERE seq <= "
+                "(SELECT seq FROM sqlite_sequence WHERE name = 'changes') - ?",
+                (self._max_entries,),
+            )
+        return len(entries) + 1
+
+    def read(self, since: int, limit=1000) -> dict:
+        """
+        The entries after sequence number `since`, at most `limit` of them,
+        with the epoch of the log, the first and last sequence numbers it
+        still has, and the channels it knows of.
+        """
+        with closing(self.connect()) as connection:
+            (epoch,) = connection.execute(
+                "SELECT value FROM meta WHERE key = 'epoch'"
+            ).fetchone()
+            last = self._last_seq(connection)
+            (first,) = connection.execute("SELECT MIN(seq) FROM changes").fetchone()
+            rows = connection.execute(
+                "SELECT seq, channel, kind, path, sha256, size, subdirs, created "
+                "FROM changes WHERE seq > ? ORDER BY seq LIMIT ?",
+                (since, limit),
+            ).fetchall()
+            channels = [
+                channel
+                for channel, in connection.execute(
+                    "SELECT channel FROM changes UNION SELECT channel FROM packages"
+                )
+            ]
+        return {
+            "epoch": epoch,
+            "first": last + 1 if first is None else first,
+            "last": last,
+            "channels": [channel or None for channel in sorted(channels)],
+            "changes": [
+                {
+                    "seq": seq,
+                    "channel": channel or None,
+                    "kind": kind,
+                    "path": path,
+                    "sha256": sha256,
+                    "size": size,
+                    "subdirs": subdirs.split(",") if subdirs else None,
+                    "created": created,
+                }
+                for seq, channel, kind, path, sha256, size, subdirs, created in rows
+            ],
+        }
+
+    def last_seq(self) -> int:
+        with closing(self.connect()) as connection:
+            return self._last_seq(connection)
+
+    @staticmethod
+    def _last_seq(connection: sqlite3.Connection) -> int:
+        # Unlike MAX(seq), this survives trimming the whole log
+        row = connection.execute(
+            "SELECT seq FROM sqlite_sequence WHERE name = 'changes'"
+        ).fetchone()
+        return row[0] if row else 0
+
+    async def wait(self, since: int, timeout: float) -> None:
+        """
+        Wait up to `timeout` seconds for an entry after `since`. Entries logged
+        by other workers are seen within a second.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            changed = self._changed
+            if await run_in_threadpool(self.last_seq) > since:
+                return
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            with suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(changed.wait(), min(remaining, 1.0))
+
+    async def __aenter__(self) -> "ChangeLog":
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback) -> None:
+        # Let pending generations finish logging
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+
+class ReplicaPlan(NamedTuple):
+    # Channel path -> digest of the packages to fetch from the leader
+    fetch: dict[str, str]
+    # Channel path -> digest of the packages whose blob is already here
+    link: dict[str, str]
+    # Packages that the leader no longer publishes
+    remove: list[str]
+
+
+def plan_replica(blob_store: BlobStore, staged: StagedSnapshot) -> ReplicaPlan:
+    """
+    Compare the packages listed by the index files of a leader with those of
+    the channel, so that only new packages are fetched.
+    """
+    fetch: dict[str, str] = {}
+    link: dict[str, str] = {}
+    for name, package in staged.manifest["packages"].items():
+        path = os.path.join(staged.channel_dir, name)
+        digest = package["sha256"]
+        try:
+            if os.stat(path).st_ino == os.stat(blob_store.blob_path(digest)).st_ino:
+                continue
+        except FileNotFoundError:
+            pass
+        if blob_store.has(digest):
+            link[path] = digest
+        else:
+            fetch[path] = digest
+
+    remove = []
+    for subdir in get_platforms():
+        subdir_dir = os.path.join(staged.channel_dir, subdir)
+        if not os.path.isdir(subdir_dir):
+            continue
+        with os.scandir(subdir_dir) as entries:
+            remove.extend(
+                entry.path
+                for entry in entries
+                if entry.name.endswith(PACKAGE_EXTENSIONS)
+                and f"{subdir}/{entry.name}" not in staged.manifest["packages"]
+            )
+    return ReplicaPlan(fetch, link, sorted(remove))
+
+
+def apply_replica(
+    blob_store: BlobStore,
+    staged: StagedSnapshot,
+    plan: ReplicaPlan,
+    fetched: dict[str, StagedBlob],
+) -> None:
+    """
+    Bring a channel in line with the staged index files of a leader: link the
+    new packages, fetched by digest in `fetched`, then replace the index files
+    and only then remove the packages they no longer list, so that clients
+    never see an index listing packages that aren't there.
+    """
+    try:
+        for path in [*plan.fetch, *plan.link]:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        commit_batch(
+            blob_store, {path: fetched[digest] for path, digest in plan.fetch.items()}
+        )
+        for path, digest in plan.link.items():
+            blob_store.link(digest, path)
+        replace_index_files(staged.index_files)
+        for path in plan.remove:
+            with suppress(FileNotFoundError):
+                blob_store.release(path)
+    finally:
+        for staged_blob in fetched.values():
+            blob_store.discard(staged_blob)
+        shutil.rmtree(staged.staging_dir, ignore_errors=True)
+
+
+class Follower:
+    """
+    Keeps the channels of a read-only node in step with a leader. The
+    follower long-polls the change log of the leader, and for each channel
+    with new index generations fetches the leader's published index files,
+    then only the packages it doesn't have, by digest, and applies them
+    without ever indexing. Its position in the log is kept in `state_file`.
+    """
+
+    def __init__(
+        self,
+        leader: Upstream,
+        registry: "ChannelRegistry",
+        blob_store: BlobStore,
+        state_file: str,
+        wait=30.0,
+        max_fetches=4,
+        retry_interval=5.0,
+    ) -> None:
+        self._leader = leader
+        self._registry = registry
+        self._blob_store = blob_store
+        self._state_file = state_file
+        self._wait = wait
+        self._fetch_slots = asyncio.Semaphore(max_fetches)
+        self._retry_interval = retry_interval
+        self._epoch: str | None = None
+        self._cursor = 0
+        self._task: asyncio.Task[None] | None = None
+
+    @property
+    def cursor(self) -> int:
+        return self._cursor
+
+    def _load_state(self) -> None:
+        try:
+            with open(self._state_file, encoding="utf-8") as f:
+                state = json.load(f)
+            self._epoch, self._cursor = state["epoch"], state["cursor"]
+        except (FileNotFoundError, json.JSONDecodeError, KeyError):
+            self._epoch, self._cursor = None, 0
+
+    def _save_state(self) -> None:
+        os.makedirs(os.path.dirname(self._state_file), exist_ok=True)
+        with atomic_write(self._state_file) as f:
+            json.dump({"epoch": self._epoch, "cursor": self._cursor}, f)
+
+    async def sync(self, wait=0.0) -> set[str | None]:
+        """
+        Apply the changes logged since the last sync, waiting up to `wait`
+        seconds for some. Returns the channels that were synced.
+        """
+        async with self._leader.stream(
+            f"replication/changes?since={self._cursor}&wait={wait}"
+        ) as response:
+            response.raise_for_status()
+            await response.aread()
+        log = response.json()
+
+        if log["epoch"] != self._epoch or self._cursor < log["first"] - 1:
+            # The log was recreated, or trimmed past the entries this node
+            # hasn't seen yet
+            logger.info("Resynchronizing every channel with %s", self._leader.url)
+            channels = set(log["channels"])
+            cursor = log["last"]
+        else:
+            channels = {
+                change["channel"]
+                for change in log["changes"]
+                if change["kind"] == "index"
+            }
+            cursor = log["changes"][-1]["seq"] if log["changes"] else self._cursor
+
+        for name in sorted(channels, key=lambda name: name or ""):
+            await self.sync_channel(name)
+        self._epoch, self._cursor = log["epoch"], cursor
+        await run_in_threadpool(self._save_state)
+        return channels
+
+    async def sync_channel(self, name: str | None) -> None:
+        directory = self._registry.channel_dir(name)
+        os.makedirs(directory, exist_ok=True)
+        prefix = f"{name}/" if name else ""
+        async with self._leader.stream(f"{prefix}replication/index") as response:
+            if response.status_code == 404:
+                logger.warning("Channel %s is gone from the leader", name)
+                return
+            response.raise_for_status()
+            staged = await run_in_threadpool(
+                stage_snapshot,
+                self._blob_store,
+                directory,
+                open_async_iterator(response.aiter_bytes()),
+            )
+
+        fetched: dict[str, StagedBlob] = {}
+        try:
+            plan = await run_in_threadpool(plan_replica, self._blob_store, staged)
+            fetched = await self._fetch_blobs(plan.fetch)
+        except BaseException:
+            for staged_blob in fetched.values():
+                self._blob_store.discard(staged_blob)
+            shutil.rmtree(staged.staging_dir, ignore_errors=True)
+            raise
+
+        async with self._registry.use(name) as channel:
+            async with channel.index_manager.published():
+                await run_in_threadpool(
+                    apply_replica, self._blob_store, staged, plan, fetched
+                )
+            channel.index_manager.notify_published(None)
+        logger.info(
+            "Replicated %s: %d packages fetched, %d linked, %d removed",
+            name or "<default>",
+            len(plan.fetch),
+            len(plan.link),
+            len(plan.remove),
+        )
+
+    async def _fetch_blobs(self, paths: dict[str, str]) -> dict[str, StagedBlob]:
+        # Each blob is fetched once, however many paths it is published under
+        digests = {digest: path for path, digest in paths.items()}
+        results = await asyncio.gather(
+            *(self._fetch_blob(digest, path) for digest, path in digests.items()),
+            return_exceptions=True,
+        )
+        fetched = {
+            digest: result
+            for digest, result in zip(digests, results)
+            if isinstance(result, StagedBlob)
+        }
+        for result in results:
+            if isinstance(result, BaseException):
+                for staged_blob in fetched.values():
+                    self._blob_store.discard(staged_blob)
+                raise result
+        return fetched
+
+    async def _fetch_blob(self, digest: str, path: str) -> StagedBlob:
+        async with self._fetch_slots, self._leader.stream(
+            f"blobs/sha256/{digest}"
+        ) as response:
+            response.raise_for_status()
+            return await run_in_threadpool(
+                self._blob_store.stage,
+                open_async_iterator(response.aiter_bytes()),
+                expected_digest=digest,
+                inspect=functools.partial(
+                    inspect_package,
+                    filename=os.path.basename(path),
+                    platform=os.path.basename(os.path.dirname(path)),
+                ),
+            )
+
+    async def run(self) -> None:
+        await run_in_threadpool(self._load_state)
+        while True:
+            try:
+                await self.sync(wait=self._wait)
+            except Exception as e:  # pylint: disable=broad-except
+                # The cursor only moves once changes are applied, so they are
+                # retried
+                logger.error("Replicating from %s failed: %s", self._leader.url, e)
+                await asyncio.sleep(self._retry_interval)
+
+    async def __aenter__(self) -> "Follower":
+        self._task = asyncio.create_task(self.run())
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+        await self._leader.aclose()
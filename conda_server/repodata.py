@@ -0,0 +1,495 @@
+import bz2
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import time
+from contextlib import ExitStack, closing
+from typing import Iterator
+
+import zstandard
+
+from .atomic import atomic_link, atomic_write
+from .blobs import BlobStore
+from .current_repodata import PackageRecord, current_records
+from .packages import PackageError, read_index_json
+from .utils import get_blob_dir
+
+logger = logging.getLogger(__name__)
+
+REPODATA_VERSION = 1
+# Same compression settings as conda-index
+ZSTD_COMPRESS_LEVEL = 16
+# index.json fields that conda-index leaves out of repodata.json
+REPODATA_FILTER_FIELDS = {
+    "arch",
+    "binstar",
+    "has_prefix",
+    "machine",
+    "mtime",
+    "operatingsystem",
+    "platform",
+    "requires_features",
+    "target-triplet",
+    "ucs",
+}
+
+
+def repodata_record(metadata: dict) -> dict:
+    """
+    The repodata.json record of a package, from the metadata cached with its
+    blob: index.json with the md5, sha256 and size of the package file.
+    """
+    return {
+        key: value
+        for key, value in metadata.items()
+        if key not in REPODATA_FILTER_FIELDS
+    }
+
+
+def read_published_packages(channel_dir: str, subdir: str) -> dict:
+    """
+    fn -> (sha256, size) of the packages listed by the published repodata.json
+    of a subdir, which is empty if there is none.
+    """
+    try:
+        with open(os.path.join(channel_dir, subdir, "repodata.json"), "rb") as f:
+            repodata = json.load(f)
+    except FileNotFoundError:
+        return {}
+    return {
+        fn: (record.get("sha256", ""), record.get("size", 0))
+        for section in ("packages", "packages.conda")
+        for fn, record in repodata.get(section, {}).items()
+    }
+
+
+class RepodataStore:
+    """
+    Pre-serialized repodata records of the packages in a channel, stored in
+    SQLite. Each record is serialized once, when its package is added, and
+    repodata.json is assembled by concatenating the records in file name order.
+    The records are kept in sync with the subdirs by comparing the size and
+    mtime of the package files. Each record also has the time its package file
+    was added to the channel: package files are hardlinks to shared blobs, so
+    their mtime is the age of the content, not of the upload.
+    """
+
+    def __init__(self, channel_dir: str, blob_store: BlobStore | None = None) -> None:
+        self._channel_dir = channel_dir
+        self._blob_store = blob_store or BlobStore(get_blob_dir())
+        self._db_path = os.path.join(channel_dir, ".conda-server", "repodata.db")
+
+    def connect(self) -> sqlite3.Connection:
+        os.makedirs(os.path.dirname(self._db_path), exist_ok=True)
+        connection = sqlite3.connect(self._db_path, timeout=30.0)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("""
+            CREATE TABLE IF NOT EXISTS packages (
+                subdir TEXT NOT NULL,
+                fn TEXT NOT NULL,
+                name TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                record TEXT NOT NULL,
+                PRIMARY KEY (subdir, fn)
+            ) WITHOUT ROWID
+            """)
+        connection.execute(
+            "CREATE INDEX IF NOT EXISTS packages_name ON packages (subdir, name)"
+        )
+        # Added after the table, so stores created before have no upload times
+        # for the records they already had
+        columns = {row[1] for row in connection.execute("PRAGMA table_info(packages)")}
+        if "added" not in columns:
+            connection.execute("ALTER TABLE packages ADD COLUMN added REAL")
+        # The per-name index of current_repodata.json: the files included for
+        # each package name, the names they were chosen from, and the names
+        # whose packages changed since it was last updated
+        connection.execute("""
+            CREATE TABLE IF NOT EXISTS current_packages (
+                subdir TEXT NOT NULL,
+                root TEXT NOT NULL,
+                fn TEXT NOT NULL,
+                PRIMARY KEY (subdir, root, fn)
+            ) WITHOUT ROWID
+            """)
+        connection.execute("""
+            CREATE TABLE IF NOT EXISTS current_requires (
+                subdir TEXT NOT NULL,
+                root TEXT NOT NULL,
+                name TEXT NOT NULL,
+                PRIMARY KEY (subdir, root, name)
+            ) WITHOUT ROWID
+            """)
+        connection.execute("""
+            CREATE INDEX IF NOT EXISTS current_requires_name
+            ON current_requires (subdir, name)
+            """)
+        connection.execute("""
+            CREATE TABLE IF NOT EXISTS stale_names (
+                subdir TEXT NOT NULL,
+                name TEXT NOT NULL,
+                PRIMARY KEY (subdir, name)
+            ) WITHOUT ROWID
+            """)
+        return connection
+
+    def add(self, path: str, metadata: dict) -> None:
+        """
+        Add the record of a package file whose metadata is already known, e.g.
+        from its upload, so that it doesn't have to be extracted again.
+        """
+        self.add_many({path: metadata})
+
+    def add_many(self, metadata: dict[str, dict]) -> None:
+        """Add the records of many package files in one transaction."""
+        with closing(self.connect()) as connection, connection:
+            for path, package_metadata in metadata.items():
+                subdir = os.path.basename(os.path.dirname(path))
+                self._upsert(
+                    connection,
+                    subdir,
+                    os.path.basename(path),
+                    os.stat(path),
+                    package_metadata,
+                )
+                self._mark_stale(connection, subdir, {package_metadata["name"]})
+
+    def added_times(self, subdir: str) -> dict[str, float]:
+        """
+        fn -> the time each package file of a subdir was added to the channel,
+        for the package files that have one.
+        """
+        with closing(self.connect()) as connection:
+            return dict(
+                connection.execute(
+                    """
+                    SELECT fn, added FROM packages
+                    WHERE subdir = ? AND added IS NOT NULL
+                    """,
+                    (subdir,),
+                )
+            )
+
+    def update(self, subdir: str) -> set[str]:
+        """
+        Bring the records of a subdir in line with its package files. Only new
+        and changed package files are read. Returns the names of the packages
+        that were added, changed or removed.
+        """
+        subdir_dir = os.path.join(self._channel_dir, subdir)
+        changed_names: set[str] = set()
+
+        with closing(self.connect()) as connection, connection:
+            indexed = {
+                fn: (name, size, mtime_ns)
+                for fn, name, size, mtime_ns in connection.execute(
+                    "SELECT fn, name, size, mtime_ns FROM packages WHERE subdir = ?",
+                    (subdir,),
+                )
+            }
+
+            present = set()
+            if os.path.isdir(subdir_dir):
+                with os.scandir(subdir_dir) as entries:
+                    for entry in entries:
+                        if not entry.name.endswith((".tar.bz2", ".conda")):
+                            continue
+                        if not entry.is_file():
+                            continue
+                        present.add(entry.name)
+                        stat = entry.stat()
+                        if entry.name in indexed and indexed[entry.name][1:] == (
+                            stat.st_size,
+                            stat.st_mtime_ns,
+                        ):
+                            continue
+                        try:
+                            metadata = self._extract(entry.path)
+                        except (PackageError, OSError) as e:
+                            logger.warning("Skipping %s: %s", entry.path, e)
+                            continue
+                        self._upsert(connection, subdir, entry.name, stat, metadata)
+                        changed_names.add(metadata["name"])
+
+            removed = indexed.keys() - present
+            for fn in removed:
+                changed_names.add(indexed[fn][0])
+            connection.executemany(
+                "DELETE FROM packages WHERE subdir = ? AND fn = ?",
+                [(subdir, fn) for fn in removed],
+            )
+            self._mark_stale(connection, subdir, changed_names)
+
+        return changed_names
+
+    def update_current(self, subdir: str) -> bool:
+        """
+        Update the per-name index of current_repodata.json of a subdir. Only
+        the names whose packages changed since the last update, and the names
+        that chose dependencies from them, are recomputed. Returns whether the
+        files included in current_repodata.json changed.
+        """
+        with closing(self.connect()) as connection, connection:
+            stale = {
+                name
+                for (name,) in connection.execute(
+                    "SELECT name FROM stale_names WHERE subdir = ?", (subdir,)
+                )
+            }
+            connection.execute("DELETE FROM stale_names WHERE subdir = ?", (subdir,))
+            if not connection.execute(
+                "SELECT 1 FROM current_packages WHERE subdir = ? LIMIT 1", (subdir,)
+            ).fetchone():
+                stale.update(
+                    name
+                    for (name,) in connection.execute(
+                        "SELECT DISTINCT name FROM packages WHERE subdir = ?",
+                        (subdir,),
+                    )
+                )
+
+            roots = set(stale)
+            for name in stale:
+                roots.update(
+                    root
+                    for (root,) in connection.execute(
+                        """
+                        SELECT root FROM current_requires
+                        WHERE subdir = ? AND name = ?
+                        """,
+                        (subdir, name),
+                    )
+                )
+
+            loaded: dict[str, list[PackageRecord]] = {}
+
+            def load_records(name: str) -> list[PackageRecord]:
+                if name not in loaded:
+                    loaded[name] = [
+                        PackageRecord.from_record(fn, json.loads(record))
+                        for fn, record in connection.execute(
+                            """
+                            SELECT fn, record FROM packages
+                            WHERE subdir = ? AND name = ?
+                            """,
+                            (subdir, name),
+                        )
+                    ]
+                return loaded[name]
+
+            changed = False
+            for root in sorted(roots):
+                previous = {
+                    fn
+                    for (fn,) in connection.execute(
+                        """
+                        SELECT fn FROM current_packages
+                        WHERE subdir = ? AND root = ?
+                        """,
+                        (subdir, root),
+                    )
+                }
+                current = current_records(root, load_records)
+                changed = changed or current.fns != previous
+
+                for table in "current_packages", "current_requires":
+                    connection.execute(
+                        f"DELETE FROM {table} WHERE subdir = ? AND root = ?",
+                        (subdir, root),
+                    )
+                connection.executemany(
+                    "INSERT INTO current_packages (subdir, root, fn) VALUES (?, ?, ?)",
+                    [(subdir, root, fn) for fn in current.fns],
+                )
+                if current.fns:
+                    connection.executemany(
+                        """
+                        INSERT INTO current_requires (subdir, root, name)
+                        VALUES (?, ?, ?)
+                        """,
+                        [(subdir, root, name) for name in current.requires],
+                    )
+
+        return changed
+
+    def iter_repodata(
+        self, subdir: str, current=False, chunk_size=65536
+    ) -> Iterator[bytes]:
+        """
+        Stream repodata.json of a subdir in chunks, in the same format as
+        conda-index writes it. The document is never held in memory as a whole.
+        With `current`, stream current_repodata.json instead, from the per-name
+        index maintained by `update_current`.
+        """
+        sections = (
+            (b'"packages":{', "*.tar.bz2"),
+            (b'},"packages.conda":{', "*.conda"),
+        )
+        with closing(self.connect()) as connection:
+            parts = [b'{"info":{"subdir":%s},' % json.dumps(subdir).encode()]
+            buffered = 0
+            for section, pattern in sections:
+                parts.append(section)
+                separator = b""
+                rows = (
+                    self._iter_current_records(connection, subdir, pattern)
+                    if current
+                    else connection.execute(
+                        """
+                        SELECT fn, record FROM packages
+                        WHERE subdir = ? AND fn GLOB ? ORDER BY fn
+                        """,
+                        (subdir, pattern),
+                    )
+                )
+                for fn, record in rows:
+                    part = b"%s%s:%s" % (
+                        separator,
+                        json.dumps(fn).encode(),
+                        record.encode(),
+                    )
+                    parts.append(part)
+                    buffered += len(part)
+                    separator = b","
+                    if buffered >= chunk_size:
+                        yield b"".join(parts)
+                        parts.clear()
+                        buffered = 0
+            parts.append(b'},"removed":[],"repodata_version":%d}' % REPODATA_VERSION)
+            yield b"".join(parts)
+
+    def write_repodata(self, subdir: str) -> None:
+        """
+        Write repodata.json of a subdir and its bz2 and zst compressed copies in
+        one streaming pass. Without patch instructions, repodata_from_packages.json
+        has the same content and is linked to it.
+        """
+        subdir_dir = os.path.join(self._channel_dir, subdir)
+        path = os.path.join(subdir_dir, "repodata.json")
+        self._write_compressed(path, self.iter_repodata(subdir))
+
+        for suffix in "", ".bz2", ".zst":
+            atomic_link(
+                f"{path}{suffix}",
+                os.path.join(subdir_dir, f"repodata_from_packages.json{suffix}"),
+            )
+
+    def write_current_repodata(self, subdir: str) -> None:
+        """
+        Write current_repodata.json of a subdir and its bz2 and zst compressed
+        copies, from the per-name index maintained by `update_current`.
+        """
+        path = os.path.join(self._channel_dir, subdir, "current_repodata.json")
+        self._write_compressed(path, self.iter_repodata(subdir, current=True))
+
+    @staticmethod
+    def _write_compressed(path: str, chunks: Iterator[bytes]) -> None:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with ExitStack() as stack:
+            json_file = stack.enter_context(atomic_write(path, mode="wb"))
+            bz2_file = stack.enter_context(atomic_write(f"{path}.bz2", mode="wb"))
+            zst_file = stack.enter_context(atomic_write(f"{path}.zst", mode="wb"))
+            bz2_compressor = bz2.BZ2Compressor()
+            zst_writer = stack.enter_context(
+                zstandard.ZstdCompressor(
+                    level=ZSTD_COMPRESS_LEVEL, threads=-1
+                ).stream_writer(zst_file, closefd=False)
+            )
+
+            for chunk in chunks:
+                json_file.write(chunk)
+                bz2_file.write(bz2_compressor.compress(chunk))
+                zst_writer.write(chunk)
+            bz2_file.write(bz2_compressor.flush())
+
+    @staticmethod
+    def _iter_current_records(
+        connection: sqlite3.Connection, subdir: str, pattern: str
+    ) -> Iterator[tuple[str, str]]:
+        # Like conda-index, .conda records carry the md5 of the .tar.bz2 of the
+        # same build, or null if there is none
+        for fn, record, legacy_bz2_md5 in connection.execute(
+            """
+            SELECT p.fn, p.record, json_extract(b.record, '$.md5')
+            FROM packages AS p
+            LEFT JOIN packages AS b ON b.subdir = p.subdir
+                AND b.fn = substr(p.fn, 1, length(p.fn) - 6) || '.tar.bz2'
+                AND p.fn GLOB '*.conda'
+            WHERE p.subdir = ? AND p.fn GLOB ? AND p.fn IN (
+                SELECT fn FROM current_packages WHERE subdir = ?
+            )
+            ORDER BY p.fn
+            """,
+            (subdir, pattern, subdir),
+        ):
+            if fn.endswith(".conda"):
+                record = json.dumps(
+                    {**json.loads(record), "legacy_bz2_md5": legacy_bz2_md5},
+                    sort_keys=True,
+                    separators=(",", ":"),
+                )
+            yield fn, record
+
+    def _extract(self, path: str) -> dict:
+        # Hash the package in one pass, then look for the metadata that was
+        # cached with its blob before opening the archive
+        sha256_hash = hashlib.sha256()
+        md5_hash = hashlib.md5()
+        size = 0
+        with open(path, "rb") as f:
+            for byte_block in iter(lambda: f.read(65536), b""):
+                sha256_hash.update(byte_block)
+                md5_hash.update(byte_block)
+                size += len(byte_block)
+        digest = sha256_hash.hexdigest()
+
+        if (metadata := self._blob_store.read_metadata(digest)) is not None:
+            return metadata
+        with open(path, "rb") as f:
+            index_json = read_index_json(f, os.path.basename(path))
+        return {
+            **index_json,
+            "md5": md5_hash.hexdigest(),
+            "sha256": digest,
+            "size": size,
+        }
+
+    @staticmethod
+    def _mark_stale(
+        connection: sqlite3.Connection, subdir: str, names: set[str]
+    ) -> None:
+        connection.executemany(
+            "INSERT OR IGNORE INTO stale_names (subdir, name) VALUES (?, ?)",
+            [(subdir, name) for name in names],
+        )
+
+    @staticmethod
+    def _upsert(
+        connection: sqlite3.Connection,
+        subdir: str,
+        fn: str,
+        stat: os.stat_result,
+        metadata: dict,
+    ) -> None:
+        record = json.dumps(
+            repodata_record(metadata), sort_keys=True, separators=(",", ":")
+        )
+        connection.execute(
+            """
+            INSERT OR REPLACE INTO packages
+                (subdir, fn, name, size, mtime_ns, record, added)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            """,
+            (
+                subdir,
+                fn,
+                metadata["name"],
+                stat.st_size,
+                stat.st_mtime_ns,
+                record,
+                time.time(),
+            ),
+        )
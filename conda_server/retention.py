@@ -0,0 +1,224 @@
+import fnmatch
+import logging
+import os
+import time
+from collections import defaultdict
+from typing import Iterable, NamedTuple
+
+from pydantic import BaseModel, Field
+
+from .repodata import RepodataStore
+from .utils import get_platforms
+from .validation import build_number, parse_package_filename, version_key
+
+logger = logging.getLogger(__name__)
+
+
+class RetentionPolicy(BaseModel):
+    """
+    Which packages of a channel to keep. Every rule is optional; a package is
+    deleted if any rule selects it. The newest build of the newest version of
+    each package name is never deleted, and neither are pinned packages.
+    """
+
+    # Keep the newest N versions of each package name
+    keep_versions: int | None = Field(None, ge=1)
+    # Keep the newest N builds of each package version
+    keep_builds: int | None = Field(None, ge=1)
+    # Delete packages older than this many seconds
+    max_age: float | None = Field(None, gt=0)
+    # Delete the oldest packages until each subdir is below this many bytes
+    max_bytes: int | None = Field(None, ge=0)
+    # Size quotas for individual subdirs, overriding `max_bytes`
+    subdir_max_bytes: dict[str, int] = {}
+    # Packages to keep, as `name`, `name=version` or `name=version=build`
+    # patterns. Each part may contain shell-style wildcards.
+    pinned: list[str] = []
+
+
+class RetentionReport(NamedTuple):
+    paths: list[str]
+    bytes_saved: int
+    index_entries_saved: int
+
+
+class _PackageFile(NamedTuple):
+    path: str
+    name: str
+    version: str
+    build: str
+    size: int
+    # When the package file was added to the channel
+    uploaded: float
+    inode: int
+    nlink: int
+
+
+# Formats of the same build are kept or deleted together
+_BuildKey = tuple[str, str, str]
+
+
+def plan_retention(
+    channel_dir: str,
+    policy: RetentionPolicy,
+    subdirs: Iterable[str] | None = None,
+    now: float | None = None,
+    repodata: RepodataStore | None = None,
+) -> RetentionReport:
+    """
+    Compute the package files of a channel that `policy` deletes, without
+    deleting them. Packages are aged by the upload times that `repodata`
+    recorded. Package files are hardlinks to shared blobs, so their mtime is
+    only used for packages without one, and re-uploading content that another
+    channel already has doesn't make a package old.
+    """
+    now = time.time() if now is None else now
+    deleted: list[_PackageFile] = []
+    for subdir in sorted(subdirs or get_platforms()):
+        subdir_dir = os.path.join(channel_dir, subdir)
+        if not os.path.isdir(subdir_dir):
+            continue
+        max_bytes = policy.subdir_max_bytes.get(subdir, policy.max_bytes)
+        added_times = repodata.added_times(subdir) if repodata is not None else {}
+        package_files = _scan_subdir(subdir_dir, added_times)
+        deleted.extend(_plan_subdir(package_files, policy, max_bytes, now))
+
+    # Package files are hardlinks to blobs, so the space of a blob is only
+    # freed once the last package file linked to it is deleted
+    deleted_links: dict[int, int] = defaultdict(int)
+    for package_file in deleted:
+        deleted_links[package_file.inode] += 1
+    bytes_saved = 0
+    for package_file in {p.inode: p for p in deleted}.values():
+        if package_file.nlink - deleted_links[package_file.inode] <= 1:
+            bytes_saved += package_file.size
+
+    # Each package file is one entry of the subdir's repodata.json
+    return RetentionReport(
+        paths=[package_file.path for package_file in deleted],
+        bytes_saved=bytes_saved,
+        index_entries_saved=len(deleted),
+    )
+
+
+def _scan_subdir(subdir_dir: str, added_times: dict[str, float]) -> list[_PackageFile]:
+    package_files = []
+    with os.scandir(subdir_dir) as entries:
+        for entry in entries:
+            if not entry.is_file() or not entry.name.endswith((".tar.bz2", ".conda")):
+                continue
+            try:
+                parsed = parse_package_filename(entry.name)
+            except ValueError:
+                continue
+            stat = entry.stat()
+            package_files.append(
+                _PackageFile(
+                    path=entry.path,
+                    name=parsed.name,
+                    version=parsed.version,
+                    build=parsed.build,
+                    size=stat.st_size,
+                    uploaded=added_times.get(entry.name, stat.st_mtime),
+                    inode=stat.st_ino,
+                    nlink=stat.st_nlink,
+                )
+            )
+    return package_files
+
+
+def _plan_subdir(
+    package_files: list[_PackageFile],
+    policy: RetentionPolicy,
+    max_bytes: int | None,
+    now: float,
+) -> list[_PackageFile]:
+    builds: dict[_BuildKey, list[_PackageFile]] = defaultdict(list)
+    for package_file in package_files:
+        key = (package_file.name, package_file.version, package_file.build)
+        builds[key].append(package_file)
+
+    builds_by_name: dict[str, list[_BuildKey]] = defaultdict(list)
+    protected: set[_BuildKey] = set()
+    for key in builds:
+        if _is_pinned(key, policy.pinned):
+            protected.add(key)
+        try:
+            version_key(key[1])
+        except ValueError:
+            # Never delete packages that can't be ordered
+            logger.warning("Keeping %s-%s-%s, invalid version", *key)
+            protected.add(key)
+            continue
+        builds_by_name[key[0]].append(key)
+
+    def newest_first(keys: Iterable[_BuildKey]) -> list[_BuildKey]:
+        return sorted(
+            keys,
+            key=lambda key: (
+                version_key(key[1]),
+                build_number(key[2]),
+                max(package_file.uploaded for package_file in builds[key]),
+            ),
+            reverse=True,
+        )
+
+    selected: set[_BuildKey] = set()
+    for keys in builds_by_name.values():
+        keys = newest_first(keys)
+        protected.add(keys[0])
+
+        versions = list(dict.fromkeys(key[1] for key in keys))
+        if policy.keep_versions is not None:
+            kept_versions = set(versions[: policy.keep_versions])
+            selected.update(key for key in keys if key[1] not in kept_versions)
+        if policy.keep_builds is not None:
+            for package_version in versions:
+                version_builds = [key for key in keys if key[1] == package_version]
+                selected.update(version_builds[policy.keep_builds :])
+        if policy.max_age is not None:
+            selected.update(
+                key
+                for key in keys
+                if max(p.uploaded for p in builds[key]) < now - policy.max_age
+            )
+    selected -= protected
+
+    if max_bytes is not None:
+        total_bytes = sum(
+            package_file.size
+            for key, build in builds.items()
+            if key not in selected
+            for package_file in build
+        )
+        # Delete the least recently uploaded packages first
+        candidates = sorted(
+            builds.keys() - selected - protected,
+            key=lambda key: max(package_file.uploaded for package_file in builds[key]),
+        )
+        for key in candidates:
+            if total_bytes <= max_bytes:
+                break
+            selected.add(key)
+            total_bytes -= sum(package_file.size for package_file in builds[key])
+        if total_bytes > max_bytes:
+            logger.warning(
+                "Size quota of %d bytes can't be met, %d bytes are kept",
+                max_bytes,
+                total_bytes,
+            )
+
+    return sorted(
+        (package_file for key in selected for package_file in builds[key]),
+        key=lambda package_file: package_file.path,
+    )
+
+
+def _is_pinned(key: _BuildKey, patterns: list[str]) -> bool:
+    for pattern in patterns:
+        parts = pattern.split("=")
+        if len(parts) <= 3 and all(
+            fnmatch.fnmatchcase(value, part) for value, part in zip(key, parts)
+        ):
+            return True
+    return False
@@ -0,0 +1,479 @@
+import io
+import json
+import logging
+import os
+import queue
+import secrets
+import shutil
+import tarfile
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import suppress
+from typing import BinaryIO, Iterator, NamedTuple
+
+from filelock import FileLock, Timeout
+
+from .atomic import safely_remove_lock_file
+from .batch import commit_batch
+from .blobs import BlobStore, StagedBlob
+from .hash import sha256_in_chunks
+from .packages import inspect_package
+from .repodata import RepodataStore
+from .utils import get_platforms
+from .validation import parse_package_filename
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_FORMAT = 1
+MANIFEST_NAME = "snapshot.json"
+PACKAGE_EXTENSIONS = (".tar.bz2", ".conda")
+
+
+class SnapshotConflict(Exception):
+    pass
+
+
+class ChannelSnapshot:
+    """
+    The packages and index files of a channel as of one published index
+    generation, pinned by hardlinks in a directory of their own. Hardlinks
+    copy no data and keep the content of a file even if the channel replaces
+    or deletes it, so the snapshot can be streamed while the channel changes.
+    Pins live in the blob store, outside the channel, and a pinned package is
+    a reference to its blob like any package file, so the snapshot must be
+    released once it is streamed. A lock is held on the pins until then, so
+    that pins left behind by a process that died can be told apart and
+    released by `release_stale_snapshots`.
+    """
+
+    def __init__(
+        self, blob_store: BlobStore, directory: str, manifest: dict, lock: FileLock
+    ) -> None:
+        self.blob_store = blob_store
+        self.directory = directory
+        self.manifest = manifest
+        self._lock = lock
+
+    def parts(self) -> Iterator[bytes | tuple[str, int]]:
+        """
+        The parts of the snapshot as a tar archive: headers and padding as
+        bytes, and the content of files as (path, size), so that it can be
+        sent straight from the file. The manifest comes first, then the
+        packages and then the index files, so that the index files are only
+        replaced on import once every package has arrived.
+        """
+        manifest = json.dumps(self.manifest, indent=2).encode()
+        created = self.manifest["created"]
+        yield _tar_header(MANIFEST_NAME, len(manifest), created) + manifest
+        yield _padding(len(manifest))
+        names = list(self.manifest["index_files"])
+        if self.manifest["includes_packages"]:
+            names = [*self.manifest["packages"], *names]
+        for name in names:
+            path = os.path.join(self.directory, name)
+            size = os.path.getsize(path)
+            yield _tar_header(name, size, created)
+            yield path, size
+            yield _padding(size)
+        yield b"\0" * (2 * tarfile.BLOCKSIZE)
+
+    def release(self) -> None:
+        if not self._lock.is_locked:
+            return
+        try:
+            _release_pins(self.blob_store, self.directory, self.manifest["packages"])
+        finally:
+            self._lock.release()
+            safely_remove_lock_file(self._lock.lock_file)
+
+
+def pin_snapshot(
+    blob_store: BlobStore, channel_dir: str, include_packages=True
+) -> ChannelSnapshot:
+    """
+    Pin the published index files of a channel and the packages they list.
+    Without `include_packages`, the manifest still lists the packages but only
+    the index files are pinned, for peers that have most packages already.
+    Must be called while no index generation is running.
+    """
+    snapshot_dir = os.path.join(blob_store.root, "snapshots", secrets.token_hex(8))
+    os.makedirs(os.path.dirname(snapshot_dir), exist_ok=True)
+    # Released from whichever thread the snapshot is released in
+    lock = FileLock(f"{snapshot_dir}.lock", thread_local=False)
+    lock.acquire()
+    packages: dict[str, dict] = {}
+    index_files: dict[str, int] = {}
+    try:
+        for subdir in sorted(get_platforms()):
+            subdir_dir = os.path.join(channel_dir, subdir)
+            repodata_path = os.path.join(subdir_dir, "repodata.json")
+            if not os.path.isfile(repodata_path):
+                continue
+            # Pin repodata.json before reading it, so that the packages are
+            # those it lists
+            index_files.update(_pin_index_files(channel_dir, snapshot_dir, subdir))
+            with open(os.path.join(snapshot_dir, subdir, "repodata.json"), "rb") as f:
+                repodata = json.load(f)
+            for section in "packages", "packages.conda":
+                for fn, record in repodata.get(section, {}).items():
+                    name = f"{subdir}/{fn}"
+                    path = os.path.join(subdir_dir, fn)
+                    try:
+                        if include_packages:
+                            path = os.path.join(snapshot_dir, name)
+                            os.link(os.path.join(subdir_dir, fn), path)
+                        packages[name] = {
+                            "sha256": record.get("sha256") or sha256_in_chunks(path),
+                            "size": os.path.getsize(path),
+                        }
+                    except FileNotFoundError:
+                        logger.warning("Package %s was deleted, skipping", name)
+        index_files.update(_pin_index_files(channel_dir, snapshot_dir, ""))
+    except BaseException:
+        _release_pins(blob_store, snapshot_dir, packages)
+        lock.release()
+        safely_remove_lock_file(lock.lock_file)
+        raise
+
+    return ChannelSnapshot(
+        blob_store,
+        snapshot_dir,
+        {
+            "format": SNAPSHOT_FORMAT,
+            "created": time.time(),
+            "includes_packages": include_packages,
+            "packages": packages,
+            "index_files": index_files,
+        },
+        lock,
+    )
+
+
+def release_stale_snapshots(blob_store: BlobStore) -> int:
+    """
+    Release the pins of snapshots whose process died before releasing them,
+    so that the blobs they pinned can be dropped. Snapshots that are still
+    being streamed, by any process, are left alone. Returns the number of
+    snapshots released.
+    """
+    snapshots_dir = os.path.join(blob_store.root, "snapshots")
+    try:
+        entries = [entry.path for entry in os.scandir(snapshots_dir) if entry.is_dir()]
+    except FileNotFoundError:
+        return 0
+
+    released = 0
+    for snapshot_dir in entries:
+        lock = FileLock(f"{snapshot_dir}.lock", thread_local=False)
+        try:
+            lock.acquire(blocking=False)
+        except Timeout:
+            continue
+        try:
+            if os.path.isdir(snapshot_dir):
+                logger.info("Releasing stale snapshot %s", snapshot_dir)
+                _release_pins(blob_store, snapshot_dir, {})
+                released += 1
+        finally:
+            lock.release()
+            safely_remove_lock_file(lock.lock_file)
+    return released
+
+
+def _release_pins(blob_store: BlobStore, snapshot_dir: str, packages: dict) -> None:
+    # Pinned packages are released through the blob store, so that blobs that
+    # the channel dropped meanwhile go with their last pin
+    for dirpath, _, filenames in os.walk(snapshot_dir):
+        for filename in filenames:
+            if not filename.endswith(PACKAGE_EXTENSIONS):
+                continue
+            path = os.path.join(dirpath, filename)
+            package = packages.get(os.path.relpath(path, snapshot_dir), {})
+            with suppress(FileNotFoundError):
+                blob_store.release(path, package.get("sha256"))
+    shutil.rmtree(snapshot_dir, ignore_errors=True)
+
+
+def _pin_index_files(channel_dir: str, snapshot_dir: str, subdir: str) -> dict:
+    # Every file of a subdir, or of the channel root, that isn't a package,
+    # hidden, or left over from a write
+    pinned = {}
+    os.makedirs(os.path.join(snapshot_dir, subdir), exist_ok=True)
+    with os.scandir(os.path.join(channel_dir, subdir)) as entries:
+        for entry in entries:
+            if (
+                entry.name.startswith(".")
+                or entry.name.endswith((*PACKAGE_EXTENSIONS, ".lock", ".tmp"))
+                or not entry.is_file()
+            ):
+                continue
+            name = f"{subdir}/{entry.name}" if subdir else entry.name
+            pinned_path = os.path.join(snapshot_dir, name)
+            with suppress(FileNotFoundError):
+                os.link(entry.path, pinned_path)
+                pinned[name] = os.path.getsize(pinned_path)
+    return pinned
+
+
+def _tar_header(name: str, size: int, mtime: float) -> bytes:
+    info = tarfile.TarInfo(name)
+    info.size = size
+    info.mtime = int(mtime)
+    info.mode = 0o644
+    return info.tobuf(format=tarfile.PAX_FORMAT)
+
+
+def _padding(size: int) -> bytes:
+    return b"\0" * (-size % tarfile.BLOCKSIZE)
+
+
+class StagedSnapshot(NamedTuple):
+    channel_dir: str
+    # Channel path -> staged package
+    packages: dict[str, StagedBlob]
+    # Channel path -> staged index file
+    index_files: dict[str, str]
+    staging_dir: str
+    manifest: dict
+
+
+class _ChunkPipe(io.RawIOBase):
+    # Hands the chunks of a tar member from the thread that reads the archive
+    # to the thread that stages the member. The reader moves on to the next
+    # member as soon as all chunks are handed over.
+    def __init__(self, maxsize=16) -> None:
+        self._queue: queue.Queue[bytes] = queue.Queue(maxsize)
+        self._buffer = memoryview(b"")
+        self._eof = False
+        self._aborted = threading.Event()
+
+    def readable(self) -> bool:
+        return True
+
+    def put(self, chunk: bytes) -> None:
+        # Chunks are dropped once the pipe is aborted
+        while not self._aborted.is_set():
+            with suppress(queue.Full):
+                self._queue.put(chunk, timeout=0.1)
+                return
+
+    def readinto(self, buffer) -> int:
+        while not self._buffer and not self._eof:
+            try:
+                chunk = self._queue.get(timeout=0.1)
+            except queue.Empty:
+                if self._aborted.is_set():
+                    raise ValueError("Snapshot import was aborted") from None
+                continue
+            if chunk:
+                self._buffer = memoryview(chunk)
+            else:
+                self._eof = True
+
+        size = min(len(buffer), len(self._buffer))
+        buffer[:size] = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return size
+
+    def abort(self) -> None:
+        self._aborted.set()
+
+
+def stage_snapshot(
+    blob_store: BlobStore,
+    channel_dir: str,
+    fileobj: BinaryIO,
+    max_workers=4,
+    chunk_size=65536,
+) -> StagedSnapshot:
+    """
+    Stage the packages and index files of a snapshot archive. The archive is
+    read once, front to back; each package is hashed, checked against the
+    manifest, inspected and written to the blob store by a pool of workers
+    while the next ones are read. Nothing in the channel changes until the
+    snapshot is committed. Raises `ValueError` if the snapshot is invalid.
+    Snapshots without packages only stage their index files.
+    """
+    staging_dir = os.path.join(
+        channel_dir, ".conda-server", "imports", secrets.token_hex(8)
+    )
+    os.makedirs(staging_dir)
+    futures: dict[str, Future[StagedBlob]] = {}
+    pipes: list[_ChunkPipe] = []
+    index_files: dict[str, str] = {}
+    manifest = None
+    try:
+        with ThreadPoolExecutor(max_workers) as executor:
+            try:
+                with tarfile.open(fileobj=fileobj, mode="r|*") as tar:
+                    for member in tar:
+                        if not member.isfile():
+                            continue
+                        member_file = tar.extractfile(member)
+                        assert member_file is not None
+                        if manifest is None:
+                            if member.name != MANIFEST_NAME:
+                                raise ValueError(
+                                    f"Snapshot must start with {MANIFEST_NAME}"
+                                )
+                            manifest = _read_manifest(member_file)
+                            continue
+
+                        name = member.name
+                        if (
+                            name in manifest["packages"]
+                            and manifest["includes_packages"]
+                        ):
+                            if name in futures:
+                                raise ValueError(f"Duplicate package {name}")
+                            pipe = _ChunkPipe()
+                            pipes.append(pipe)
+                            futures[name] = executor.submit(
+                                _stage_package, blob_store, pipe, name, manifest
+                            )
+                            for chunk in iter(
+                                lambda: member_file.read(chunk_size), b""
+                            ):
+                                pipe.put(chunk)
+                            pipe.put(b"")
+                        elif name in manifest["index_files"]:
+                            staged_path = os.path.join(staging_dir, name)
+                            os.makedirs(os.path.dirname(staged_path), exist_ok=True)
+                            with open(staged_path, "wb") as f:
+                                shutil.copyfileobj(member_file, f)
+                            index_files[os.path.join(channel_dir, name)] = staged_path
+                        else:
+                            raise ValueError(f"File {name} is not in the manifest")
+
+                        # Fail fast instead of reading the rest of a bad archive
+                        for future in futures.values():
+                            if future.done() and (error := future.exception()):
+                                raise error
+            except BaseException:
+                # Workers waiting for chunks that will never come give up
+                for pipe in pipes:
+                    pipe.abort()
+                raise
+
+        if manifest is None:
+            raise ValueError("Snapshot is empty")
+        packages = {
+            os.path.join(channel_dir, name): future.result()
+            for name, future in futures.items()
+        }
+        if manifest["includes_packages"] and (
+            missing := manifest["packages"].keys() - futures.keys()
+        ):
+            raise ValueError(f"Packages missing from snapshot: {', '.join(missing)}")
+        if missing := manifest["index_files"].keys() - {
+            os.path.relpath(path, channel_dir) for path in index_files
+        }:
+            raise ValueError(f"Index files missing from snapshot: {', '.join(missing)}")
+    except BaseException:
+        for future in futures.values():
+            if not future.cancelled() and future.exception() is None:
+                blob_store.discard(future.result())
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        raise
+    return StagedSnapshot(channel_dir, packages, index_files, staging_dir, manifest)
+
+
+def _read_manifest(fileobj: BinaryIO) -> dict:
+    try:
+        manifest = json.load(fileobj)
+    except json.JSONDecodeError as e:
+        raise ValueError(f"Invalid snapshot manifest: {str(e)}") from e
+    if manifest.get("format") != SNAPSHOT_FORMAT:
+        raise ValueError(f"Unsupported snapshot format: {manifest.get('format')}")
+    manifest.setdefault("includes_packages", True)
+    for name in [*manifest["packages"], *manifest["index_files"]]:
+        # Paths in the archive must stay inside the channel
+        subdir, _, filename = name.rpartition("/")
+        if (subdir and subdir not in get_platforms()) or filename in ("", ".", ".."):
+            raise ValueError(f"Invalid path in snapshot: {name}")
+    for name in manifest["index_files"]:
+        # Package files only come in through the packages, which are inspected
+        if name.endswith(PACKAGE_EXTENSIONS):
+            raise ValueError(f"Package file listed as an index file: {name}")
+    for name in manifest["packages"]:
+        subdir, _, filename = name.rpartition("/")
+        if not subdir:
+            raise ValueError(f"Invalid path in snapshot: {name}")
+        parse_package_filename(filename)
+    return manifest
+
+
+def _stage_package(
+    blob_store: BlobStore, pipe: _ChunkPipe, name: str, manifest: dict
+) -> StagedBlob:
+    subdir, _, filename = name.rpartition("/")
+    try:
+        return blob_store.stage(
+            io.BufferedReader(pipe),  # type: ignore
+            expected_digest=manifest["packages"][name]["sha256"],
+            inspect=lambda f: inspect_package(f, filename, subdir),
+        )
+    finally:
+        pipe.abort()
+
+
+def commit_snapshot(
+    blob_store: BlobStore, repodata: RepodataStore, staged: StagedSnapshot
+) -> None:
+    """
+    Link the packages of a staged snapshot into the channel, record their
+    repodata from the metadata extracted while they were staged, and then
+    replace the index files, so that the channel serves the snapshot without
+    being indexed. Raises `SnapshotConflict` if the channel has packages that
+    the snapshot doesn't, as the index files of the snapshot wouldn't list
+    them, and `ValueError` if the snapshot doesn't include its packages.
+    """
+    try:
+        if not staged.manifest["includes_packages"]:
+            raise ValueError("Snapshot doesn't include its packages")
+        extra = []
+        for subdir in get_platforms():
+            subdir_dir = os.path.join(staged.channel_dir, subdir)
+            if not os.path.isdir(subdir_dir):
+                continue
+            with os.scandir(subdir_dir) as entries:
+                extra.extend(
+                    f"{subdir}/{entry.name}"
+                    for entry in entries
+                    if entry.name.endswith(PACKAGE_EXTENSIONS)
+                    and entry.path not in staged.packages
+                )
+        if extra:
+            raise SnapshotConflict(
+                "Channel has packages that are not in the snapshot: "
+                + ", ".join(sorted(extra))
+            )
+
+        for path in staged.packages:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        commit_batch(blob_store, staged.packages)
+        repodata.add_many(
+            {
+                path: metadata
+                for path, staged_blob in staged.packages.items()
+                if (metadata := blob_store.read_metadata(staged_blob.digest))
+                is not None
+            }
+        )
+        replace_index_files(staged.index_files)
+    finally:
+        for staged_blob in staged.packages.values():
+            blob_store.discard(staged_blob)
+        shutil.rmtree(staged.staging_dir, ignore_errors=True)
+
+
+def replace_index_files(index_files: dict[str, str]) -> None:
+    """
+    Move staged index files into place. Each file is replaced atomically,
+    repodata.json last, so that clients never see an index listing packages
+    that aren't there yet.
+    """
+    for path in sorted(index_files, key=lambda path: path.endswith("repodata.json")):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(index_files[path], path)
@@ -0,0 +1,98 @@
+import fnmatch
+import functools
+import re
+from typing import Callable
+
+from .validation import version_key
+
+DEPENDENCY_REGEX = re.compile(r"^([^\s<>=!~]+)\s*(.*)$")
+CONSTRAINT_REGEX = re.compile(r"^(==|!=|>=|<=|~=|>|<|=)?(.+)$")
+
+VersionMatcher = Callable[[str], bool]
+
+
+@functools.lru_cache(maxsize=65536)
+def parse_dependency(spec: str) -> tuple[str, Callable[[str, str], bool]]:
+    """
+    Parse a dependency of a package record, e.g. `python >=3.11,<3.12.0a0`,
+    into the package name and a function that checks whether a version and
+    build of that package satisfy it. Versions are compared under the
+    configured versioning scheme. Constraints that can't be compared are
+    treated as satisfied.
+    """
+    match_ = DEPENDENCY_REGEX.match(spec.strip())
+    if not match_:
+        raise ValueError(f"Invalid dependency: {spec}")
+    name, rest = match_.groups()
+    parts = rest.split()
+    version_matcher = _parse_version_spec(parts[0]) if parts else None
+    build_pattern = parts[1] if len(parts) > 1 else None
+
+    def matches(package_version: str, package_build: str) -> bool:
+        if version_matcher is not None and not version_matcher(package_version):
+            return False
+        if build_pattern is not None and not fnmatch.fnmatchcase(
+            package_build, build_pattern
+        ):
+            return False
+        return True
+
+    return name, matches
+
+
+def _parse_version_spec(version_spec: str) -> VersionMatcher:
+    # `|` separates alternatives, each of which is a `,` separated conjunction
+    alternatives = [
+        [_parse_constraint(constraint) for constraint in alternative.split(",")]
+        for alternative in version_spec.split("|")
+    ]
+    return lambda package_version: any(
+        all(constraint(package_version) for constraint in alternative)
+        for alternative in alternatives
+    )
+
+
+def _parse_constraint(constraint: str) -> VersionMatcher:
+    match_ = CONSTRAINT_REGEX.match(constraint.strip())
+    if not match_:
+        return lambda _: True
+    operator, version = match_.groups()
+
+    # `=1.2` and `1.2.*` match any version starting with 1.2
+    if operator == "=" or (operator is None and version.endswith("*")):
+        prefix = version.rstrip("*").rstrip(".")
+        return lambda package_version: package_version == prefix or (
+            package_version.startswith(f"{prefix}.")
+        )
+    version = version.rstrip("*").rstrip(".")
+
+    try:
+        key = version_key(version)
+    except ValueError:
+        return lambda _: True
+
+    if operator == "~=":
+        # Compatible release, e.g. ~=1.2.3 is >=1.2.3,==1.2.*
+        prefix = version.rsplit(".", 1)[0]
+        return lambda package_version: _compare(
+            package_version, lambda other: other >= key
+        ) and (package_version.startswith(f"{prefix}."))
+
+    comparisons: dict[str | None, Callable] = {
+        None: lambda other: other == key,
+        "==": lambda other: other == key,
+        "!=": lambda other: other != key,
+        ">=": lambda other: other >= key,
+        "<=": lambda other: other <= key,
+        ">": lambda other: other > key,
+        "<": lambda other: other < key,
+    }
+    comparison = comparisons[operator]
+    return lambda package_version: _compare(package_version, comparison)
+
+
+def _compare(package_version: str, comparison: Callable) -> bool:
+    try:
+        return comparison(version_key(package_version))
+    except (ValueError, TypeError):
+        return True
@@ -0,0 +1,49 @@
+import io
+from typing import AsyncIterator
+
+import anyio.from_thread
+from fastapi.concurrency import run_in_threadpool
+
+
+class AsyncIteratorReader(io.RawIOBase):
+    """
+    Blocking file-like reader over an async byte iterator, e.g. a request body
+    stream. Must be read from a worker thread started with `run_in_threadpool`,
+    which lets it hand each read back to the event loop.
+    """
+
+    def __init__(self, iterator: AsyncIterator[bytes]) -> None:
+        self._iterator = iterator
+        self._buffer = memoryview(b"")
+        self._eof = False
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        while not self._buffer and not self._eof:
+            try:
+                self._buffer = memoryview(anyio.from_thread.run(self._next_chunk))
+            except StopAsyncIteration:
+                self._eof = True
+
+        size = min(len(buffer), len(self._buffer))
+        buffer[:size] = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return size
+
+    async def _next_chunk(self) -> bytes:
+        return await self._iterator.__anext__()
+
+
+def open_async_iterator(
+    iterator: AsyncIterator[bytes], buffer_size=65536
+) -> io.BufferedReader:
+    return io.BufferedReader(AsyncIteratorReader(iterator), buffer_size=buffer_size)
+
+
+async def iter_file(path: str, chunk_size=65536) -> AsyncIterator[bytes]:
+    # Reads in worker threads, so that a slow disk doesn't block the event loop
+    with open(path, "rb") as f:
+        while chunk := await run_in_threadpool(f.read, chunk_size):
+            yield chunk
@@ -0,0 +1,199 @@
+import math
+
+from fastapi.responses import JSONResponse
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from .utils import get_max_upload_size, get_platforms
+
+
+class UploadTooLarge(Exception):
+    def __init__(self, max_size: int) -> None:
+        super().__init__(f"Upload exceeds the size limit of {max_size} bytes")
+        self.max_size = max_size
+
+
+class UploadsBusy(Exception):
+    def __init__(self, retry_after: float) -> None:
+        super().__init__("Too many uploads in progress")
+        self.retry_after = retry_after
+
+
+class UploadSlot:
+    """The share of an upload in the bytes in flight of an `UploadLimiter`."""
+
+    def __init__(self, limiter: "UploadLimiter") -> None:
+        self._limiter = limiter
+        self.reserved = 0
+
+    def reserve(self, size: int) -> None:
+        """
+        Grow the reservation of the upload to `size` bytes. Raises
+        `UploadsBusy` if that would exceed the bytes in flight.
+        """
+        if size > self.reserved:
+            self._limiter._reserve(size - self.reserved)
+            self.reserved = size
+
+    def release(self) -> None:
+        self._limiter._release(self)
+
+
+class UploadLimiter:
+    """
+    Caps the number of concurrent uploads and the bytes they have in flight.
+    Uploads over either cap are refused rather than queued, so that clients
+    back off instead of the server running out of disk or memory. A cap of 0
+    disables it.
+    """
+
+    def __init__(
+        self, max_concurrent: int = 0, max_bytes: int = 0, retry_after: float = 5.0
+    ) -> None:
+        self._max_concurrent = max_concurrent
+        self._max_bytes = max_bytes
+        self._retry_after = retry_after
+        self._active = 0
+        self._bytes = 0
+
+    @property
+    def active(self) -> int:
+        return self._active
+
+    @property
+    def bytes_in_flight(self) -> int:
+        return self._bytes
+
+    def acquire(self, size: int = 0) -> UploadSlot:
+        """
+        Start an upload, reserving its expected size if it is known. Raises
+        `UploadsBusy` if the upload can't start now.
+        """
+        if self._max_concurrent and self._active >= self._max_concurrent:
+            raise UploadsBusy(self._retry_after)
+        slot = UploadSlot(self)
+        slot.reserve(size)
+        self._active += 1
+        return slot
+
+    def _reserve(self, size: int) -> None:
+        if self._max_bytes and self._bytes + size > self._max_bytes:
+            raise UploadsBusy(self._retry_after)
+        self._bytes += size
+
+    def _release(self, slot: UploadSlot) -> None:
+        self._bytes -= slot.reserved
+        slot.reserved = 0
+        self._active -= 1
+
+
+def upload_subdir(method: str, path: str) -> str | None:
+    """The subdir that a request uploads to, or None if it isn't an upload."""
+    segments = path.rstrip("/").split("/")
+    if method == "PUT" and len(segments) >= 3:
+        subdir = segments[-2]
+    elif method == "POST" and len(segments) >= 3 and segments[-1] == "batch":
+        subdir = segments[-2]
+    else:
+        return None
+    return subdir if subdir in get_platforms() else None
+
+
+class UploadLimitMiddleware:
+    """
+    Enforces the upload limits while request bodies stream in, before they
+    reach the routes. Single package uploads are limited to the maximum
+    package size of their subdir; a body is refused with a 413 up front if
+    its Content-Length is too large, and aborted as soon as it crosses the
+    limit otherwise. Uploads over the caps of `upload_limiter` are refused
+    with a 503 and a Retry-After header.
+    """
+
+    def __init__(self, app: ASGIApp, upload_limiter: UploadLimiter) -> None:
+        self._app = app
+        self._upload_limiter = upload_limiter
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        subdir = (
+            upload_subdir(scope["method"], scope["path"])
+            if scope["type"] == "http"
+            else None
+        )
+        if subdir is None:
+            await self._app(scope, receive, send)
+            return
+
+        # Batches hold many packages, so their members are checked instead
+        max_size = get_max_upload_size(subdir) if scope["method"] == "PUT" else None
+        content_length = _content_length(scope)
+        try:
+            if max_size is not None and (content_length or 0) > max_size:
+                raise UploadTooLarge(max_size)
+            slot = self._upload_limiter.acquire(content_length or 0)
+        except (UploadTooLarge, UploadsBusy) as e:
+            await _error_response(e)(scope, receive, send)
+            return
+
+        received = 0
+        error: UploadTooLarge | UploadsBusy | None = None
+        response_started = False
+
+        async def limited_receive() -> Message:
+            nonlocal received, error
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                try:
+                    if max_size is not None and received > max_size:
+                        raise UploadTooLarge(max_size)
+                    slot.reserve(received)
+                except (UploadTooLarge, UploadsBusy) as e:
+                    # Raising aborts the route, which removes its temp files
+                    error = e
+                    raise
+            return message
+
+        async def guarded_send(message: Message) -> None:
+            nonlocal response_started
+            # Once the body is aborted, the route's own error response is
+            # replaced by the limit's
+            if error is not None and not response_started:
+                return
+            response_started = response_started or (
+                message["type"] == "http.response.start"
+            )
+            await send(message)
+
+        try:
+            await self._app(scope, limited_receive, guarded_send)
+        except Exception:
+            if error is None or response_started:
+                raise
+        finally:
+            slot.release()
+        if error is not None and not response_started:
+            await _error_response(error)(scope, receive, send)
+
+
+def _content_length(scope: Scope) -> int | None:
+    for name, value in scope["headers"]:
+        if name == b"content-length":
+            try:
+                return int(value)
+            except ValueError:
+                return None
+    return None
+
+
+def _error_response(error: UploadTooLarge | UploadsBusy) -> JSONResponse:
+    if isinstance(error, UploadTooLarge):
+        return JSONResponse(
+            {"detail": str(error)},
+            status_code=413,
+            # The rest of the body is not read
+            headers={"Connection": "close"},
+        )
+    return JSONResponse(
+        {"detail": str(error)},
+        status_code=503,
+        headers={"Retry-After": str(math.ceil(error.retry_after))},
+    )
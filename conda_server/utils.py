@@ -29,3 +29,206 @@ def get_channel_dir() -> str:
     return os.getenv(
         "CONDA_CHANNEL_DIR", str(Path.home() / ".conda-server" / "channel")
     )
+
+
+@functools.lru_cache(maxsize=1)
+def get_blob_dir() -> str:
+    return os.getenv("CONDA_SERVER_BLOB_DIR", os.path.join(get_channel_dir(), ".blobs"))
+
+
+@functools.lru_cache(maxsize=1)
+def get_channels_dir() -> str:
+    return os.getenv(
+        "CONDA_SERVER_CHANNELS_DIR",
+        os.path.join(os.path.dirname(get_channel_dir()), "channels"),
+    )
+
+
+@functools.lru_cache(maxsize=1)
+def get_max_concurrent_indexing() -> int:
+    return int(os.getenv("CONDA_SERVER_MAX_CONCURRENT_INDEXING", "2"))
+
+
+@functools.lru_cache(maxsize=1)
+def get_channel_idle_timeout() -> float:
+    return float(os.getenv("CONDA_SERVER_CHANNEL_IDLE_TIMEOUT", "600"))
+
+
+@functools.lru_cache(maxsize=None)
+def get_upstream_url(channel_name: str | None) -> str | None:
+    # Named channels are configured with e.g. $CONDA_SERVER_UPSTREAM_URL_CONDA_FORGE
+    if channel_name is None:
+        return os.getenv("CONDA_SERVER_UPSTREAM_URL")
+    suffix = "".join(c if c.isalnum() else "_" for c in channel_name.upper())
+    return os.getenv(f"CONDA_SERVER_UPSTREAM_URL_{suffix}")
+
+
+@functools.lru_cache(maxsize=1)
+def get_upstream_ttl() -> float:
+    return float(os.getenv("CONDA_SERVER_UPSTREAM_TTL", "60"))
+
+
+@functools.lru_cache(maxsize=1)
+def get_downloads_db() -> str:
+    return os.getenv(
+        "CONDA_SERVER_DOWNLOADS_DB",
+        os.path.join(get_channel_dir(), ".conda-server", "downloads.db"),
+    )
+
+
+@functools.lru_cache(maxsize=1)
+def get_downloads_flush_interval() -> float:
+    # At most this many seconds of download counts are lost in a crash
+    return float(os.getenv("CONDA_SERVER_DOWNLOADS_FLUSH_INTERVAL", "10"))
+
+
+@functools.lru_cache(maxsize=1)
+def get_downloads_flush_threshold() -> int:
+    return int(os.getenv("CONDA_SERVER_DOWNLOADS_FLUSH_THRESHOLD", "1000"))
+
+
+@functools.lru_cache(maxsize=1)
+def get_warmup_bytes() -> int:
+    # Set to 0 to disable warming the page cache
+    return int(os.getenv("CONDA_SERVER_WARMUP_BYTES", str(512 * 2**20)))
+
+
+@functools.lru_cache(maxsize=1)
+def get_warmup_rate() -> int:
+    return int(os.getenv("CONDA_SERVER_WARMUP_RATE", str(32 * 2**20)))
+
+
+@functools.lru_cache(maxsize=1)
+def get_rate_limit_requests() -> float:
+    # Requests per second per client, 0 for no limit
+    return float(os.getenv("CONDA_SERVER_RATE_LIMIT_REQUESTS", "0"))
+
+
+@functools.lru_cache(maxsize=1)
+def get_rate_limit_request_burst() -> float | None:
+    burst = os.getenv("CONDA_SERVER_RATE_LIMIT_REQUEST_BURST")
+    return float(burst) if burst else None
+
+
+@functools.lru_cache(maxsize=1)
+def get_rate_limit_bandwidth() -> float:
+    # Bytes per second per client, 0 for no limit
+    return float(os.getenv("CONDA_SERVER_RATE_LIMIT_BANDWIDTH", "0"))
+
+
+@functools.lru_cache(maxsize=1)
+def get_rate_limit_bandwidth_burst() -> float | None:
+    burst = os.getenv("CONDA_SERVER_RATE_LIMIT_BANDWIDTH_BURST")
+    return float(burst) if burst else None
+
+
+@functools.lru_cache(maxsize=1)
+def get_rate_limit_db() -> str | None:
+    # Share the limits between the workers of a server through this database
+    return os.getenv("CONDA_SERVER_RATE_LIMIT_DB")
+
+
+@functools.lru_cache(maxsize=None)
+def get_max_upload_size(subdir: str) -> int | None:
+    # Subdirs can override the limit with e.g. $CONDA_SERVER_MAX_UPLOAD_SIZE_LINUX_64
+    suffix = "".join(c if c.isalnum() else "_" for c in subdir.upper())
+    size = os.getenv(f"CONDA_SERVER_MAX_UPLOAD_SIZE_{suffix}") or os.getenv(
+        "CONDA_SERVER_MAX_UPLOAD_SIZE"
+    )
+    return int(size) if size and int(size) > 0 else None
+
+
+@functools.lru_cache(maxsize=1)
+def get_max_concurrent_uploads() -> int:
+    return int(os.getenv("CONDA_SERVER_MAX_CONCURRENT_UPLOADS", "0"))
+
+
+@functools.lru_cache(maxsize=1)
+def get_max_upload_bytes_in_flight() -> int:
+    return int(os.getenv("CONDA_SERVER_MAX_UPLOAD_BYTES_IN_FLIGHT", "0"))
+
+
+@functools.lru_cache(maxsize=1)
+def get_api_keys_file() -> str | None:
+    # Without a keys file, no request requires an API key
+    return os.getenv("CONDA_SERVER_API_KEYS_FILE")
+
+
+@functools.lru_cache(maxsize=1)
+def get_auth_download() -> bool:
+    return os.getenv("CONDA_SERVER_AUTH_DOWNLOAD", "0").lower() in ("1", "true")
+
+
+@functools.lru_cache(maxsize=1)
+def get_auth_upload() -> bool:
+    return os.getenv("CONDA_SERVER_AUTH_UPLOAD", "1").lower() in ("1", "true")
+
+
+@functools.lru_cache(maxsize=1)
+def get_watch_mode() -> str:
+    # "poll" for network file systems that don't deliver change notifications
+    return os.getenv("CONDA_SERVER_WATCH_MODE", "notify")
+
+
+@functools.lru_cache(maxsize=1)
+def get_watch_poll_interval() -> float:
+    return float(os.getenv("CONDA_SERVER_WATCH_POLL_INTERVAL", "2"))
+
+
+@functools.lru_cache(maxsize=1)
+def get_watch_rescan_interval() -> float:
+    # Seconds between scans for changes that notifications missed, 0 for never
+    return float(os.getenv("CONDA_SERVER_WATCH_RESCAN_INTERVAL", "300"))
+
+
+@functools.lru_cache(maxsize=1)
+def get_replicate_from() -> str | None:
+    # URL of the leader to replicate, which makes this node a read-only follower
+    return os.getenv("CONDA_SERVER_REPLICATE_FROM")
+
+
+@functools.lru_cache(maxsize=1)
+def get_replication_api_key() -> str | None:
+    # Needs download access to every channel of the leader, if it requires one
+    return os.getenv("CONDA_SERVER_REPLICATION_API_KEY")
+
+
+@functools.lru_cache(maxsize=1)
+def get_replication_wait() -> float:
+    # Seconds a follower waits for changes in each request to the leader
+    return float(os.getenv("CONDA_SERVER_REPLICATION_WAIT", "30"))
+
+
+@functools.lru_cache(maxsize=1)
+def get_replication_db() -> str:
+    return os.getenv(
+        "CONDA_SERVER_REPLICATION_DB",
+        os.path.join(get_channel_dir(), ".conda-server", "replication.db"),
+    )
+
+
+@functools.lru_cache(maxsize=1)
+def get_replication_log_size() -> int:
+    return int(os.getenv("CONDA_SERVER_REPLICATION_LOG_SIZE", "100000"))
+
+
+@functools.lru_cache(maxsize=1)
+def get_replication_state_file() -> str:
+    return os.path.join(get_channel_dir(), ".conda-server", "replication.json")
+
+
+@functools.lru_cache(maxsize=1)
+def get_listing_page_size() -> int:
+    # Packages per page of the HTML listings of subdirs
+    return int(os.getenv("CONDA_SERVER_LISTING_PAGE_SIZE", "500"))
+
+
+@functools.lru_cache(maxsize=1)
+def get_event_buffer_size() -> int:
+    # Events kept for subscribers that fall behind or resume
+    return int(os.getenv("CONDA_SERVER_EVENT_BUFFER_SIZE", "10000"))
+
+
+@functools.lru_cache(maxsize=1)
+def get_event_keepalive() -> float:
+    return float(os.getenv("CONDA_SERVER_EVENT_KEEPALIVE", "15"))
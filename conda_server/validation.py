@@ -1,15 +1,13 @@
+import functools
 import os
 import re
+from typing import Any, NamedTuple
 
-from fastapi import HTTPException
 from packaging import version
 
-from .utils import get_platforms
-
 FORMAT_REGEX = re.compile(
     r"^(?P<name>.+)-(?P<version>[^-]+)-(?P<build>[^-\.]+)\.(?P<file_ext>.+)$"
 )
-PLATFORM_REGEX = rf"^({'|'.join(get_platforms())})$"
 PACKAGE_NAME_REGEX = re.compile(r"^[a-z0-9_.-]+$")
 # https://semver.org/#is-there-a-suggested-regular-expression-regex-to-check-a-semver-string
 SEMVER_REGEX = re.compile(
@@ -18,25 +16,75 @@ SEMVER_REGEX = re.compile(
 PEP440_VERSION_REGEX = re.compile(version.VERSION_PATTERN, re.VERBOSE | re.IGNORECASE)
 PACKAGE_BUILD_REGEX = re.compile(r"^[a-z0-9_]+$")
 FILE_EXTENSION_REGEX = re.compile(r"^(tar\.bz2|conda)$")
+# FORMAT_REGEX with the name, build and extension rules folded in, so that a
+# file name is split and checked in one pass. Only the version is left to
+# VERSION_REGEX.
+PACKAGE_FILENAME_REGEX = re.compile(
+    r"^(?P<name>[a-z0-9_.-]+)-(?P<version>[^-]+)-(?P<build>[a-z0-9_]+)"
+    r"\.(?P<file_ext>tar\.bz2|conda)$"
+)
+SHA256_REGEX = r"^[0-9a-f]{64}$"
 
 VERSION_REGEX = (
     SEMVER_REGEX if bool(os.getenv("CONDA_SERVER_USE_SEMVER")) else PEP440_VERSION_REGEX
 )
 
 
-def validate_package_name(filename: str) -> tuple[str, str, str, str]:
-    match_ = FORMAT_REGEX.match(filename)
+class PackageFilename(NamedTuple):
+    name: str
+    version: str
+    build: str
+    file_extension: str
+
+
+def parse_package_filename(filename: str) -> PackageFilename:
+    """
+    Split a package file name into its name, version, build and extension.
+    Raises `ValueError` if the file name is invalid. Results are cached, as the
+    same file names are parsed over and over by requests.
+    """
+    parsed = _parse_package_filename(filename, VERSION_REGEX)
+    if parsed is None:
+        raise ValueError(f"Invalid package file name format: {filename}")
+    return parsed
+
+
+@functools.lru_cache(maxsize=8192)
+def _parse_package_filename(
+    filename: str, version_regex: re.Pattern[str]
+) -> PackageFilename | None:
+    # Invalid file names are cached as None, as exceptions aren't cached
+    match_ = PACKAGE_FILENAME_REGEX.match(filename)
+    if not match_ or not version_regex.match(match_["version"]):
+        return None
+    return PackageFilename._make(match_.groups())
+
+
+def version_key(package_version: str) -> Any:
+    """
+    Sort key of a package version under the configured versioning scheme.
+    Raises `ValueError` if the version does not follow the scheme.
+    """
+    if VERSION_REGEX is not SEMVER_REGEX:
+        return version.Version(package_version)
+
+    match_ = SEMVER_REGEX.match(package_version)
     if not match_:
-        raise HTTPException(status_code=400, detail="Invalid package file name format")
+        raise ValueError(f"Invalid semantic version: {package_version}")
+    major, minor, patch, prerelease, _ = match_.groups()
 
-    package_name, package_version, package_build, file_extension = match_.groups()
+    # A release has a higher precedence than its pre-releases. Numeric
+    # identifiers have a lower precedence than alphanumeric ones.
+    if prerelease is None:
+        return int(major), int(minor), int(patch), (1,)
+    identifiers = tuple(
+        (0, int(identifier), "") if identifier.isdigit() else (1, 0, identifier)
+        for identifier in prerelease.split(".")
+    )
+    return int(major), int(minor), int(patch), (0, identifiers)
 
-    if (
-        not PACKAGE_NAME_REGEX.match(package_name)
-        or not VERSION_REGEX.match(package_version)
-        or not PACKAGE_BUILD_REGEX.match(package_build)
-        or not FILE_EXTENSION_REGEX.match(file_extension)
-    ):
-        raise HTTPException(status_code=400, detail="Invalid package file name format")
 
-    return package_name, package_version, package_build, file_extension
+def build_number(package_build: str) -> int:
+    # Conda build strings end with the build number, e.g. py311_0
+    _, _, number = package_build.rpartition("_")
+    return int(number) if number.isdigit() else 0
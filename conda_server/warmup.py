@@ -0,0 +1,168 @@
+import asyncio
+import logging
+import os
+import time
+from contextlib import suppress
+
+from fastapi.concurrency import run_in_threadpool
+
+from .channels import Channel
+from .downloads import DownloadCounter
+from .utils import get_platforms
+
+logger = logging.getLogger(__name__)
+
+# Index files in the order clients are most likely to fetch them
+INDEX_FILES = ("repodata.json.zst", "current_repodata.json", "repodata.json")
+# Popularity is judged by the downloads of the last week
+POPULARITY_WINDOW = 7 * 24 * 3600
+
+
+class CacheWarmer:
+    """
+    Prefetches the index files and the most downloaded packages of a channel
+    into the OS page cache, so that the first requests after a restart or an
+    index generation don't hit a cold disk. At most `budget` bytes are
+    prefetched per run, at no more than `rate` bytes per second, so that
+    warming doesn't compete with live traffic.
+    """
+
+    def __init__(
+        self,
+        download_counter: DownloadCounter,
+        budget: int,
+        rate: int,
+        chunk_size=4 * 2**20,
+        max_packages=1000,
+    ) -> None:
+        self._download_counter = download_counter
+        self._budget = budget
+        self._rate = rate
+        self._chunk_size = chunk_size
+        self._max_packages = max_packages
+        self._tasks: dict[str | None, asyncio.Task[None]] = {}
+        self._rerun: set[str | None] = set()
+
+    @property
+    def enabled(self) -> bool:
+        return self._budget > 0
+
+    def attach(self, channel: Channel) -> None:
+        """Warm a channel now and after each of its index generations."""
+        if not self.enabled:
+            return
+        channel.index_manager.add_generation_listener(
+            lambda subdirs: self.schedule(channel)
+        )
+        self.schedule(channel)
+
+    def schedule(self, channel: Channel) -> None:
+        # A generation during a run warms the channel again once it finishes
+        if channel.name in self._tasks:
+            self._rerun.add(channel.name)
+            return
+        task = asyncio.create_task(self._warm_until_done(channel))
+        self._tasks[channel.name] = task
+
+    async def warm(self, channel: Channel) -> int:
+        """Prefetch the files of a channel. Returns the number of bytes."""
+        paths = await run_in_threadpool(self.select_files, channel)
+        return await self.prefetch(paths)
+
+    def select_files(self, channel: Channel) -> list[str]:
+        subdirs = sorted(
+            subdir
+            for subdir in get_platforms()
+            if os.path.isdir(os.path.join(channel.directory, subdir))
+        )
+        paths = [
+            os.path.join(channel.directory, subdir, filename)
+            for filename in INDEX_FILES
+            for subdir in subdirs
+        ]
+        paths.extend(
+            os.path.join(channel.directory, subdir, fn)
+            for subdir, fn, _ in self._download_counter.most_downloaded(
+                channel.name,
+                since=time.time() - POPULARITY_WINDOW,
+                limit=self._max_packages,
+            )
+        )
+        return paths
+
+    async def prefetch(self, paths: list[str]) -> int:
+        """
+        Prefetch files in order until the budget is spent. Files that don't
+        fit in the remaining budget are skipped.
+        """
+        remaining = self._budget
+        prefetched = 0
+        for path in paths:
+            try:
+                f = await run_in_threadpool(open, path, "rb")
+            except FileNotFoundError:
+                continue
+            except OSError as e:
+                logger.warning("Prefetching %s failed: %s", path, e)
+                continue
+            with f:
+                size = os.fstat(f.fileno()).st_size
+                if size > remaining:
+                    continue
+                try:
+                    await self._prefetch_file(f.fileno(), size)
+                except OSError as e:
+                    logger.warning("Prefetching %s failed: %s", path, e)
+                    continue
+            remaining -= size
+            prefetched += size
+        return prefetched
+
+    async def _prefetch_file(self, fd: int, size: int) -> None:
+        # Each chunk is read in a worker thread of its own, and the pauses
+        # between chunks don't hold a thread that requests could use
+        for offset in range(0, size, self._chunk_size):
+            length = min(self._chunk_size, size - offset)
+            started = time.monotonic()
+            await run_in_threadpool(_read_ahead, fd, offset, length)
+            # Pace the reads to the rate limit
+            delay = length / self._rate - (time.monotonic() - started)
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+    async def _warm_until_done(self, channel: Channel) -> None:
+        try:
+            while True:
+                self._rerun.discard(channel.name)
+                try:
+                    prefetched = await self.warm(channel)
+                except Exception as e:  # pylint: disable=broad-except
+                    logger.error("Warming channel %s failed: %s", channel.name, e)
+                else:
+                    logger.info(
+                        "Prefetched %d bytes of channel %s into the page cache",
+                        prefetched,
+                        channel.name or "<default>",
+                    )
+                if channel.name not in self._rerun:
+                    return
+        finally:
+            del self._tasks[channel.name]
+
+    async def __aenter__(self) -> "CacheWarmer":
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback) -> None:
+        for task in list(self._tasks.values()):
+            task.cancel()
+            with suppress(asyncio.CancelledError):
+                await task
+        self._rerun.clear()
+
+
+def _read_ahead(fd: int, offset: int, length: int) -> None:
+    if hasattr(os, "posix_fadvise"):
+        # Asks the kernel to read the range ahead without copying it
+        os.posix_fadvise(fd, offset, length, os.POSIX_FADV_WILLNEED)
+    else:
+        os.pread(fd, length, offset)
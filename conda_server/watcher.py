@@ -0,0 +1,253 @@
+import asyncio
+import logging
+import os
+import time
+from contextlib import suppress
+from typing import Iterable
+
+from fastapi.concurrency import run_in_threadpool
+from watchfiles import Change, awatch
+
+from .utils import get_platforms
+
+logger = logging.getLogger(__name__)
+
+PACKAGE_EXTENSIONS = (".tar.bz2", ".conda")
+
+# path -> (inode, size, mtime_ns) of the package files of a channel
+Snapshot = dict[str, tuple[int, int, int]]
+
+
+def merge_change(previous: Change | None, change: Change) -> Change | None:
+    """
+    The net change of a path that saw `previous` and then `change`, or None
+    if the two cancel out.
+    """
+    if previous is None:
+        return change
+    if previous == Change.added:
+        return None if change == Change.deleted else Change.added
+    return Change.deleted if change == Change.deleted else Change.modified
+
+
+class ChangeQueue:
+    """
+    Changes waiting to be indexed, at most one per path. Putting never blocks:
+    a path that changes again before it is taken merges into its pending
+    change, so the queue is bounded by the number of files in the channel
+    rather than by the rate of events.
+    """
+
+    def __init__(self) -> None:
+        self._changes: dict[str, Change] = {}
+        self._ready = asyncio.Event()
+        self._closed = False
+
+    def __len__(self) -> int:
+        return len(self._changes)
+
+    def put(self, change: Change, path: str) -> None:
+        path = os.path.abspath(path)
+        merged = merge_change(self._changes.pop(path, None), change)
+        if merged is not None:
+            self._changes[path] = merged
+            self._ready.set()
+
+    def close(self) -> None:
+        self._closed = True
+        self._ready.set()
+
+    async def get(self) -> set[tuple[Change, str]] | None:
+        """
+        Take all pending changes, waiting for some if there are none. Returns
+        None once the queue is closed and empty.
+        """
+        while not self._changes:
+            if self._closed:
+                return None
+            self._ready.clear()
+            await self._ready.wait()
+        changes, self._changes = self._changes, {}
+        return {(change, path) for path, change in changes.items()}
+
+
+def scan_channel_dir(channel_dir: str) -> Snapshot:
+    # Packages only live directly in the subdirs, so there is no need to walk
+    # the whole tree
+    snapshot: Snapshot = {}
+    for subdir in get_platforms():
+        try:
+            entries = list(os.scandir(os.path.join(channel_dir, subdir)))
+        except (FileNotFoundError, NotADirectoryError):
+            continue
+        for entry in entries:
+            if not entry.name.endswith(PACKAGE_EXTENSIONS):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            snapshot[entry.path] = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+    return snapshot
+
+
+def update_snapshot(snapshot: Snapshot, channel_dir: str, paths: Iterable[str]) -> None:
+    # Brings the entries of changed paths up to date, so that rescans don't
+    # report changes that were already delivered
+    subdir_dirs = {os.path.join(channel_dir, subdir) for subdir in get_platforms()}
+    for path in paths:
+        if (
+            not path.endswith(PACKAGE_EXTENSIONS)
+            or os.path.dirname(path) not in subdir_dirs
+        ):
+            continue
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            snapshot.pop(path, None)
+            continue
+        snapshot[path] = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+
+def diff_snapshots(old: Snapshot, new: Snapshot) -> set[tuple[Change, str]]:
+    changes = {(Change.deleted, path) for path in old.keys() - new.keys()}
+    for path, state in new.items():
+        previous = old.get(path)
+        if previous is None:
+            changes.add((Change.added, path))
+        elif previous != state:
+            changes.add((Change.modified, path))
+    return changes
+
+
+class ChannelWatcher:
+    """
+    Produces the package file changes of a channel directory into a
+    `ChangeQueue`. In "notify" mode changes come from file system
+    notifications, which also bring the snapshot up to date, and the
+    directory is diffed against it to recover events lost on the way:
+    every `rescan_interval` seconds, after a burst of events large enough
+    to have overflowed the kernel's queue, and after the notification
+    backend fails. In "poll" mode, for network file systems that don't
+    deliver notifications, the directory is diffed every `poll_interval`
+    seconds instead.
+    """
+
+    def __init__(
+        self,
+        channel_dir: str,
+        mode="notify",
+        poll_interval=2.0,
+        rescan_interval=300.0,
+        overflow_threshold: int | None = None,
+    ) -> None:
+        self._channel_dir = os.path.abspath(channel_dir)
+        self._mode = mode
+        self._poll_interval = poll_interval
+        self._rescan_interval = rescan_interval
+        self._overflow_threshold = overflow_threshold or _max_queued_events()
+        self._snapshot: Snapshot = {}
+
+    async def run(self, queue: ChangeQueue, stop_event: asyncio.Event) -> None:
+        """Watch until `stop_event` is set, then close the queue."""
+        try:
+            self._snapshot = await run_in_threadpool(
+                scan_channel_dir, self._channel_dir
+            )
+            if self._mode == "poll":
+                await self._poll(queue, stop_event)
+            else:
+                await self._notify(queue, stop_event)
+        finally:
+            queue.close()
+
+    async def rescan(self, queue: ChangeQueue) -> None:
+        snapshot = await run_in_threadpool(scan_channel_dir, self._channel_dir)
+        for change, path in diff_snapshots(self._snapshot, snapshot):
+            queue.put(change, path)
+        self._snapshot = snapshot
+
+    async def _poll(self, queue: ChangeQueue, stop_event: asyncio.Event) -> None:
+        while True:
+            with suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(stop_event.wait(), self._poll_interval)
+            if stop_event.is_set():
+                return
+            await self.rescan(queue)
+
+    async def _notify(self, queue: ChangeQueue, stop_event: asyncio.Event) -> None:
+        next_rescan = time.monotonic() + self._rescan_interval
+        needs_rescan = False
+        while not stop_event.is_set():
+            watch_filter = FileExtensionFilter(PACKAGE_EXTENSIONS, self._channel_dir)
+            try:
+                # Timeouts yield empty batches, so that rescans are due even
+                # when nothing happens
+                async for changes in awatch(
+                    self._channel_dir,
+                    stop_event=stop_event,
+                    watch_filter=watch_filter,
+                    rust_timeout=1000,
+                    yield_on_timeout=True,
+                ):
+                    for change, path in changes:
+                        queue.put(change, path)
+                    if changes:
+                        await run_in_threadpool(
+                            update_snapshot,
+                            self._snapshot,
+                            self._channel_dir,
+                            {os.path.abspath(path) for _, path in changes},
+                        )
+                    if watch_filter.seen >= self._overflow_threshold:
+                        logger.warning(
+                            "%d changes in %s may have overflowed the event queue",
+                            watch_filter.seen,
+                            self._channel_dir,
+                        )
+                        needs_rescan = True
+                    watch_filter.seen = 0
+                    if self._rescan_interval and time.monotonic() >= next_rescan:
+                        needs_rescan = True
+                    if needs_rescan:
+                        await self.rescan(queue)
+                        needs_rescan = False
+                        next_rescan = time.monotonic() + self._rescan_interval
+            except Exception as e:  # pylint: disable=broad-except
+                # Changes until the watcher is back are found by a rescan once
+                # it is
+                logger.error("Watching %s failed: %s", self._channel_dir, e)
+                needs_rescan = True
+                with suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(stop_event.wait(), 1.0)
+
+
+class FileExtensionFilter:
+    """
+    Selects files with one of `file_extensions`. Paths under dot-directories
+    of `root`, e.g. the blob store and its snapshot pins, are never selected.
+    """
+
+    def __init__(self, file_extensions: Iterable[str], root: str | None = None) -> None:
+        self._select_file_extensions = tuple(file_extensions)
+        self._root = root
+        # Changes seen since last reset, selected or not
+        self.seen = 0
+
+    def __call__(self, change: Change, path: str) -> bool:
+        self.seen += 1
+        if not path.endswith(self._select_file_extensions):
+            return False
+        if self._root is not None:
+            parts = os.path.relpath(path, self._root).split(os.sep)[:-1]
+            if any(part.startswith(".") for part in parts):
+                return False
+        return True
+
+
+def _max_queued_events() -> int:
+    try:
+        with open("/proc/sys/fs/inotify/max_queued_events") as f:
+            return int(f.read())
+    except (OSError, ValueError):
+        return 16384
@@ -1,10 +1,16 @@
+import bz2
 import glob
+import io
+import json
 import os
 import shutil
+import tarfile
+import zipfile
 from os.path import basename
 from pathlib import Path
 
 import pytest
+import zstandard
 from asgi_lifespan import LifespanManager
 from httpx import ASGITransport, AsyncClient
 
@@ -50,3 +56,47 @@ async def async_client():
 @pytest.fixture(autouse=True, scope="session")
 def anyio_backend(request):
     return "asyncio", {"use_uvloop": True}
+
+
+@pytest.fixture
+def make_package(tmp_path: Path):
+    # Builds minimal packages with an info/index.json matching the file name
+    def make_package(filename: str, subdir="linux-64", **index_json) -> Path:
+        stem = filename.removesuffix(".tar.bz2").removesuffix(".conda")
+        name, version, build = stem.rsplit("-", 2)
+        index_json = {
+            "name": name,
+            "version": version,
+            "build": build,
+            "build_number": 0,
+            "depends": [],
+            "subdir": subdir,
+            **index_json,
+        }
+        info_tar = tar_bytes({"info/index.json": json.dumps(index_json).encode()})
+
+        path = tmp_path / filename
+        if filename.endswith(".tar.bz2"):
+            path.write_bytes(bz2.compress(info_tar))
+        else:
+            # The info component is stored after the pkg component
+            with zipfile.ZipFile(path, "w", compression=zipfile.ZIP_STORED) as zip_:
+                zip_.writestr("metadata.json", '{"conda_pkg_format_version": 2}')
+                zip_.writestr(
+                    f"pkg-{stem}.tar.zst",
+                    zstandard.compress(tar_bytes({"bin/tool": b"tool"})),
+                )
+                zip_.writestr(f"info-{stem}.tar.zst", zstandard.compress(info_tar))
+        return path
+
+    return make_package
+
+
+def tar_bytes(files: dict[str, bytes]) -> bytes:
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w") as tar:
+        for name, content in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            tar.addfile(info, io.BytesIO(content))
+    return buffer.getvalue()
@@ -3,7 +3,7 @@ import os
 import shutil
 from pathlib import Path
 
-from conda_server.atomic import atomic_write
+from conda_server.atomic import atomic_link, atomic_write
 
 
 def test_atomic_write(testpkg: Path):
@@ -17,3 +17,16 @@ def test_atomic_write(testpkg: Path):
     assert not glob.glob(f"{test_output_path}/*.tmp")
     assert not Path(f"{copy_path}.lock").exists()
     assert Path(copy_path).exists()
+
+
+def test_atomic_link(testpkg: Path, tmp_path: Path):
+    source_path = tmp_path / f"{testpkg.name}.source"
+    shutil.copy(testpkg, source_path)
+    link_path = tmp_path / testpkg.name
+    link_path.write_bytes(b"previous content")
+
+    atomic_link(str(source_path), str(link_path))
+
+    assert link_path.stat().st_ino == source_path.stat().st_ino
+    assert not glob.glob(f"{tmp_path}/*.tmp")
+    assert not Path(f"{link_path}.lock").exists()
@@ -0,0 +1,109 @@
+import json
+from pathlib import Path
+from unittest.mock import patch
+
+from conda_server.auth import (
+    APIKey,
+    Authenticator,
+    KeyScope,
+    generate_api_key,
+    verify_api_key,
+)
+
+
+def write_keys(path: Path, *keys: APIKey) -> None:
+    path.write_text(json.dumps({"keys": [key.model_dump() for key in keys]}))
+
+
+def make_key(key_id: str, *scopes: KeyScope) -> tuple[str, APIKey]:
+    token, key = generate_api_key(key_id)
+    return token, key.model_copy(update={"scopes": list(scopes)})
+
+
+def test_key_scopes():
+    key = APIKey(
+        id="ci",
+        hash="",
+        scopes=[
+            KeyScope(access="upload", channel="dev", subdir="linux-64"),
+            KeyScope(access="download", channel=None),
+        ],
+    )
+    assert key.allows("upload", "dev", "linux-64")
+    assert key.allows("download", "dev", "linux-64")
+    assert not key.allows("upload", "dev", "noarch")
+    assert not key.allows("upload", "dev", None)
+    assert not key.allows("upload", None, "linux-64")
+    assert key.allows("download", None, "noarch")
+    assert key.allows("download", None, None)
+    assert not key.allows("download", "dev", "noarch")
+    assert key.has_access("upload")
+
+
+def test_verify_api_key():
+    token, key = generate_api_key("ci")
+    key_id, _, secret = token.partition(".")
+    assert key_id == "ci"
+    assert key.hash.startswith("sha256$")
+    assert secret not in key.hash
+    assert verify_api_key(secret, key.hash)
+    assert not verify_api_key(secret + "x", key.hash)
+    assert not verify_api_key(secret, "md5$00$00")
+    assert not verify_api_key(secret, "invalid")
+
+
+async def test_authenticate(tmp_path: Path):
+    token, key = make_key("ci", KeyScope())
+    write_keys(tmp_path / "keys.json", key)
+    authenticator = Authenticator(str(tmp_path / "keys.json"))
+
+    assert await authenticator.authenticate(token) == key
+    assert authenticator.identify(token) == "ci"
+    assert await authenticator.authenticate(token + "x") is None
+    assert authenticator.identify(token + "x") is None
+
+    # Unknown keys are never checked
+    with patch("conda_server.auth.verify_api_key") as mock_verify:
+        assert await authenticator.authenticate("other." + token) is None
+        assert await authenticator.authenticate("ci") is None
+        assert authenticator.identify("other." + token) is None
+    mock_verify.assert_not_called()
+
+
+async def test_revoke_and_reload(tmp_path: Path):
+    token, key = make_key("ci", KeyScope())
+    other_token, other_key = make_key("other", KeyScope())
+    keys_file = tmp_path / "keys.json"
+    write_keys(keys_file, key, other_key)
+    authenticator = Authenticator(str(keys_file))
+    assert await authenticator.authenticate(token) == key
+
+    authenticator.revoke("ci")
+    assert await authenticator.authenticate(token) is None
+
+    # Rotating a key invalidates its old token
+    assert await authenticator.authenticate(other_token) == other_key
+    new_token, new_key = make_key("other", KeyScope())
+    write_keys(keys_file, key, new_key)
+    with patch("conda_server.auth.os.stat") as mock_stat:
+        mock_stat.return_value.st_mtime_ns = 1
+        authenticator.reload()
+    assert await authenticator.authenticate(other_token) is None
+    assert await authenticator.authenticate(new_token) == new_key
+    # Keys revoked in the process stay revoked
+    assert await authenticator.authenticate(token) is None
+
+    # A broken keys file keeps the keys loaded before
+    keys_file.write_text("{")
+    with patch("conda_server.auth.os.stat") as mock_stat:
+        mock_stat.return_value.st_mtime_ns = 2
+        authenticator.reload()
+    assert await authenticator.authenticate(new_token) == new_key
+
+
+def test_requires(tmp_path: Path):
+    assert not Authenticator(None).requires("upload")
+    write_keys(tmp_path / "keys.json")
+    authenticator = Authenticator(str(tmp_path / "keys.json"))
+    assert authenticator.requires("upload")
+    assert not authenticator.requires("download")
@@ -0,0 +1,131 @@
+import io
+import tarfile
+from pathlib import Path
+from unittest.mock import patch
+
+import pytest
+
+from conda_server.batch import commit_batch, delete_batch, stage_tar_stream
+from conda_server.blobs import BlobStore
+from conda_server.uploads import UploadTooLarge
+
+
+def build_tar(files: dict[str, bytes], mode="w:bz2") -> io.BytesIO:
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode=mode) as tar:
+        for name, content in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            tar.addfile(info, io.BytesIO(content))
+    buffer.seek(0)
+    return buffer
+
+
+def validate_name(filename: str) -> None:
+    if not filename.endswith((".tar.bz2", ".conda")):
+        raise ValueError(f"Invalid file name {filename}")
+
+
+def test_stage_tar_stream(tmp_path: Path):
+    blob_store = BlobStore(str(tmp_path / ".blobs"))
+    tar = build_tar({"a-1.0-0.tar.bz2": b"a", "dist/b-1.0-0.conda": b"b"})
+
+    staged_blobs = stage_tar_stream(blob_store, tar, validate_name)
+
+    assert set(staged_blobs) == {"a-1.0-0.tar.bz2", "b-1.0-0.conda"}
+    assert staged_blobs["b-1.0-0.conda"].size == 1
+
+
+def test_stage_tar_stream_discards_on_error(tmp_path: Path):
+    blob_store = BlobStore(str(tmp_path / ".blobs"))
+    tar = build_tar({"a-1.0-0.tar.bz2": b"a", "README.md": b"b"})
+
+    with pytest.raises(ValueError):
+        stage_tar_stream(blob_store, tar, validate_name)
+
+    assert not list((tmp_path / ".blobs" / "tmp").iterdir())
+
+
+def test_stage_tar_stream_max_size(tmp_path: Path):
+    blob_store = BlobStore(str(tmp_path / ".blobs"))
+    tar = build_tar({"a-1.0-0.tar.bz2": b"a", "b-1.0-0.tar.bz2": b"b" * 10})
+
+    with pytest.raises(UploadTooLarge):
+        stage_tar_stream(blob_store, tar, validate_name, max_size=5)
+
+    assert not list((tmp_path / ".blobs" / "tmp").iterdir())
+
+
+def test_commit_batch(tmp_path: Path):
+    blob_store = BlobStore(str(tmp_path / ".blobs"))
+    staged_blobs = {
+        str(tmp_path / "a-1.0-0.tar.bz2"): blob_store.stage(io.BytesIO(b"a")),
+        str(tmp_path / "b-1.0-0.tar.bz2"): blob_store.stage(io.BytesIO(b"b")),
+    }
+
+    commit_batch(blob_store, staged_blobs)
+
+    assert (tmp_path / "a-1.0-0.tar.bz2").read_bytes() == b"a"
+    assert (tmp_path / "b-1.0-0.tar.bz2").read_bytes() == b"b"
+    assert not list((tmp_path / ".blobs" / "tmp").iterdir())
+
+
+def test_commit_batch_rolls_back(tmp_path: Path):
+    blob_store = BlobStore(str(tmp_path / ".blobs"))
+    (tmp_path / "a-1.0-0.tar.bz2").write_bytes(b"old")
+    staged_blobs = {
+        str(tmp_path / "a-1.0-0.tar.bz2"): blob_store.stage(io.BytesIO(b"new")),
+        str(tmp_path / "b-1.0-0.tar.bz2"): blob_store.stage(io.BytesIO(b"b")),
+        str(tmp_path / "c-1.0-0.tar.bz2"): blob_store.stage(io.BytesIO(b"c")),
+    }
+
+    # Fail on the last package of the batch
+    commit = blob_store.commit
+
+    def failing_commit(staged_blob, path):
+        if path.endswith("c-1.0-0.tar.bz2"):
+            raise OSError("No space left on device")
+        commit(staged_blob, path)
+
+    with patch.object(blob_store, "commit", failing_commit), pytest.raises(OSError):
+        commit_batch(blob_store, staged_blobs)
+
+    assert (tmp_path / "a-1.0-0.tar.bz2").read_bytes() == b"old"
+    assert not (tmp_path / "b-1.0-0.tar.bz2").exists()
+    assert sorted(p.name for p in tmp_path.glob("*.tar.bz2")) == ["a-1.0-0.tar.bz2"]
+    assert blob_store.collect_garbage() == 0
+
+
+def test_commit_batch_releases_replaced_blobs(tmp_path: Path):
+    blob_store = BlobStore(str(tmp_path / ".blobs"))
+    path = str(tmp_path / "a-1.0-0.tar.bz2")
+    old_digest = blob_store.store(io.BytesIO(b"old"), path)
+
+    commit_batch(blob_store, {path: blob_store.stage(io.BytesIO(b"new"))})
+
+    assert Path(path).read_bytes() == b"new"
+    assert not blob_store.has(old_digest)
+    assert not list(tmp_path.glob("*.tmp"))
+
+
+def test_delete_batch(tmp_path: Path):
+    blob_store = BlobStore(str(tmp_path / ".blobs"))
+    paths = [str(tmp_path / "a-1.0-0.tar.bz2"), str(tmp_path / "b-1.0-0.tar.bz2")]
+    for path in paths:
+        blob_store.store(io.BytesIO(path.encode()), path)
+
+    delete_batch(blob_store, paths)
+
+    assert not list(tmp_path.glob("*.tar.bz2*"))
+    assert blob_store.collect_garbage() == 0
+
+
+def test_delete_batch_is_all_or_nothing(tmp_path: Path):
+    blob_store = BlobStore(str(tmp_path / ".blobs"))
+    path = str(tmp_path / "a-1.0-0.tar.bz2")
+    blob_store.store(io.BytesIO(b"a"), path)
+
+    with pytest.raises(FileNotFoundError):
+        delete_batch(blob_store, [path, str(tmp_path / "b-1.0-0.tar.bz2")])
+
+    assert Path(path).read_bytes() == b"a"
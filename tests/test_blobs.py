@@ -0,0 +1,147 @@
+import io
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import pytest
+
+from conda_server.blobs import BlobStore
+from conda_server.packages import PackageError, inspect_package
+
+TESTPKG_SHA256 = "f74353fc376dd8732662cde39e0103080cb7e03c6df4e13a6efa21cd484c48f6"
+
+
+def test_store_deduplicates(testpkg: Path, tmp_path: Path):
+    blob_store = BlobStore(str(tmp_path / ".blobs"))
+    first_path = tmp_path / "first" / testpkg.name
+    second_path = tmp_path / "second" / testpkg.name
+    first_path.parent.mkdir()
+    second_path.parent.mkdir()
+
+    with open(testpkg, "rb") as f:
+        assert blob_store.store(f, str(first_path)) == TESTPKG_SHA256
+    with open(testpkg, "rb") as f:
+        assert blob_store.store(f, str(second_path)) == TESTPKG_SHA256
+
+    assert blob_store.has(TESTPKG_SHA256)
+    blob_stat = os.stat(blob_store.blob_path(TESTPKG_SHA256))
+    assert blob_stat.st_ino == first_path.stat().st_ino == second_path.stat().st_ino
+    assert blob_stat.st_nlink == 3
+    assert not list((tmp_path / ".blobs" / "tmp").iterdir())
+
+
+def test_store_rejects_digest_mismatch(testpkg: Path, tmp_path: Path):
+    blob_store = BlobStore(str(tmp_path / ".blobs"))
+    package_path = tmp_path / testpkg.name
+
+    with open(testpkg, "rb") as f, pytest.raises(ValueError):
+        blob_store.store(f, str(package_path), expected_digest="0" * 64)
+
+    assert not package_path.exists()
+    assert not blob_store.has(TESTPKG_SHA256)
+
+
+def test_link_existing_blob(testpkg: Path, tmp_path: Path):
+    blob_store = BlobStore(str(tmp_path / ".blobs"))
+    with open(testpkg, "rb") as f:
+        blob_store.store(f, str(tmp_path / "first.tar.bz2"))
+
+    blob_store.link(TESTPKG_SHA256, str(tmp_path / "second.tar.bz2"))
+
+    assert (tmp_path / "second.tar.bz2").read_bytes() == testpkg.read_bytes()
+
+
+def test_release_drops_last_reference(testpkg: Path, tmp_path: Path):
+    blob_store = BlobStore(str(tmp_path / ".blobs"))
+    first_path = tmp_path / "first.tar.bz2"
+    second_path = tmp_path / "second.tar.bz2"
+    with open(testpkg, "rb") as f:
+        blob_store.store(f, str(first_path))
+    blob_store.link(TESTPKG_SHA256, str(second_path))
+
+    blob_store.release(str(first_path))
+    assert not first_path.exists()
+    assert blob_store.has(TESTPKG_SHA256)
+
+    blob_store.release(str(second_path))
+    assert not second_path.exists()
+    assert not blob_store.has(TESTPKG_SHA256)
+
+
+def test_store_releases_replaced_blob(testpkg: Path, tmp_path: Path):
+    blob_store = BlobStore(str(tmp_path / ".blobs"))
+    package_path = tmp_path / testpkg.name
+    old_digest = blob_store.store(io.BytesIO(b"old"), str(package_path))
+
+    with open(testpkg, "rb") as f:
+        blob_store.store(f, str(package_path))
+
+    assert not blob_store.has(old_digest)
+    assert blob_store.has(TESTPKG_SHA256)
+    assert [p.name for p in tmp_path.iterdir() if p.is_file()] == [testpkg.name]
+
+
+def test_concurrent_releases_drop_blob(testpkg: Path, tmp_path: Path):
+    blob_store = BlobStore(str(tmp_path / ".blobs"))
+    paths = [str(tmp_path / f"{i}.tar.bz2") for i in range(8)]
+    with open(testpkg, "rb") as f:
+        blob_store.store(f, paths[0])
+    for path in paths[1:]:
+        blob_store.link(TESTPKG_SHA256, path)
+
+    with ThreadPoolExecutor(len(paths)) as executor:
+        list(executor.map(blob_store.release, paths))
+
+    assert not blob_store.has(TESTPKG_SHA256)
+
+
+def test_collect_garbage(testpkg: Path, tmp_path: Path):
+    blob_store = BlobStore(str(tmp_path / ".blobs"))
+    package_path = tmp_path / testpkg.name
+    with open(testpkg, "rb") as f:
+        blob_store.store(f, str(package_path))
+
+    assert blob_store.collect_garbage() == 0
+
+    # Removing the package file out-of-band leaves the blob unreferenced
+    package_path.unlink()
+    assert blob_store.collect_garbage() == 1
+    assert not blob_store.has(TESTPKG_SHA256)
+
+
+def test_store_caches_metadata(testpkg: Path, tmp_path: Path):
+    blob_store = BlobStore(str(tmp_path / ".blobs"))
+    package_path = tmp_path / testpkg.name
+
+    with open(testpkg, "rb") as f:
+        blob_store.store(
+            f,
+            str(package_path),
+            inspect=lambda fileobj: inspect_package(fileobj, testpkg.name, "linux-64"),
+        )
+
+    metadata = blob_store.read_metadata(TESTPKG_SHA256)
+    assert metadata is not None
+    assert metadata["name"] == "testpkg"
+    assert metadata["md5"] == "ec370971727ce7870eba47f8ad2847ba"
+    assert metadata["size"] == testpkg.stat().st_size
+    assert package_path.read_bytes() == testpkg.read_bytes()
+
+    # The metadata goes with the blob
+    blob_store.release(str(package_path))
+    assert blob_store.read_metadata(TESTPKG_SHA256) is None
+
+
+def test_store_rejects_invalid_package(testpkg: Path, tmp_path: Path):
+    blob_store = BlobStore(str(tmp_path / ".blobs"))
+    package_path = tmp_path / testpkg.name
+
+    with open(testpkg, "rb") as f, pytest.raises(PackageError):
+        blob_store.store(
+            f,
+            str(package_path),
+            inspect=lambda fileobj: inspect_package(fileobj, testpkg.name, "noarch"),
+        )
+
+    assert not package_path.exists()
+    assert not list((tmp_path / ".blobs" / "tmp").iterdir())
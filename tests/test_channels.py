@@ -0,0 +1,41 @@
+from pathlib import Path
+
+import pytest
+
+from conda_server.channels import ChannelRegistry
+
+
+def test_get_default_channel(channel_dir: Path, tmp_path: Path):
+    channel_registry = ChannelRegistry(channels_dir=str(tmp_path))
+
+    channel = channel_registry.get()
+    assert channel.is_default
+    assert channel.directory == str(channel_dir)
+    assert channel_registry.get() is channel
+
+
+def test_get_named_channel(tmp_path: Path):
+    (tmp_path / "dev").mkdir()
+    channel_registry = ChannelRegistry(channels_dir=str(tmp_path))
+
+    channel = channel_registry.get("dev")
+    assert channel.name == "dev"
+    assert channel.directory == str(tmp_path / "dev")
+    assert channel.index_manager.channel_dir == str(tmp_path / "dev")
+
+    with pytest.raises(FileNotFoundError):
+        channel_registry.get("staging")
+
+
+async def test_close_idle_channels(tmp_path: Path):
+    (tmp_path / "dev").mkdir()
+    (tmp_path / "prod").mkdir()
+
+    async with ChannelRegistry(channels_dir=str(tmp_path), idle_timeout=0) as registry:
+        dev_channel = registry.get("dev")
+        async with registry.use("prod") as prod_channel:
+            # Channels in use and the default channel are never closed
+            assert await registry.close_idle_channels() == 1
+            assert registry.get("prod") is prod_channel
+            assert registry.get("dev") is not dev_channel
+            assert registry.get().is_default
@@ -0,0 +1,177 @@
+import json
+import os
+from pathlib import Path
+from unittest.mock import patch
+
+import pytest
+
+from conda_server import repodata, validation
+from conda_server.blobs import BlobStore
+from conda_server.current_repodata import PackageRecord, current_records
+from conda_server.repodata import RepodataStore
+from conda_server.specs import parse_dependency
+
+
+@pytest.fixture
+def pep440(monkeypatch):
+    monkeypatch.setattr(validation, "VERSION_REGEX", validation.PEP440_VERSION_REGEX)
+
+
+@pytest.fixture
+def channel(make_package, tmp_path: Path):
+    channel_dir = tmp_path / "channel"
+    (channel_dir / "linux-64").mkdir(parents=True)
+
+    def add(filename: str, **index_json) -> Path:
+        package = make_package(filename, **index_json)
+        path = channel_dir / "linux-64" / filename
+        os.link(package, path)
+        return path
+
+    store = RepodataStore(str(channel_dir), BlobStore(str(tmp_path / "b")))
+    return channel_dir, add, store
+
+
+def read_current(channel_dir: Path) -> dict:
+    path = channel_dir / "linux-64" / "current_repodata.json"
+    return json.loads(path.read_bytes())
+
+
+@pytest.mark.parametrize(
+    "spec,version,build,expected",
+    [
+        ("dep", "1.0", "0", True),
+        ("dep >=1.0,<2", "1.5", "0", True),
+        ("dep >=1.0,<2", "2.0", "0", False),
+        ("dep 1.2.*", "1.2.3", "0", True),
+        ("dep 1.2.*", "1.20", "0", False),
+        ("dep =1.2", "1.2", "0", True),
+        ("dep ==1.2", "1.2.0", "0", True),
+        ("dep 1.0|2.0", "2.0", "0", True),
+        ("dep !=1.0", "1.0", "0", False),
+        ("dep ~=1.4.2", "1.4.9", "0", True),
+        ("dep ~=1.4.2", "1.5.0", "0", False),
+        ("dep 1.0 py311_*", "1.0", "py311_0", True),
+        ("dep 1.0 py311_*", "1.0", "py312_0", False),
+        ("dep>=1.10", "1.9", "0", False),
+    ],
+)
+def test_parse_dependency(spec, version, build, expected, pep440):
+    name, matches = parse_dependency(spec)
+    assert name == "dep"
+    assert matches(version, build) is expected
+
+
+def test_current_repodata(channel, pep440):
+    channel_dir, add, store = channel
+    add("tool-1.9-0.tar.bz2")
+    add("tool-1.10-0.tar.bz2", depends=["lib <2"])
+    add("tool-1.10-1.tar.bz2", depends=["lib <2"])
+    add("tool-1.10-1.conda", depends=["lib <2"])
+    add("lib-1.0-0.tar.bz2")
+    add("lib-2.0-0.tar.bz2")
+
+    store.update("linux-64")
+    assert store.update_current("linux-64")
+    store.write_current_repodata("linux-64")
+
+    # All builds of the latest version under PEP 440, and the newest version of
+    # each dependency that the latest versions don't satisfy
+    current = read_current(channel_dir)
+    assert sorted(current["packages"]) == [
+        "lib-1.0-0.tar.bz2",
+        "lib-2.0-0.tar.bz2",
+        "tool-1.10-0.tar.bz2",
+        "tool-1.10-1.tar.bz2",
+    ]
+    assert list(current["packages.conda"]) == ["tool-1.10-1.conda"]
+    store.write_repodata("linux-64")
+    repodata_json = json.loads((channel_dir / "linux-64" / "repodata.json").read_text())
+    record = current["packages"]["tool-1.10-1.tar.bz2"]
+    assert record == repodata_json["packages"]["tool-1.10-1.tar.bz2"]
+
+
+def test_current_repodata_legacy_bz2_md5(channel, pep440):
+    channel_dir, add, store = channel
+    tar_bz2 = add("tool-1.0-0.tar.bz2")
+    add("tool-1.0-0.conda")
+    add("tool-1.0-1.conda")
+
+    store.update("linux-64")
+    store.update_current("linux-64")
+    store.write_current_repodata("linux-64")
+
+    current = read_current(channel_dir)
+    md5 = current["packages"][tar_bz2.name]["md5"]
+    assert current["packages.conda"]["tool-1.0-0.conda"]["legacy_bz2_md5"] == md5
+    assert current["packages.conda"]["tool-1.0-1.conda"]["legacy_bz2_md5"] is None
+
+
+def test_current_repodata_featureless_version(channel, pep440):
+    channel_dir, add, store = channel
+    add("blas-2.0-mkl.tar.bz2", track_features="mkl")
+    add("blas-1.5-0.tar.bz2")
+    add("blas-1.0-0.tar.bz2")
+
+    store.update("linux-64")
+    store.update_current("linux-64")
+    store.write_current_repodata("linux-64")
+
+    assert sorted(read_current(channel_dir)["packages"]) == [
+        "blas-1.5-0.tar.bz2",
+        "blas-2.0-mkl.tar.bz2",
+    ]
+
+
+def test_update_current_is_incremental(channel, pep440):
+    channel_dir, add, store = channel
+    add("tool-1.0-0.tar.bz2", depends=["lib <2"])
+    add("lib-1.0-0.tar.bz2")
+    add("lib-2.0-0.tar.bz2")
+    add("other-1.0-0.tar.bz2")
+    store.update("linux-64")
+    store.update_current("linux-64")
+
+    # A new version of a dependency recomputes the names that depend on it
+    add("lib-1.5-0.tar.bz2")
+    store.update("linux-64")
+    with patch.object(
+        repodata, "current_records", wraps=current_records
+    ) as mock_current_records:
+        assert store.update_current("linux-64")
+        assert {call.args[0] for call in mock_current_records.call_args_list} == {
+            "lib",
+            "tool",
+        }
+    store.write_current_repodata("linux-64")
+    assert sorted(read_current(channel_dir)["packages"]) == [
+        "lib-1.5-0.tar.bz2",
+        "lib-2.0-0.tar.bz2",
+        "other-1.0-0.tar.bz2",
+        "tool-1.0-0.tar.bz2",
+    ]
+
+    # Nothing to recompute without changes
+    with patch.object(repodata, "current_records") as mock_current_records:
+        assert not store.update_current("linux-64")
+        mock_current_records.assert_not_called()
+
+    # Packages added with known metadata are picked up as well
+    path = add("other-2.0-0.tar.bz2")
+    (path.parent / "other-1.0-0.tar.bz2").unlink()
+    store.add(str(path), {"name": "other", "version": "2.0", "build": "0"})
+    store.update("linux-64")
+    assert store.update_current("linux-64")
+    store.write_current_repodata("linux-64")
+    assert "other-2.0-0.tar.bz2" in read_current(channel_dir)["packages"]
+    assert "other-1.0-0.tar.bz2" not in read_current(channel_dir)["packages"]
+
+
+def test_current_records_semver(monkeypatch):
+    monkeypatch.setattr(validation, "VERSION_REGEX", validation.SEMVER_REGEX)
+    records = [
+        PackageRecord("tool-1.9.0-0", "tool", "1.9.0", "0", (), False),
+        PackageRecord("tool-1.10.0-rc.1-0", "tool", "1.10.0-rc.1", "0", (), False),
+        PackageRecord("tool-1.10.0-0", "tool", "1.10.0", "0", (), False),
+    ]
+    assert current_records("tool", lambda name: records).fns == {"tool-1.10.0-0"}
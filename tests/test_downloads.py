@@ -0,0 +1,83 @@
+import asyncio
+import sqlite3
+from pathlib import Path
+from unittest.mock import patch
+
+from conda_server.downloads import DownloadCounter
+
+HOUR = 3600
+
+
+async def test_flush_at_threshold(tmp_path: Path):
+    counter = DownloadCounter(
+        str(tmp_path / "downloads.db"), flush_interval=3600, flush_threshold=3
+    )
+    async with counter:
+        counter.record(None, "linux-64", "tool-1.0-0.conda")
+        counter.record(None, "linux-64", "tool-1.0-0.conda")
+        await asyncio.sleep(0.05)
+        assert counter.pending == 2
+
+        counter.record(None, "noarch", "lib-1.0-0.tar.bz2")
+        for _ in range(100):
+            if counter.pending == 0:
+                break
+            await asyncio.sleep(0.01)
+        assert counter.pending == 0
+        assert counter.query(None) == [("tool", 2), ("lib", 1)]
+
+
+async def test_flush_on_exit(tmp_path: Path):
+    counter = DownloadCounter(str(tmp_path / "downloads.db"), flush_interval=3600)
+    async with counter:
+        counter.record("dev", "linux-64", "tool-1.0-0.conda")
+    assert counter.pending == 0
+    assert counter.query("dev") == [("tool", 1)]
+    assert counter.query(None) == []
+
+
+async def test_counts_are_merged_across_workers(tmp_path: Path):
+    workers = [DownloadCounter(str(tmp_path / "downloads.db")) for _ in range(2)]
+    for worker in workers:
+        worker.record(None, "linux-64", "tool-1.0-0.conda", now=10 * HOUR)
+        worker.record(None, "linux-64", "tool-1.0-1.conda", now=10 * HOUR)
+    await asyncio.gather(*(worker.flush() for worker in workers))
+
+    assert workers[0].query(None, group_by="file") == [
+        ("tool-1.0-0.conda", 2),
+        ("tool-1.0-1.conda", 2),
+    ]
+
+
+async def test_query(tmp_path: Path):
+    counter = DownloadCounter(str(tmp_path / "downloads.db"))
+    counter.record(None, "linux-64", "tool-1.0-0.conda", now=1 * HOUR)
+    counter.record(None, "linux-64", "tool-2.0-0.conda", now=2 * HOUR + 5)
+    counter.record(None, "osx-64", "tool-2.0-0.conda", now=25 * HOUR)
+    counter.record(None, "osx-64", "lib-1.0-0.conda", now=25 * HOUR)
+    await counter.flush()
+
+    assert counter.query(None, group_by="subdir") == [("linux-64", 2), ("osx-64", 2)]
+    assert counter.query(None, subdir="osx-64", package="lib") == [("lib", 1)]
+    assert counter.query(None, group_by="bucket") == [
+        (1 * HOUR, 1),
+        (2 * HOUR, 1),
+        (25 * HOUR, 2),
+    ]
+    assert counter.query(None, group_by="bucket", bucket_seconds=24 * HOUR) == [
+        (0, 2),
+        (24 * HOUR, 2),
+    ]
+    assert counter.query(None, since=2 * HOUR + 10, until=24 * HOUR) == [("tool", 1)]
+
+
+async def test_failed_flush_keeps_counts(tmp_path: Path):
+    counter = DownloadCounter(str(tmp_path / "downloads.db"))
+    counter.record(None, "linux-64", "tool-1.0-0.conda")
+    with patch.object(counter, "_write", side_effect=sqlite3.OperationalError):
+        await counter.flush()
+    assert counter.pending == 1
+
+    await counter.flush()
+    assert counter.pending == 0
+    assert counter.query(None) == [("tool", 1)]
@@ -0,0 +1,106 @@
+import asyncio
+import json
+import os
+from pathlib import Path
+
+import pytest
+from fastapi.responses import FileResponse
+
+from conda_server.events import EventHub
+
+
+def write_repodata(channel_dir: Path, *filenames: str, subdir="linux-64") -> None:
+    (channel_dir / subdir).mkdir(parents=True, exist_ok=True)
+    packages = {fn: {"sha256": fn[0] * 64, "size": 1} for fn in filenames}
+    temp_path = channel_dir / subdir / "repodata.json.tmp"
+    temp_path.write_text(json.dumps({"packages": packages}))
+    os.replace(temp_path, channel_dir / subdir / "repodata.json")
+
+
+async def next_events(subscription, count: int) -> list:
+    return [await asyncio.wait_for(anext(subscription), 1) for _ in range(count)]
+
+
+async def test_events_of_generation(tmp_path: Path):
+    write_repodata(tmp_path, "a-1.0-0.tar.bz2", "b-1.0-0.tar.bz2")
+    hub = EventHub()
+    await hub.publish_generation(None, str(tmp_path), None, publish=False)
+    subscription = hub.subscribe(None)
+    other_channel = hub.subscribe("other")
+
+    write_repodata(tmp_path, "b-1.0-0.tar.bz2", "c-1.0-0.tar.bz2")
+    await hub.publish_generation(None, str(tmp_path), {"linux-64"})
+    events = [event.data for event in await next_events(subscription, 3)]
+    assert events[:2] == [
+        {"type": "removed", "subdir": "linux-64", "fn": "a-1.0-0.tar.bz2"},
+        {
+            "type": "added",
+            "subdir": "linux-64",
+            "fn": "c-1.0-0.tar.bz2",
+            "sha256": "c" * 64,
+            "size": 1,
+        },
+    ]
+    # The ETags are those that the index files are served with
+    response = FileResponse(tmp_path / "linux-64" / "repodata.json")
+    response.set_stat_headers(os.stat(tmp_path / "linux-64" / "repodata.json"))
+    assert events[2] == {
+        "type": "published",
+        "subdirs": ["linux-64"],
+        "etags": {"linux-64/repodata.json": response.headers["ETag"]},
+    }
+
+    # Subscribers only see the events of their channel
+    with pytest.raises(asyncio.TimeoutError):
+        await asyncio.wait_for(anext(other_channel), 0.1)
+
+
+async def test_resume_and_reset(tmp_path: Path):
+    write_repodata(tmp_path)
+    hub = EventHub(capacity=4)
+    await hub.publish_generation(None, str(tmp_path), None, publish=False)
+    for filename in "a-1.0-0.tar.bz2", "b-1.0-0.tar.bz2":
+        write_repodata(tmp_path, filename)
+        await hub.publish_generation(None, str(tmp_path), {"linux-64"})
+    # Events 1-5 were logged, of which 1 is gone: 3 removed a
+    (event,) = await next_events(hub.subscribe(None, hub.token(2)), 1)
+    assert (event.id, event.data["type"]) == (3, "removed")
+
+    # Subscribers that missed events start over
+    for token in hub.token(0), "unknown-4", "junk":
+        (event,) = await next_events(hub.subscribe(None, token), 1)
+        assert (event.id, event.data) == (5, {"type": "reset"})
+
+    subscription = hub.subscribe(None, hub.token(5))
+    for filename in "c-1.0-0.tar.bz2", "d-1.0-0.tar.bz2":
+        write_repodata(tmp_path, filename)
+        await hub.publish_generation(None, str(tmp_path), {"linux-64"})
+    # Falling more than the capacity behind resets the subscription to now
+    (event,) = await next_events(subscription, 1)
+    assert (event.id, event.data["type"]) == (11, "reset")
+
+
+async def test_idle_subscribers(tmp_path: Path):
+    write_repodata(tmp_path)
+    hub = EventHub()
+    await hub.publish_generation(None, str(tmp_path), None, publish=False)
+    subscriptions = [hub.subscribe(None, keepalive=60) for _ in range(1000)]
+    waiting = [asyncio.create_task(anext(s)) for s in subscriptions]  # type: ignore
+    await asyncio.sleep(0.05)
+    assert not any(task.done() for task in waiting)
+
+    # A single publish wakes every subscriber
+    await hub.publish_generation(None, str(tmp_path), {"linux-64"})
+    events = await asyncio.wait_for(asyncio.gather(*waiting), 5)
+    assert {event.data["type"] for event in events} == {"published"}
+
+    # Subscriptions end once the hub is closed
+    hub.close()
+    for subscription in subscriptions[:10]:
+        with pytest.raises(StopAsyncIteration):
+            await asyncio.wait_for(anext(subscription), 1)
+
+
+async def test_keepalive():
+    hub = EventHub()
+    assert await anext(hub.subscribe(None, keepalive=0.01)) is None
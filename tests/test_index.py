@@ -1,9 +1,14 @@
+import asyncio
 import glob
 import os
+import threading
 import time
 from contextlib import suppress
 from datetime import datetime, timedelta
 from pathlib import Path
+from unittest.mock import patch
+
+from watchfiles import Change
 
 from conda_server.index import IndexManager
 from conda_server.utils import get_platforms
@@ -63,13 +68,9 @@ async def test_generate_index(channel_dir: Path):
             "current_repodata.json",
             "current_repodata.json.bz2",
             "current_repodata.json.zst",
-            "repodata_from_packages.json",
-            "repodata_from_packages.json.bz2",
-            "repodata_from_packages.json.zst",
             "repodata.json",
             "repodata.json.bz2",
             "repodata.json.zst",
-            "index.html",
             ".cache/cache.db",
         ],
         current_time,
@@ -88,15 +89,117 @@ async def test_generate_index(channel_dir: Path):
                 "current_repodata.json",
                 "current_repodata.json.bz2",
                 "current_repodata.json.zst",
-                "repodata_from_packages.json",
-                "repodata_from_packages.json.bz2",
-                "repodata_from_packages.json.zst",
                 "repodata.json",
                 "repodata.json.bz2",
                 "repodata.json.zst",
-                "index.html",
                 ".cache/cache.db",
             ],
             current_time,
             timedelta(seconds=index_end_time - index_start_time),
         )
+
+
+async def test_ignore_changes(tmp_path: Path):
+    index_manager = IndexManager(str(tmp_path))
+    ignored_path = str(tmp_path / "linux-64" / "a-1.0-0.tar.bz2")
+    other_path = str(tmp_path / "linux-64" / "b-1.0-0.tar.bz2")
+
+    index_manager.ignore_changes([ignored_path])
+    changes = {(Change.added, ignored_path), (Change.added, other_path)}
+    assert index_manager._filter_ignored_changes(changes) == {
+        (Change.added, other_path)
+    }
+
+    # The path is only ignored until it has seen an event
+    assert index_manager._filter_ignored_changes(changes) == changes
+
+
+async def test_generate_index_for_changed_subdirs(tmp_path: Path):
+    index_manager = IndexManager(str(tmp_path))
+
+    (tmp_path / "linux-64").mkdir()
+
+    with patch("conda_server.index.ChannelIndex") as mock_channel_index:
+        await index_manager.generate_index(
+            {(Change.deleted, str(tmp_path / "linux-64" / "a-1.0-0.tar.bz2"))}
+        )
+        assert mock_channel_index.call_args.kwargs["subdirs"] == ["linux-64"]
+        assert not (tmp_path / "noarch" / "repodata.json").exists()
+
+        await index_manager.generate_index()
+        assert mock_channel_index.call_args.kwargs["subdirs"] == [
+            "linux-64",
+            "noarch",
+        ]
+        # conda-index only writes channeldata, not repodata
+        mock_channel_index.return_value.update_channeldata.assert_called_with(rss=True)
+        mock_channel_index.return_value.index.assert_not_called()
+
+
+async def test_pending_generation_leaves_slots_to_other_channels(tmp_path: Path):
+    busy = IndexManager(str(tmp_path / "a"))
+    other = IndexManager(str(tmp_path / "b"))
+    writing = threading.Event()
+    release = threading.Event()
+
+    def write_repodata(subdirs):
+        writing.set()
+        release.wait(5)
+
+    with patch("conda_server.index._index_slots", asyncio.Semaphore(2)), patch.object(
+        busy, "_write_repodata", side_effect=write_repodata
+    ), patch.object(busy, "_write_channeldata"), patch.object(
+        other, "_write_repodata"
+    ), patch.object(
+        other, "_write_channeldata"
+    ):
+        running = asyncio.create_task(busy.generate_index())
+        while not writing.is_set():
+            await asyncio.sleep(0.01)
+        pending = asyncio.create_task(busy.generate_index())
+        await asyncio.sleep(0.1)
+
+        # The pending generation of the busy channel doesn't hold a slot
+        await asyncio.wait_for(other.generate_index(), 1)
+        release.set()
+        await asyncio.gather(running, pending)
+        assert busy._write_repodata.call_count == 2
+
+
+async def test_watch_channel_dir(tmp_path: Path):
+    (tmp_path / "linux-64").mkdir()
+    index_manager = IndexManager(str(tmp_path))
+    generating = asyncio.Event()
+    generated = asyncio.Event()
+    calls = []
+
+    async def generate_index(changes):
+        calls.append(changes)
+        generating.set()
+        await generated.wait()
+
+    with patch("conda_server.index.get_watch_mode", return_value="poll"), patch(
+        "conda_server.index.get_watch_poll_interval", return_value=0.01
+    ), patch.object(index_manager, "generate_index", side_effect=generate_index):
+        with index_manager:
+            await asyncio.sleep(0.1)
+            paths = [str(tmp_path / "linux-64" / f"{n}-1.0-0.conda") for n in "abc"]
+            Path(paths[0]).write_bytes(b"a")
+            await asyncio.wait_for(generating.wait(), 5)
+
+            # Changes made during a generation are merged into the next one
+            for path in paths[1:]:
+                Path(path).write_bytes(b"x")
+            Path(paths[2]).unlink()
+            Path(paths[0]).write_bytes(b"aa")
+            await asyncio.sleep(0.1)
+            generated.set()
+            while len(calls) < 2:
+                await asyncio.sleep(0.01)
+        await asyncio.sleep(0.1)
+
+    assert calls == [
+        {(Change.added, paths[0])},
+        {(Change.added, paths[1]), (Change.modified, paths[0])},
+    ]
+    assert not index_manager.is_watching
@@ -0,0 +1,87 @@
+import json
+import os
+from pathlib import Path
+
+import pytest
+
+from conda_server.listings import ListedPackage, ListingCache
+
+
+def write_repodata(channel_dir: Path, count: int, subdir="linux-64") -> None:
+    (channel_dir / subdir).mkdir(parents=True, exist_ok=True)
+    packages = {
+        f"pkg{i:03d}-1.0-0.tar.bz2": {
+            "name": f"pkg{i:03d}",
+            "size": 2048,
+            "timestamp": 1700000000000,
+            "sha256": "ab" * 32,
+        }
+        for i in range(count)
+    }
+    # Index files are replaced, not rewritten in place
+    temp_path = channel_dir / subdir / "repodata.json.tmp"
+    temp_path.write_text(json.dumps({"packages": packages, "packages.conda": {}}))
+    os.replace(temp_path, channel_dir / subdir / "repodata.json")
+
+
+async def test_listing_pages(tmp_path: Path):
+    write_repodata(tmp_path, 25)
+    cache = ListingCache(page_size=10)
+
+    first = await cache.listing(str(tmp_path), "linux-64", 1, title="test/linux-64")
+    assert first is not None
+    body = first.body.decode()
+    assert "25 packages, page 1 of 3" in body
+    assert '<a href="pkg000-1.0-0.tar.bz2">' in body
+    assert "pkg010-1.0-0.tar.bz2" not in body
+    assert "2.0 KB" in body and "2023-11-14" in body
+    assert '<a href="?page=2">next</a>' in body
+
+    last = await cache.listing(str(tmp_path), "linux-64", 3)
+    assert last is not None
+    assert "pkg024-1.0-0.tar.bz2" in last.body.decode()
+    assert last.etag != first.etag
+    assert await cache.listing(str(tmp_path), "linux-64", 4) is None
+    assert await cache.listing(str(tmp_path), "noarch", 1) is None
+
+    # Pages are served from memory until the index is replaced
+    assert await cache.listing(str(tmp_path), "linux-64", 1) is first
+    write_repodata(tmp_path, 5)
+    page = await cache.listing(str(tmp_path), "linux-64", 1)
+    assert page is not None and page.etag != first.etag
+    assert "5 packages, page 1 of 1" in page.body.decode()
+
+
+async def test_listing_of_empty_subdir(tmp_path: Path):
+    write_repodata(tmp_path, 0)
+    page = await ListingCache().listing(str(tmp_path), "linux-64", 1)
+    assert page is not None
+    assert "0 packages, page 1 of 1" in page.body.decode()
+
+
+async def test_feed(tmp_path: Path):
+    cache = ListingCache()
+    assert await cache.feed(str(tmp_path)) is None
+    (tmp_path / "rss.xml").write_text("<rss></rss>")
+    feed = await cache.feed(str(tmp_path))
+    assert feed is not None and feed.body == b"<rss></rss>"
+    assert feed.etag == (await cache.feed(str(tmp_path))).etag  # type: ignore
+
+
+async def test_refresh_reads_cached_index_files(tmp_path: Path):
+    write_repodata(tmp_path, 1)
+    cache = ListingCache(max_entries=1)
+    await cache.listing(str(tmp_path), "linux-64", 1)
+    write_repodata(tmp_path, 2)
+    await cache.refresh(str(tmp_path))
+    cached = cache._entries[str(tmp_path / "linux-64" / "repodata.json")]
+    assert len(cached.data) == 2 and not cached.pages
+    # Only the fields that listings show are kept of the records
+    assert cached.data[0] == ListedPackage(
+        "pkg000-1.0-0.tar.bz2", 2048, 1700000000000, "ab" * 32
+    )
+
+    # Only the most recently used index files are kept
+    write_repodata(tmp_path, 1, subdir="noarch")
+    await cache.listing(str(tmp_path), "noarch", 1)
+    assert list(cache._entries) == [str(tmp_path / "noarch" / "repodata.json")]
@@ -1,10 +1,12 @@
 import asyncio
 import glob
+import json
 import shutil
 from os.path import basename
 from pathlib import Path
 from unittest.mock import AsyncMock, patch
 
+import pytest
 from httpx import AsyncClient
 from watchfiles import Change
 
@@ -144,3 +146,492 @@ async def test_get_package(testpkg: Path, async_client: AsyncClient, channel_dir
     )
     assert response.headers["Content-Type"] == "application/x-tar"
     assert response.headers["Content-Length"] == str(testpkg.stat().st_size)
+
+
+async def test_check_blob(testpkg: Path, async_client: AsyncClient, channel_dir: Path):
+    # Upload the package to the server
+    with open(testpkg, "rb") as f:
+        response = await async_client.put(
+            f"/linux-64/{basename(testpkg)}", files={"file": f}
+        )
+    assert response.status_code == 200
+    sha256 = response.json()["sha256"]
+
+    response = await async_client.head(f"/blobs/sha256/{sha256}")
+    assert response.status_code == 200
+
+    response = await async_client.head(f"/blobs/sha256/{'0' * 64}")
+    assert response.status_code == 404
+
+
+async def test_upload_existing_blob(
+    testpkg: Path, async_client: AsyncClient, channel_dir: Path
+):
+    from conda_server.main import channel_registry
+
+    # Upload the package to the server
+    with open(testpkg, "rb") as f:
+        response = await async_client.put(
+            f"/linux-64/{basename(testpkg)}", files={"file": f}
+        )
+    assert response.status_code == 200
+    sha256 = response.json()["sha256"]
+
+    # Upload the same content to another channel without transferring the file
+    dev_channel_dir = Path(channel_registry.channel_dir("dev"))
+    dev_channel_dir.mkdir(parents=True, exist_ok=True)
+    response = await async_client.put(
+        f"/dev/linux-64/{basename(testpkg)}", headers={"X-Content-Sha256": sha256}
+    )
+    assert response.status_code == 200
+
+    assert (dev_channel_dir / "linux-64" / basename(testpkg)).stat().st_ino == (
+        channel_dir / "linux-64" / basename(testpkg)
+    ).stat().st_ino
+
+    # The package metadata must match the subdir it is linked into
+    response = await async_client.put(
+        f"/noarch/{basename(testpkg)}", headers={"X-Content-Sha256": sha256}
+    )
+    assert response.status_code == 400
+    assert not (channel_dir / "noarch" / basename(testpkg)).exists()
+
+    response = await async_client.delete(f"/dev/linux-64/{basename(testpkg)}")
+    assert response.status_code == 200
+
+
+async def test_upload_unknown_blob(testpkg: Path, async_client: AsyncClient):
+    response = await async_client.put(
+        f"/linux-64/{basename(testpkg)}", headers={"X-Content-Sha256": "0" * 64}
+    )
+    assert response.status_code == 404
+
+
+async def test_named_channel(testpkg: Path, async_client: AsyncClient):
+    from conda_server.main import channel_registry
+
+    channel_dir = Path(channel_registry.channel_dir("dev"))
+    channel_dir.mkdir(parents=True, exist_ok=True)
+
+    # Upload the package to the named channel
+    with open(testpkg, "rb") as f:
+        response = await async_client.put(
+            f"/dev/linux-64/{basename(testpkg)}", files={"file": f}
+        )
+    assert response.status_code == 200
+    assert (channel_dir / "linux-64" / basename(testpkg)).exists()
+
+    # Get the package from the named channel
+    response = await async_client.get(f"/dev/linux-64/{basename(testpkg)}")
+    assert response.status_code == 200
+    assert response.content == testpkg.read_bytes()
+
+    # Delete the package from the named channel
+    response = await async_client.delete(f"/dev/linux-64/{basename(testpkg)}")
+    assert response.status_code == 200
+    assert not (channel_dir / "linux-64" / basename(testpkg)).exists()
+
+
+async def test_unknown_channel(testpkg: Path, async_client: AsyncClient):
+    response = await async_client.get(f"/unknown/linux-64/{basename(testpkg)}")
+    assert response.status_code == 404
+    assert response.json()["detail"] == "Channel not found"
+
+
+async def test_batch_upload_and_delete(
+    testpkg: Path, make_package, async_client: AsyncClient, channel_dir: Path
+):
+    from conda_server.main import channel_registry
+
+    channel = channel_registry.get()
+    other_package = make_package("testpkg-0.0.2-py311_0.conda")
+    other_name = other_package.name
+
+    # Upload two packages in one request, which is indexed once
+    with patch.object(
+        channel.index_manager, "generate_index", new_callable=AsyncMock
+    ) as mock_generate_index:
+        response = await async_client.post(
+            "/linux-64/batch",
+            files=[
+                ("files", (basename(testpkg), testpkg.read_bytes())),
+                ("files", (other_name, other_package.read_bytes())),
+            ],
+        )
+        assert response.status_code == 200
+        assert set(response.json()["packages"]) == {basename(testpkg), other_name}
+        mock_generate_index.assert_awaited_once()
+
+    assert (
+        channel_dir / "linux-64" / other_name
+    ).read_bytes() == other_package.read_bytes()
+
+    # A batch with a missing package deletes nothing
+    response = await async_client.post(
+        "/linux-64/batch/delete", json={"files": [other_name, "missing-1.0-0.conda"]}
+    )
+    assert response.status_code == 404
+    assert (channel_dir / "linux-64" / other_name).exists()
+
+    with patch.object(
+        channel.index_manager, "generate_index", new_callable=AsyncMock
+    ) as mock_generate_index:
+        response = await async_client.post(
+            "/linux-64/batch/delete", json={"files": [other_name]}
+        )
+        assert response.status_code == 200
+        mock_generate_index.assert_awaited_once_with(
+            {(Change.deleted, str(channel_dir / "linux-64" / other_name))}
+        )
+
+    assert not (channel_dir / "linux-64" / other_name).exists()
+
+
+async def test_batch_upload_rejects_invalid_name(async_client: AsyncClient):
+    response = await async_client.post(
+        "/linux-64/batch", files=[("files", ("README.md", b"content"))]
+    )
+    assert response.status_code == 400
+
+
+async def test_retention(testpkg: Path, async_client: AsyncClient, channel_dir: Path):
+    from conda_server.main import channel_registry
+
+    channel = channel_registry.get()
+    old_package = basename(testpkg).replace("0.0.1", "0.0.0")
+    shutil.copy(testpkg, channel_dir / "linux-64" / old_package)
+    shutil.copy(testpkg, channel_dir / "linux-64" / basename(testpkg))
+
+    # A dry run only reports what would be deleted
+    response = await async_client.post("/retention", json={"keep_versions": 1})
+    assert response.status_code == 200
+    assert response.json()["packages"] == [f"linux-64/{old_package}"]
+    assert response.json()["index_entries_saved"] == 1
+    assert (channel_dir / "linux-64" / old_package).exists()
+
+    with patch.object(
+        channel.index_manager, "generate_index", new_callable=AsyncMock
+    ) as mock_generate_index:
+        response = await async_client.post(
+            "/retention?dry_run=false", json={"keep_versions": 1}
+        )
+        assert response.status_code == 200
+        mock_generate_index.assert_awaited_once()
+
+    assert not (channel_dir / "linux-64" / old_package).exists()
+    assert (channel_dir / "linux-64" / basename(testpkg)).exists()
+
+
+async def test_upload_rejects_invalid_package(
+    testpkg: Path, make_package, async_client: AsyncClient, channel_dir: Path
+):
+    # The package is built for another platform than the one it's uploaded to
+    with open(testpkg, "rb") as f:
+        response = await async_client.put(
+            f"/osx-64/{basename(testpkg)}", files={"file": f}
+        )
+    assert response.status_code == 400
+    assert not (channel_dir / "osx-64" / basename(testpkg)).exists()
+
+    # The file name doesn't match the package metadata
+    package = make_package("testpkg-0.0.3-py311_0.conda", version="0.0.4")
+    with open(package, "rb") as f:
+        response = await async_client.put(
+            f"/linux-64/{package.name}", files={"file": f}
+        )
+    assert response.status_code == 400
+    assert not (channel_dir / "linux-64" / package.name).exists()
+
+
+async def test_download_counts(
+    testpkg: Path, async_client: AsyncClient, channel_dir: Path
+):
+    shutil.copy(testpkg, channel_dir / "linux-64" / basename(testpkg))
+    query = {"subdir": "linux-64", "package": "testpkg"}
+    response = await async_client.get("/downloads", params=query)
+    assert response.status_code == 200
+    before = response.json()["total"]
+
+    for _ in range(2):
+        response = await async_client.get(f"/linux-64/{basename(testpkg)}")
+        assert response.status_code == 200
+
+    # Pending counts are flushed before querying
+    response = await async_client.get("/downloads", params=query)
+    assert response.json()["total"] == before + 2
+    assert response.json()["downloads"] == [{"package": "testpkg", "count": before + 2}]
+
+    response = await async_client.get(
+        "/downloads", params={**query, "group_by": "bucket", "bucket_seconds": 86400}
+    )
+    assert response.json()["downloads"][-1]["bucket"] % 86400 == 0
+
+    response = await async_client.get("/downloads", params={"group_by": "version"})
+    assert response.status_code == 422
+
+
+async def test_fetch_package_bandwidth_limit(
+    testpkg: Path, async_client: AsyncClient, channel_dir: Path
+):
+    from conda_server.main import rate_limiter
+
+    shutil.copy(testpkg, channel_dir / "linux-64" / basename(testpkg))
+    size = testpkg.stat().st_size
+    url = f"/linux-64/{basename(testpkg)}"
+    unlimited = await async_client.get(url)
+    unlimited_range = await async_client.get(url, headers={"Range": "bytes=0-9"})
+    with patch.object(rate_limiter, "_bytes_per_second", size), patch.object(
+        rate_limiter, "_bytes_burst", 1
+    ), patch("conda_server.ratelimit.asyncio.sleep", AsyncMock()) as mock_sleep:
+        response = await async_client.get(url, headers={"X-API-Key": "bandwidth"})
+        # The whole file is paid for at the limit
+        assert sum(call.args[0] for call in mock_sleep.call_args_list) == pytest.approx(
+            1.0, abs=0.1
+        )
+
+        # Throttled downloads keep the headers and range handling of files
+        range_response = await async_client.get(url, headers={"Range": "bytes=0-9"})
+    assert response.status_code == 200
+    assert response.content == testpkg.read_bytes()
+    for header in "Content-Length", "ETag", "Last-Modified":
+        assert response.headers[header] == unlimited.headers[header]
+    assert range_response.status_code == unlimited_range.status_code
+    assert range_response.content == unlimited_range.content
+
+
+async def test_upload_raw_body(testpkg: Path, async_client: AsyncClient):
+    from conda_server.main import channel_registry
+
+    channel_dir = Path(channel_registry.channel_dir("dev"))
+    channel_dir.mkdir(parents=True, exist_ok=True)
+    response = await async_client.put(
+        f"/dev/linux-64/{basename(testpkg)}", content=testpkg.read_bytes()
+    )
+    assert response.status_code == 200
+    assert (channel_dir / "linux-64" / basename(testpkg)).read_bytes() == (
+        testpkg.read_bytes()
+    )
+
+
+async def test_upload_size_limit(
+    testpkg: Path, async_client: AsyncClient, monkeypatch, tmp_path: Path
+):
+    from conda_server.main import blob_store, channel_registry
+    from conda_server.utils import get_max_upload_size
+
+    channel_dir = Path(channel_registry.channel_dir("dev"))
+    package_path = channel_dir / "linux-64" / basename(testpkg)
+    package_path.unlink(missing_ok=True)
+    monkeypatch.setenv("CONDA_SERVER_MAX_UPLOAD_SIZE_LINUX_64", "1000")
+    get_max_upload_size.cache_clear()
+    try:
+        # Bodies with a known size are refused up front
+        response = await async_client.put(
+            f"/dev/linux-64/{basename(testpkg)}", content=testpkg.read_bytes()
+        )
+        assert response.status_code == 413
+
+        # Streamed bodies are aborted once they cross the limit
+        async def chunks():
+            content = testpkg.read_bytes()
+            for offset in range(0, len(content), 512):
+                yield content[offset : offset + 512]
+
+        response = await async_client.put(
+            f"/dev/linux-64/{basename(testpkg)}", content=chunks()
+        )
+        assert response.status_code == 413
+        assert not package_path.exists()
+        assert not list(Path(blob_store.root, "tmp").glob("*.tmp"))
+
+        # Other subdirs fall back to the global limit, which is unset
+        assert get_max_upload_size("noarch") is None
+    finally:
+        monkeypatch.delenv("CONDA_SERVER_MAX_UPLOAD_SIZE_LINUX_64")
+        get_max_upload_size.cache_clear()
+
+
+async def test_upload_backpressure(testpkg: Path, async_client: AsyncClient):
+    from conda_server.main import upload_limiter
+
+    with patch.object(upload_limiter, "_max_concurrent", 1):
+        slot = upload_limiter.acquire()
+        try:
+            response = await async_client.put(
+                f"/dev/linux-64/{basename(testpkg)}", content=testpkg.read_bytes()
+            )
+        finally:
+            slot.release()
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "5"
+
+
+async def test_api_key_scopes(testpkg: Path, async_client: AsyncClient, tmp_path: Path):
+    from conda_server import main
+    from conda_server.auth import Authenticator, KeyScope, generate_api_key
+
+    token, key = generate_api_key("ci")
+    key.scopes = [KeyScope(access="upload", channel="dev", subdir="linux-64")]
+    keys_file = tmp_path / "keys.json"
+    keys_file.write_text(json.dumps({"keys": [key.model_dump()]}))
+    authenticator = Authenticator(str(keys_file), require_download=True)
+
+    url = f"/dev/linux-64/{basename(testpkg)}"
+    with patch.object(main, "authenticator", authenticator):
+        response = await async_client.put(url, content=testpkg.read_bytes())
+        assert response.status_code == 401
+        response = await async_client.put(
+            url, content=testpkg.read_bytes(), headers={"X-API-Key": token + "x"}
+        )
+        assert response.status_code == 401
+        response = await async_client.put(
+            f"/dev/noarch/{basename(testpkg)}",
+            content=testpkg.read_bytes(),
+            headers={"X-API-Key": token},
+        )
+        assert response.status_code == 403
+        response = await async_client.put(
+            url, content=testpkg.read_bytes(), headers={"X-API-Key": token}
+        )
+        assert response.status_code == 200
+
+        # Upload access includes download access
+        response = await async_client.get(url)
+        assert response.status_code == 401
+        response = await async_client.get(url, headers={"X-API-Key": token})
+        assert response.status_code == 200
+        response = await async_client.get(
+            f"/linux-64/{basename(testpkg)}", headers={"X-API-Key": token}
+        )
+        assert response.status_code == 403
+
+
+async def test_snapshot_export_and_import(
+    testpkg: Path, async_client: AsyncClient, make_package
+):
+    from conda_server.main import blob_store, channel_registry
+    from conda_server.repodata import RepodataStore
+
+    source = Path(channel_registry.channel_dir("snapshot-source"))
+    (source / "linux-64").mkdir(parents=True, exist_ok=True)
+    shutil.copy(testpkg, source / "linux-64" / basename(testpkg))
+    store = RepodataStore(str(source), blob_store)
+    store.update("linux-64")
+    store.write_repodata("linux-64")
+
+    response = await async_client.get("/snapshot-source/snapshot")
+    assert response.status_code == 200
+    assert response.headers["Content-Type"] == "application/x-tar"
+
+    target = Path(channel_registry.channel_dir("snapshot-target"))
+    target.mkdir(parents=True, exist_ok=True)
+    response = await async_client.put(
+        "/snapshot-target/snapshot", content=response.content
+    )
+    assert response.status_code == 200
+    assert response.json()["packages"] == 1
+    assert (target / "linux-64" / basename(testpkg)).read_bytes() == (
+        testpkg.read_bytes()
+    )
+    response = await async_client.get("/snapshot-target/linux-64/repodata.json")
+    assert basename(testpkg) in response.json()["packages"]
+
+    response = await async_client.put("/snapshot-target/snapshot", content=b"junk")
+    assert response.status_code == 400
+
+
+async def test_snapshot_released_when_client_leaves(make_package, tmp_path: Path):
+    from starlette.requests import ClientDisconnect
+
+    from conda_server.blobs import BlobStore
+    from conda_server.main import SnapshotResponse
+    from conda_server.repodata import RepodataStore
+    from conda_server.snapshot import pin_snapshot
+
+    channel = tmp_path / "channel"
+    (channel / "linux-64").mkdir(parents=True)
+    blob_store = BlobStore(str(tmp_path / "blobs"))
+    with open(make_package("a-1.0-0.conda"), "rb") as f:
+        digest = blob_store.store(f, str(channel / "linux-64" / "a-1.0-0.conda"))
+    store = RepodataStore(str(channel), blob_store)
+    store.update("linux-64")
+    store.write_repodata("linux-64")
+    snapshot = pin_snapshot(blob_store, str(channel))
+    blob_store.release(str(channel / "linux-64" / "a-1.0-0.conda"))
+
+    async def send(message):
+        # The client is gone before the first chunk is sent
+        raise OSError("Connection reset")
+
+    response = SnapshotResponse(snapshot, "snapshot.tar")
+    scope = {"type": "http", "asgi": {"spec_version": "2.4"}}
+    with pytest.raises(ClientDisconnect):
+        await response(scope, AsyncMock(), send)
+    assert not Path(snapshot.directory).exists()
+    assert not blob_store.has(digest)
+
+
+async def test_rss_and_subdir_listing(async_client: AsyncClient):
+    from conda_server.main import channel_registry
+
+    channel = Path(channel_registry.channel_dir("listing"))
+    (channel / "linux-64").mkdir(parents=True, exist_ok=True)
+    (channel / "channeldata.json").write_text('{"packages": {}}')
+    (channel / "rss.xml").write_text("<rss></rss>")
+    (channel / "linux-64" / "repodata.json").write_text(
+        json.dumps({"packages": {"a-1.0-0.tar.bz2": {"size": 1}}})
+    )
+
+    # rss.xml serves the feed, not channeldata.json
+    response = await async_client.get("/listing/rss.xml")
+    assert response.status_code == 200
+    assert response.text == "<rss></rss>"
+    assert response.headers["Content-Type"] == "application/rss+xml"
+    response = await async_client.get(
+        "/listing/rss.xml", headers={"If-None-Match": response.headers["ETag"]}
+    )
+    assert response.status_code == 304
+
+    for path in "/listing/linux-64/", "/listing/linux-64/index.html":
+        response = await async_client.get(path)
+        assert response.status_code == 200
+        assert response.headers["Content-Type"].startswith("text/html")
+        assert '<a href="a-1.0-0.tar.bz2">' in response.text
+        assert "<title>listing/linux-64</title>" in response.text
+    response = await async_client.get(
+        "/listing/linux-64/", headers={"If-None-Match": response.headers["ETag"]}
+    )
+    assert response.status_code == 304
+    response = await async_client.get("/listing/linux-64/?page=2")
+    assert response.status_code == 404
+
+
+async def test_stream_events(async_client: AsyncClient, channel_dir: Path):
+    from conda_server.main import channel_registry, event_hub, stream_events
+
+    channel = channel_registry.get(None)
+    response = await stream_events(
+        since=None, last_event_id=None, api_key=None, channel=channel
+    )
+    assert response.media_type == "text/event-stream"
+    await event_hub.publish_generation(None, str(channel_dir), {"noarch"})
+    while (chunk := await anext(response.body_iterator)).startswith(b"id:"):  # type: ignore
+        if b"event: published" in chunk:
+            break
+    lines = chunk.decode().splitlines()  # type: ignore
+    assert lines[1] == "event: published"
+    assert json.loads(lines[2].removeprefix("data: "))["subdirs"] == ["noarch"]
+
+    # Resuming from the token of an event starts right after it
+    token = lines[0].removeprefix("id: ")
+    response = await stream_events(
+        since=None, last_event_id=token, api_key=None, channel=channel
+    )
+    await event_hub.publish_generation(None, str(channel_dir), {"noarch"})
+    chunk = await anext(response.body_iterator)  # type: ignore
+    # Generations still running from earlier tests may publish in between
+    token_id = int(token.rpartition("-")[2])
+    next_id = min(
+        e.id for e in event_hub._events if e.id > token_id and e.channel is None
+    )
+    assert chunk.decode().startswith(f"id: {event_hub.token(next_id)}\n")  # type: ignore
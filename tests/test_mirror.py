@@ -0,0 +1,144 @@
+import asyncio
+from pathlib import Path
+
+import httpx
+import pytest
+from fastapi import FastAPI, Request, Response
+
+from conda_server.mirror import Mirror, Upstream
+
+PACKAGE_CONTENT = b"package content" * 10000
+REPODATA_CONTENT = b'{"packages": {}}'
+
+
+@pytest.fixture
+def upstream_app() -> FastAPI:
+    upstream_app = FastAPI()
+    upstream_app.state.requests = []
+
+    @upstream_app.get("/linux-64/{filename}")
+    async def get_file(filename: str, request: Request):
+        upstream_app.state.requests.append((filename, dict(request.headers)))
+        if filename == "testpkg-0.0.1-py311_0.tar.bz2":
+            # Give concurrent requests a chance to pile up
+            await asyncio.sleep(0.05)
+            return Response(PACKAGE_CONTENT, media_type="application/x-tar")
+        if filename == "repodata.json":
+            if request.headers.get("If-None-Match") == '"v1"':
+                return Response(status_code=304)
+            return Response(
+                REPODATA_CONTENT,
+                media_type="application/json",
+                headers={"ETag": '"v1"'},
+            )
+        return Response(status_code=404)
+
+    return upstream_app
+
+
+@pytest.fixture
+def mirror(upstream_app: FastAPI, tmp_path: Path) -> Mirror:
+    client = httpx.AsyncClient(transport=httpx.ASGITransport(upstream_app))
+    return Mirror(Upstream("http://upstream", client=client), str(tmp_path), ttl=60)
+
+
+async def read_body(response) -> bytes:
+    if hasattr(response, "body_iterator"):
+        return b"".join([chunk async for chunk in response.body_iterator])
+    return Path(response.path).read_bytes()
+
+
+async def test_fetch_package(mirror: Mirror, upstream_app: FastAPI, tmp_path: Path):
+    response = await mirror.fetch_package(
+        "linux-64/testpkg-0.0.1-py311_0.tar.bz2",
+        "application/x-tar",
+        "testpkg-0.0.1-py311_0.tar.bz2",
+    )
+
+    assert await read_body(response) == PACKAGE_CONTENT
+    await asyncio.sleep(0.01)
+    assert (
+        tmp_path / "linux-64" / "testpkg-0.0.1-py311_0.tar.bz2"
+    ).read_bytes() == PACKAGE_CONTENT
+    assert not list((tmp_path / "linux-64").glob("*.tmp"))
+    assert len(upstream_app.state.requests) == 1
+
+
+async def test_fetch_package_collapses_concurrent_requests(
+    mirror: Mirror, upstream_app: FastAPI
+):
+    responses = await asyncio.gather(
+        *(
+            mirror.fetch_package(
+                "linux-64/testpkg-0.0.1-py311_0.tar.bz2",
+                "application/x-tar",
+                "testpkg-0.0.1-py311_0.tar.bz2",
+            )
+            for _ in range(5)
+        )
+    )
+
+    for response in responses:
+        assert await read_body(response) == PACKAGE_CONTENT
+    assert len(upstream_app.state.requests) == 1
+
+
+async def test_fetch_package_slow_client_does_not_stall_download(
+    upstream_app: FastAPI, tmp_path: Path
+):
+    client = httpx.AsyncClient(transport=httpx.ASGITransport(app=upstream_app))
+    mirror = Mirror(
+        Upstream("http://upstream", client=client), str(tmp_path), chunk_size=1024
+    )
+    path = "linux-64/testpkg-0.0.1-py311_0.tar.bz2"
+    slow = await mirror.fetch_package(
+        path, "application/x-tar", "testpkg-0.0.1-py311_0.tar.bz2"
+    )
+    body = slow.body_iterator
+    first = await anext(body)
+
+    # Far more chunks than were ever buffered for a client arrive meanwhile
+    waiting = await asyncio.wait_for(
+        mirror.fetch_package(
+            path, "application/x-tar", "testpkg-0.0.1-py311_0.tar.bz2"
+        ),
+        timeout=5,
+    )
+    assert await read_body(waiting) == PACKAGE_CONTENT
+
+    rest = b"".join([chunk async for chunk in body])
+    assert first + rest == PACKAGE_CONTENT
+
+
+async def test_fetch_package_not_found(mirror: Mirror, tmp_path: Path):
+    with pytest.raises(FileNotFoundError):
+        await mirror.fetch_package(
+            "linux-64/missing-0.0.1-py311_0.tar.bz2",
+            "application/x-tar",
+            "missing-0.0.1-py311_0.tar.bz2",
+        )
+    assert not (tmp_path / "linux-64" / "missing-0.0.1-py311_0.tar.bz2").exists()
+
+
+async def test_refresh_uses_conditional_requests(upstream_app: FastAPI, tmp_path: Path):
+    client = httpx.AsyncClient(transport=httpx.ASGITransport(upstream_app))
+    mirror = Mirror(Upstream("http://upstream", client=client), str(tmp_path), ttl=0)
+
+    await mirror.refresh("linux-64/repodata.json")
+    assert (tmp_path / "linux-64" / "repodata.json").read_bytes() == REPODATA_CONTENT
+
+    await mirror.refresh("linux-64/repodata.json")
+    assert (tmp_path / "linux-64" / "repodata.json").read_bytes() == REPODATA_CONTENT
+
+    assert len(upstream_app.state.requests) == 2
+    assert "if-none-match" not in upstream_app.state.requests[0][1]
+    assert upstream_app.state.requests[1][1]["if-none-match"] == '"v1"'
+
+
+async def test_refresh_within_ttl(
+    mirror: Mirror, upstream_app: FastAPI, tmp_path: Path
+):
+    await mirror.refresh("linux-64/repodata.json")
+    await mirror.refresh("linux-64/repodata.json")
+
+    assert len(upstream_app.state.requests) == 1
@@ -0,0 +1,64 @@
+import io
+from pathlib import Path
+
+import pytest
+
+from conda_server.packages import PackageError, inspect_package
+
+
+def test_inspect_tar_bz2(testpkg: Path):
+    with open(testpkg, "rb") as f:
+        index_json = inspect_package(f, testpkg.name, "linux-64")
+
+    assert index_json["name"] == "testpkg"
+    assert index_json["depends"] == ["python >=3.11,<3.12.0a0"]
+
+
+def test_inspect_conda(make_package):
+    path = make_package("pkg-1.0.0-py311_0.conda")
+
+    with open(path, "rb") as f:
+        index_json = inspect_package(f, path.name, "linux-64")
+
+    assert index_json["version"] == "1.0.0"
+
+
+@pytest.mark.parametrize(
+    "filename, platform",
+    [
+        ("testpkg-0.0.1-py311_0.tar.bz2", "noarch"),
+        ("testpkg-0.0.2-py311_0.tar.bz2", "linux-64"),
+        ("testpkg-0.0.1-py311_1.tar.bz2", "linux-64"),
+        ("other-0.0.1-py311_0.tar.bz2", "linux-64"),
+    ],
+)
+def test_inspect_rejects_mismatch(testpkg: Path, filename: str, platform: str):
+    with open(testpkg, "rb") as f, pytest.raises(PackageError):
+        inspect_package(f, filename, platform)
+
+
+@pytest.mark.parametrize(
+    "filename", ["pkg-1.0.0-py311_0.tar.bz2", "pkg-1.0.0-py311_0.conda"]
+)
+def test_inspect_rejects_truncated_package(make_package, filename: str):
+    content = make_package(filename).read_bytes()
+
+    with pytest.raises(PackageError):
+        inspect_package(io.BytesIO(content[: len(content) // 2]), filename, "linux-64")
+
+
+def test_inspect_rejects_invalid_archive():
+    with pytest.raises(PackageError):
+        inspect_package(io.BytesIO(b"0" * 1024), "pkg-1.0.0-py311_0.conda", "noarch")
+    with pytest.raises(PackageError):
+        inspect_package(io.BytesIO(b"0" * 1024), "pkg-1.0.0-py311_0.tar.bz2", "noarch")
+
+
+def test_inspect_reads_only_what_it_needs(make_package):
+    path = make_package("pkg-1.0.0-py311_0.conda")
+    content = path.read_bytes() + b"trailing data that is never read" * 1000
+    fileobj = io.BytesIO(content)
+
+    inspect_package(fileobj, path.name, "linux-64")
+
+    assert fileobj.tell() < len(content)
@@ -0,0 +1,87 @@
+import asyncio
+from pathlib import Path
+from unittest.mock import AsyncMock, patch
+
+import pytest
+from httpx import ASGITransport, AsyncClient
+from starlette.applications import Starlette
+from starlette.responses import PlainTextResponse
+from starlette.routing import Route
+
+from conda_server.ratelimit import (
+    MemoryBackend,
+    RateLimiter,
+    RateLimitMiddleware,
+    SQLiteBackend,
+    client_key,
+)
+
+
+def test_memory_backend():
+    backend = MemoryBackend(max_clients=2)
+    with patch("conda_server.ratelimit.time.monotonic", return_value=100.0):
+        # A full bucket allows a burst, then requests are refused
+        assert backend.take("a", 1.0, 2.0, 1.0, debt=False) == 0
+        assert backend.take("a", 1.0, 2.0, 1.0, debt=False) == 0
+        assert backend.take("a", 1.0, 2.0, 1.0, debt=False) == pytest.approx(1.0)
+        # Bandwidth is taken on credit
+        assert backend.take("b", 10.0, 10.0, 30.0, debt=True) == pytest.approx(2.0)
+        assert backend.take("b", 10.0, 10.0, 10.0, debt=True) == pytest.approx(3.0)
+    with patch("conda_server.ratelimit.time.monotonic", return_value=101.0):
+        assert backend.take("a", 1.0, 2.0, 1.0, debt=False) == 0
+        # The least recently used client is evicted
+        backend.take("c", 1.0, 2.0, 1.0, debt=False)
+        assert backend.take("b", 10.0, 10.0, 10.0, debt=True) == 0
+
+
+def test_sqlite_backend_is_shared(tmp_path: Path):
+    workers = [SQLiteBackend(str(tmp_path / "ratelimit.db")) for _ in range(2)]
+    assert workers[0].take("a", 0.001, 2.0, 1.0, debt=False) == 0
+    assert workers[1].take("a", 0.001, 2.0, 1.0, debt=False) == 0
+    assert workers[0].take("a", 0.001, 2.0, 1.0, debt=False) > 0
+
+
+async def test_throttle():
+    rate_limiter = RateLimiter(bytes_per_second=100, bytes_burst=100)
+
+    async def chunks():
+        for _ in range(3):
+            yield b"x" * 100
+
+    with patch("conda_server.ratelimit.asyncio.sleep", AsyncMock()) as mock_sleep:
+        received = [chunk async for chunk in rate_limiter.throttle("a", chunks())]
+    assert received == [b"x" * 100] * 3
+    # The burst covers the first chunk, the others are sent a second apart
+    assert [call.args[0] for call in mock_sleep.call_args_list] == pytest.approx(
+        [1.0, 2.0], abs=0.1
+    )
+
+
+async def test_middleware():
+    app = Starlette(routes=[Route("/", lambda request: PlainTextResponse("ok"))])
+    app.add_middleware(
+        RateLimitMiddleware,
+        rate_limiter=RateLimiter(requests_per_second=0.01, request_burst=1),
+        identify_key={"a.secret": "a", "b.secret": "b"}.get,
+    )
+    async with AsyncClient(
+        transport=ASGITransport(app), base_url="http://test"
+    ) as client:
+        headers = {"X-API-Key": "a.secret"}
+        assert (await client.get("/", headers=headers)).status_code == 200
+        response = await client.get("/", headers=headers)
+        assert response.status_code == 429
+        assert int(response.headers["Retry-After"]) > 0
+        # Other clients have their own limits
+        headers = {"X-API-Key": "b.secret"}
+        assert (await client.get("/", headers=headers)).status_code == 200
+        assert (await client.get("/")).status_code == 200
+        # Unverified keys are limited by address, with clients without keys
+        headers = {"X-API-Key": "c.secret"}
+        assert (await client.get("/", headers=headers)).status_code == 429
+
+
+def test_client_key():
+    assert client_key("ci", "10.0.0.1") == "key:ci"
+    assert client_key(None, "10.0.0.1") == "ip:10.0.0.1"
+    assert client_key(None, None) == "ip:unknown"
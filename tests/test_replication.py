@@ -0,0 +1,203 @@
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import time
+from pathlib import Path
+from types import SimpleNamespace
+from unittest.mock import MagicMock
+
+import httpx
+import pytest
+
+from conda_server.blobs import BlobStore
+from conda_server.replication import ChangeLog
+from conda_server.repodata import RepodataStore
+
+
+@pytest.fixture
+def channel(make_package, tmp_path: Path) -> Path:
+    channel_dir = tmp_path / "channel"
+    (channel_dir / "linux-64").mkdir(parents=True)
+    for filename in "a-1.0-0.tar.bz2", "b-2.0-0.conda":
+        os.link(make_package(filename), channel_dir / "linux-64" / filename)
+    return channel_dir
+
+
+def publish(channel_dir: Path, subdir="linux-64") -> None:
+    store = RepodataStore(str(channel_dir), BlobStore(str(channel_dir / ".blobs")))
+    store.update(subdir)
+    store.write_repodata(subdir)
+
+
+async def test_change_log(channel: Path, tmp_path: Path):
+    change_log = ChangeLog(str(tmp_path / "replication.db"), max_entries=4)
+    publish(channel)
+    assert await change_log.record(None, str(channel), {"linux-64"}) == 3
+
+    log = change_log.read(0)
+    assert [(c["kind"], c["path"]) for c in log["changes"]] == [
+        ("upload", "linux-64/a-1.0-0.tar.bz2"),
+        ("upload", "linux-64/b-2.0-0.conda"),
+        ("index", None),
+    ]
+    assert log["changes"][0]["sha256"]
+    assert log["changes"][2]["subdirs"] == ["linux-64"]
+    assert (log["first"], log["last"], log["channels"]) == (1, 3, [None])
+
+    # Only the packages that changed since the last generation are logged
+    (channel / "linux-64" / "a-1.0-0.tar.bz2").unlink()
+    publish(channel)
+    assert await change_log.record(None, str(channel), None) == 2
+    log = change_log.read(3)
+    assert [(c["kind"], c["path"]) for c in log["changes"]] == [
+        ("delete", "linux-64/a-1.0-0.tar.bz2"),
+        ("index", None),
+    ]
+    assert log["changes"][1]["subdirs"] is None
+
+    # The oldest entries are trimmed, but the sequence carries on
+    log = change_log.read(0)
+    assert (log["first"], log["last"], len(log["changes"])) == (2, 5, 4)
+    assert ChangeLog(str(tmp_path / "replication.db")).read(0)["epoch"] == log["epoch"]
+
+
+async def test_change_log_baseline(channel: Path, tmp_path: Path):
+    # The leader published its channel before it had a change log
+    publish(channel)
+    change_log = ChangeLog(str(tmp_path / "replication.db"))
+    leader_channel = SimpleNamespace(
+        name=None, directory=str(channel), index_manager=MagicMock()
+    )
+
+    change_log.attach(leader_channel)  # type: ignore
+    await asyncio.gather(*change_log._tasks)
+    log = change_log.read(0)
+    assert log["channels"] == [None]
+    assert [(c["kind"], c["path"]) for c in log["changes"]] == [
+        ("upload", "linux-64/a-1.0-0.tar.bz2"),
+        ("upload", "linux-64/b-2.0-0.conda"),
+        ("index", None),
+    ]
+
+    # Channels the log knows get no other baseline, e.g. from another worker
+    change_log.attach(leader_channel)  # type: ignore
+    await asyncio.gather(*change_log._tasks)
+    assert change_log.read(0)["last"] == 3
+
+
+async def test_change_log_wait(channel: Path, tmp_path: Path):
+    change_log = ChangeLog(str(tmp_path / "replication.db"))
+    started = time.monotonic()
+    await change_log.wait(0, 0.1)
+    assert time.monotonic() - started >= 0.1
+
+    # Waiters wake up as soon as a generation is logged
+    wait = asyncio.create_task(change_log.wait(0, 10))
+    await asyncio.sleep(0.05)
+    assert not wait.done()
+    publish(channel)
+    await change_log.record(None, str(channel), {"linux-64"})
+    await asyncio.wait_for(wait, 1)
+
+
+def start_server(tmp_path: Path, name: str, **env: str) -> tuple[str, subprocess.Popen]:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    url = f"http://127.0.0.1:{port}"
+    process = subprocess.Popen(
+        [
+            *(sys.executable, "-m", "uvicorn", "conda_server.main:app"),
+            *("--port", str(port), "--log-level", "warning"),
+        ],
+        env={
+            **{k: v for k, v in os.environ.items() if not k.startswith("CONDA_")},
+            "CONDA_CHANNEL_DIR": str(tmp_path / name / "channel"),
+            "CONDA_SERVER_WARMUP_BYTES": "0",
+            **env,
+        },
+    )
+    deadline = time.monotonic() + 30
+    while True:
+        try:
+            httpx.get(f"{url}/noarch/repodata.json")
+            return url, process
+        except httpx.ConnectError:
+            if process.poll() is not None or time.monotonic() > deadline:
+                process.kill()
+                raise
+            time.sleep(0.1)
+
+
+@pytest.fixture
+def servers(tmp_path: Path):
+    processes = []
+    try:
+        leader_url, process = start_server(tmp_path, "leader")
+        processes.append(process)
+        follower_url, process = start_server(
+            tmp_path,
+            "follower",
+            CONDA_SERVER_REPLICATE_FROM=leader_url,
+            CONDA_SERVER_REPLICATION_WAIT="1",
+        )
+        processes.append(process)
+        yield leader_url, follower_url
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            try:
+                process.wait(10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+
+def wait_for_repodata(url: str, predicate, timeout=30.0) -> dict:
+    deadline = time.monotonic() + timeout
+    while True:
+        response = httpx.get(url)
+        if response.status_code == 200 and predicate(repodata := response.json()):
+            return repodata
+        assert time.monotonic() < deadline, f"Timed out waiting for {url}"
+        time.sleep(0.1)
+
+
+def test_follower_replicates_leader(make_package, servers, tmp_path: Path):
+    leader, follower = servers
+    (tmp_path / "leader" / "channels" / "extra").mkdir(parents=True)
+    package = make_package("a-1.0-0.conda")
+    for prefix in "", "/extra":
+        with open(package, "rb") as f:
+            response = httpx.post(
+                f"{leader}{prefix}/linux-64/batch",
+                files={"files": (package.name, f)},
+            )
+        assert response.status_code == 200
+
+    # The follower serves the leader's packages and index
+    for prefix in "", "/extra":
+        wait_for_repodata(
+            f"{follower}{prefix}/linux-64/repodata.json",
+            lambda repodata: package.name in repodata["packages.conda"],
+        )
+        response = httpx.get(f"{follower}{prefix}/linux-64/{package.name}")
+        assert response.content == package.read_bytes()
+    assert (tmp_path / "follower" / "channels" / "extra" / "linux-64").is_dir()
+
+    # Followers are read-only
+    with open(package, "rb") as f:
+        response = httpx.put(f"{follower}/linux-64/b-1.0-0.conda", files={"file": f})
+    assert response.status_code == 403
+
+    response = httpx.post(
+        f"{leader}/linux-64/batch/delete", json={"files": [package.name]}
+    )
+    assert response.status_code == 200
+    wait_for_repodata(
+        f"{follower}/linux-64/repodata.json",
+        lambda repodata: package.name not in repodata["packages.conda"],
+    )
+    assert httpx.get(f"{follower}/linux-64/{package.name}").status_code == 404
@@ -0,0 +1,89 @@
+import bz2
+import json
+import os
+from pathlib import Path
+from unittest.mock import patch
+
+import zstandard
+
+from conda_server.blobs import BlobStore
+from conda_server.repodata import RepodataStore
+
+
+def test_write_repodata(testpkg: Path, make_package, tmp_path: Path):
+    channel_dir = tmp_path / "channel"
+    (channel_dir / "linux-64").mkdir(parents=True)
+    os.link(testpkg, channel_dir / "linux-64" / testpkg.name)
+    conda_package = make_package("other-1.0.0-0.conda")
+    os.link(conda_package, channel_dir / "linux-64" / conda_package.name)
+
+    repodata_store = RepodataStore(str(channel_dir), BlobStore(str(tmp_path / "b")))
+    assert repodata_store.update("linux-64") == {"testpkg", "other"}
+    repodata_store.write_repodata("linux-64")
+
+    content = (channel_dir / "linux-64" / "repodata.json").read_bytes()
+    repodata = json.loads(content)
+    assert repodata["info"] == {"subdir": "linux-64"}
+    assert repodata["removed"] == []
+    assert repodata["repodata_version"] == 1
+    record = repodata["packages"][testpkg.name]
+    assert record["md5"] == "ec370971727ce7870eba47f8ad2847ba"
+    assert record["size"] == testpkg.stat().st_size
+    assert "arch" not in record and "platform" not in record
+    assert list(repodata["packages.conda"]) == [conda_package.name]
+
+    # The document is compact and sorted, like conda-index writes it
+    assert (
+        content == json.dumps(repodata, sort_keys=True, separators=(",", ":")).encode()
+    )
+    repodata_path = channel_dir / "linux-64" / "repodata.json"
+    assert bz2.decompress(Path(f"{repodata_path}.bz2").read_bytes()) == content
+    assert (
+        zstandard.ZstdDecompressor()
+        .decompressobj()
+        .decompress(Path(f"{repodata_path}.zst").read_bytes())
+        == content
+    )
+    assert (channel_dir / "linux-64" / "repodata_from_packages.json").read_bytes() == (
+        content
+    )
+
+
+def test_update_only_reads_changed_packages(make_package, tmp_path: Path):
+    channel_dir = tmp_path / "channel"
+    (channel_dir / "noarch").mkdir(parents=True)
+    repodata_store = RepodataStore(str(channel_dir), BlobStore(str(tmp_path / "b")))
+    first = make_package("first-1.0.0-0.tar.bz2", subdir="noarch")
+    second = make_package("second-1.0.0-0.tar.bz2", subdir="noarch")
+    os.link(first, channel_dir / "noarch" / first.name)
+    repodata_store.update("noarch")
+
+    os.link(second, channel_dir / "noarch" / second.name)
+    with patch.object(
+        repodata_store, "_extract", wraps=repodata_store._extract
+    ) as mock_extract:
+        assert repodata_store.update("noarch") == {"second"}
+        mock_extract.assert_called_once_with(str(channel_dir / "noarch" / second.name))
+
+    (channel_dir / "noarch" / first.name).unlink()
+    assert repodata_store.update("noarch") == {"first"}
+    repodata_store.write_repodata("noarch")
+    repodata = json.loads((channel_dir / "noarch" / "repodata.json").read_bytes())
+    assert list(repodata["packages"]) == [second.name]
+
+
+def test_add_uses_known_metadata(testpkg: Path, tmp_path: Path):
+    channel_dir = tmp_path / "channel"
+    (channel_dir / "linux-64").mkdir(parents=True)
+    blob_store = BlobStore(str(tmp_path / "b"))
+    repodata_store = RepodataStore(str(channel_dir), blob_store)
+    path = channel_dir / "linux-64" / testpkg.name
+    with open(testpkg, "rb") as f:
+        blob_store.store(f, str(path))
+
+    metadata = {"name": "testpkg", "version": "0.0.1", "build": "py311_0"}
+    repodata_store.add(str(path), metadata)
+
+    with patch.object(repodata_store, "_extract") as mock_extract:
+        assert repodata_store.update("linux-64") == set()
+        mock_extract.assert_not_called()
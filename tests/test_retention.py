@@ -0,0 +1,130 @@
+import io
+import os
+from pathlib import Path
+from unittest.mock import patch
+
+import pytest
+
+from conda_server.blobs import BlobStore
+from conda_server.repodata import RepodataStore
+from conda_server.retention import RetentionPolicy, plan_retention
+
+NOW = 1_700_000_000.0
+DAY = 86400.0
+
+
+@pytest.fixture
+def subdir(tmp_path: Path) -> Path:
+    subdir = tmp_path / "linux-64"
+    subdir.mkdir()
+    return subdir
+
+
+def add_package(subdir: Path, filename: str, age: float = 0.0, size: int = 10):
+    path = subdir / filename
+    path.write_bytes(b"0" * size)
+    os.utime(path, (NOW - age, NOW - age))
+    return path
+
+
+def planned(subdir: Path, **policy) -> list[str]:
+    report = plan_retention(str(subdir.parent), RetentionPolicy(**policy), now=NOW)
+    return [os.path.basename(path) for path in report.paths]
+
+
+def test_keep_versions(subdir: Path):
+    add_package(subdir, "pkg-1.2.0-py311_0.tar.bz2")
+    add_package(subdir, "pkg-1.10.0-py311_0.tar.bz2")
+    add_package(subdir, "pkg-1.9.0-py311_0.tar.bz2")
+    add_package(subdir, "pkg-1.9.0-py311_0.conda")
+    add_package(subdir, "other-0.1.0-py311_0.tar.bz2")
+
+    assert planned(subdir, keep_versions=1) == [
+        "pkg-1.2.0-py311_0.tar.bz2",
+        "pkg-1.9.0-py311_0.conda",
+        "pkg-1.9.0-py311_0.tar.bz2",
+    ]
+
+
+def test_keep_builds(subdir: Path):
+    add_package(subdir, "pkg-1.0.0-py311_2.tar.bz2")
+    add_package(subdir, "pkg-1.0.0-py311_10.tar.bz2")
+    add_package(subdir, "pkg-1.0.0-py311_0.tar.bz2")
+
+    assert planned(subdir, keep_builds=2) == ["pkg-1.0.0-py311_0.tar.bz2"]
+
+
+def test_max_age_keeps_newest_package(subdir: Path):
+    add_package(subdir, "pkg-1.0.0-py311_0.tar.bz2", age=30 * DAY)
+    add_package(subdir, "pkg-1.1.0-py311_0.tar.bz2", age=20 * DAY)
+    add_package(subdir, "pkg-1.2.0-py311_0.tar.bz2", age=1 * DAY)
+    add_package(subdir, "stable-1.0.0-py311_0.tar.bz2", age=365 * DAY)
+
+    assert planned(subdir, max_age=7 * DAY) == [
+        "pkg-1.0.0-py311_0.tar.bz2",
+        "pkg-1.1.0-py311_0.tar.bz2",
+    ]
+
+
+def test_max_bytes_deletes_oldest_first(subdir: Path):
+    add_package(subdir, "pkg-1.0.0-py311_0.tar.bz2", age=3 * DAY)
+    add_package(subdir, "pkg-1.1.0-py311_0.tar.bz2", age=2 * DAY)
+    add_package(subdir, "pkg-1.2.0-py311_0.tar.bz2", age=1 * DAY)
+
+    assert planned(subdir, max_bytes=20) == ["pkg-1.0.0-py311_0.tar.bz2"]
+    assert planned(subdir, max_bytes=20, subdir_max_bytes={"linux-64": 10}) == [
+        "pkg-1.0.0-py311_0.tar.bz2",
+        "pkg-1.1.0-py311_0.tar.bz2",
+    ]
+
+
+def test_pinned_packages_are_kept(subdir: Path):
+    add_package(subdir, "pkg-1.0.0-py311_0.tar.bz2")
+    add_package(subdir, "pkg-1.1.0-py311_0.tar.bz2")
+    add_package(subdir, "pkg-2.0.0-py311_0.tar.bz2")
+
+    assert planned(subdir, keep_versions=1, pinned=["pkg=1.0.*"]) == [
+        "pkg-1.1.0-py311_0.tar.bz2"
+    ]
+
+
+def test_report_counts_freed_blobs(subdir: Path):
+    add_package(subdir, "pkg-1.0.0-py311_0.tar.bz2", size=100)
+    add_package(subdir, "pkg-1.1.0-py311_0.tar.bz2")
+    # Simulate another channel referencing the same blob as the old package
+    os.link(subdir / "pkg-1.0.0-py311_0.tar.bz2", subdir.parent / "blob")
+    os.link(subdir / "pkg-1.0.0-py311_0.tar.bz2", subdir.parent / "other")
+
+    report = plan_retention(
+        str(subdir.parent), RetentionPolicy(keep_versions=1), now=NOW
+    )
+
+    assert report.index_entries_saved == 1
+    assert report.bytes_saved == 0
+
+
+def test_max_age_uses_upload_time(tmp_path: Path):
+    blob_store = BlobStore(str(tmp_path / "blobs"))
+    first = tmp_path / "first" / "linux-64"
+    second = tmp_path / "second" / "linux-64"
+    first.mkdir(parents=True)
+    second.mkdir(parents=True)
+    filename = "pkg-1.0.0-py311_0.tar.bz2"
+    digest = blob_store.store(io.BytesIO(b"0" * 10), str(first / filename))
+    # The blob was uploaded to the first channel long ago
+    os.utime(first / filename, (NOW - 30 * DAY, NOW - 30 * DAY))
+
+    # Re-uploading it to the second channel makes it new there
+    blob_store.link(digest, str(second / filename))
+    add_package(second, "pkg-1.1.0-py311_0.tar.bz2")
+    repodata = RepodataStore(str(second.parent), blob_store)
+    with patch("conda_server.repodata.time.time", return_value=NOW):
+        repodata.add(str(second / filename), {"name": "pkg"})
+
+    policy = RetentionPolicy(max_age=7 * DAY)
+    report = plan_retention(str(second.parent), policy, now=NOW, repodata=repodata)
+    assert report.paths == []
+    # Without upload times, the age of the blob is all there is
+    assert plan_retention(str(second.parent), policy, now=NOW).paths == [
+        str(second / filename)
+    ]
@@ -0,0 +1,206 @@
+import io
+import json
+import os
+import tarfile
+from pathlib import Path
+
+import pytest
+
+from conda_server.blobs import BlobStore
+from conda_server.repodata import RepodataStore
+from conda_server.snapshot import (
+    SnapshotConflict,
+    commit_snapshot,
+    pin_snapshot,
+    release_stale_snapshots,
+    stage_snapshot,
+)
+
+
+@pytest.fixture
+def source(make_package, tmp_path: Path) -> Path:
+    # A channel with published index files
+    channel_dir = tmp_path / "source"
+    (channel_dir / "linux-64").mkdir(parents=True)
+    blob_store = BlobStore(str(tmp_path / "source-blobs"))
+    for filename in "a-1.0-0.tar.bz2", "b-2.0-0.conda":
+        with open(make_package(filename), "rb") as f:
+            blob_store.store(f, str(channel_dir / "linux-64" / filename))
+    store = RepodataStore(str(channel_dir), blob_store)
+    store.update("linux-64")
+    store.write_repodata("linux-64")
+    (channel_dir / "channeldata.json").write_text('{"packages": {}}')
+    (channel_dir / "linux-64" / "index.html").write_text("<html></html>")
+    return channel_dir
+
+
+def pin(source: Path, include_packages=True):
+    blob_store = BlobStore(str(source.parent / "source-blobs"))
+    return pin_snapshot(blob_store, str(source), include_packages)
+
+
+def archive(snapshot) -> bytes:
+    parts = []
+    for part in snapshot.parts():
+        parts.append(part if isinstance(part, bytes) else Path(part[0]).read_bytes())
+    return b"".join(parts)
+
+
+def test_pin_snapshot(source: Path):
+    snapshot = pin(source)
+    # Packages that aren't published yet are left out
+    (source / "linux-64" / "c-1.0-0.conda").write_bytes(b"c")
+    # The pinned files stay as they were when the snapshot was taken
+    (source / "linux-64" / "a-1.0-0.tar.bz2").unlink()
+    (source / "linux-64" / "repodata.json").unlink()
+
+    content = archive(snapshot)
+    with tarfile.open(fileobj=io.BytesIO(content)) as tar:
+        names = tar.getnames()
+        manifest = json.load(tar.extractfile("snapshot.json"))  # type: ignore
+        assert tar.extractfile("linux-64/repodata.json") is not None
+    assert names[0] == "snapshot.json"
+    assert set(manifest["packages"]) == {
+        "linux-64/a-1.0-0.tar.bz2",
+        "linux-64/b-2.0-0.conda",
+    }
+    assert "linux-64/c-1.0-0.conda" not in names
+    assert {"channeldata.json", "linux-64/index.html"} <= set(manifest["index_files"])
+    assert names.index("linux-64/b-2.0-0.conda") < names.index("channeldata.json")
+
+    snapshot.release()
+    assert not os.path.exists(snapshot.directory)
+
+
+def test_release_snapshot_drops_blobs(source: Path, tmp_path: Path):
+    blob_store = BlobStore(str(tmp_path / "source-blobs"))
+    snapshot = pin_snapshot(blob_store, str(source))
+    # Pins are kept out of the channel
+    assert not Path(snapshot.directory).is_relative_to(source)
+    package = snapshot.manifest["packages"]["linux-64/a-1.0-0.tar.bz2"]
+
+    # The pin keeps the blob of a package deleted meanwhile until it is released
+    blob_store.release(str(source / "linux-64" / "a-1.0-0.tar.bz2"))
+    assert blob_store.has(package["sha256"])
+    snapshot.release()
+    assert not blob_store.has(package["sha256"])
+    assert blob_store.collect_garbage() == 0
+    assert (source / "linux-64" / "b-2.0-0.conda").exists()
+
+
+def test_release_stale_snapshots(source: Path, tmp_path: Path):
+    blob_store = BlobStore(str(tmp_path / "source-blobs"))
+    live = pin_snapshot(blob_store, str(source))
+    stale = pin_snapshot(blob_store, str(source))
+    digest = stale.manifest["packages"]["linux-64/a-1.0-0.tar.bz2"]["sha256"]
+    blob_store.release(str(source / "linux-64" / "a-1.0-0.tar.bz2"))
+    # The process streaming the snapshot died without releasing it
+    stale._lock.release()
+
+    assert release_stale_snapshots(blob_store) == 1
+    assert not os.path.exists(stale.directory)
+    # Snapshots that are still being streamed keep their pins
+    assert os.path.exists(live.directory)
+    assert blob_store.has(digest)
+    live.release()
+    assert not blob_store.has(digest)
+    assert release_stale_snapshots(blob_store) == 0
+
+
+def test_import_snapshot(source: Path, tmp_path: Path):
+    content = archive(pin(source))
+    target = tmp_path / "target"
+    target.mkdir()
+    blob_store = BlobStore(str(tmp_path / "target-blobs"))
+    store = RepodataStore(str(target), blob_store)
+
+    staged = stage_snapshot(blob_store, str(target), io.BytesIO(content))
+    # Nothing changes in the channel before the snapshot is committed
+    assert not (target / "linux-64").exists()
+    commit_snapshot(blob_store, store, staged)
+
+    for name in (
+        "linux-64/a-1.0-0.tar.bz2",
+        "linux-64/repodata.json",
+        "channeldata.json",
+    ):
+        assert (target / name).read_bytes() == (source / name).read_bytes()
+    # The repodata records come with the packages, so nothing is extracted
+    assert store.update("linux-64") == set()
+    assert not list((tmp_path / "target-blobs" / "tmp").iterdir())
+    assert not list((target / ".conda-server" / "imports").iterdir())
+
+
+def test_import_snapshot_rejects_corrupt_package(source: Path, tmp_path: Path):
+    snapshot = pin(source)
+    manifest = snapshot.manifest["packages"]["linux-64/b-2.0-0.conda"]
+    manifest["sha256"] = "0" * 64
+    target = tmp_path / "target"
+    target.mkdir()
+    blob_store = BlobStore(str(tmp_path / "target-blobs"))
+
+    with pytest.raises(ValueError, match="Digest mismatch"):
+        stage_snapshot(blob_store, str(target), io.BytesIO(archive(snapshot)))
+    assert not list((tmp_path / "target-blobs" / "tmp").iterdir())
+
+
+def test_import_snapshot_rejects_truncated_archive(source: Path, tmp_path: Path):
+    content = archive(pin(source))
+    target = tmp_path / "target"
+    target.mkdir()
+    blob_store = BlobStore(str(tmp_path / "target-blobs"))
+
+    with pytest.raises((tarfile.TarError, ValueError)):
+        stage_snapshot(blob_store, str(target), io.BytesIO(content[:3000]))
+    assert not list((tmp_path / "target-blobs" / "tmp").iterdir())
+
+
+def test_import_snapshot_conflict(source: Path, tmp_path: Path):
+    content = archive(pin(source))
+    target = tmp_path / "target"
+    (target / "linux-64").mkdir(parents=True)
+    (target / "linux-64" / "z-1.0-0.conda").write_bytes(b"z")
+    blob_store = BlobStore(str(tmp_path / "target-blobs"))
+
+    staged = stage_snapshot(blob_store, str(target), io.BytesIO(content))
+    with pytest.raises(SnapshotConflict):
+        commit_snapshot(blob_store, RepodataStore(str(target), blob_store), staged)
+    assert not (target / "linux-64" / "a-1.0-0.tar.bz2").exists()
+    assert not list((tmp_path / "target-blobs" / "tmp").iterdir())
+
+
+def test_snapshot_without_packages(source: Path, tmp_path: Path):
+    snapshot = pin(source, include_packages=False)
+    assert not (Path(snapshot.directory) / "linux-64" / "a-1.0-0.tar.bz2").exists()
+    content = archive(snapshot)
+    target = tmp_path / "target"
+    target.mkdir()
+    blob_store = BlobStore(str(tmp_path / "target-blobs"))
+
+    # The manifest still lists the packages, but only index files are staged
+    staged = stage_snapshot(blob_store, str(target), io.BytesIO(content))
+    assert staged.packages == {}
+    assert "linux-64/b-2.0-0.conda" in staged.manifest["packages"]
+    with pytest.raises(ValueError, match="doesn't include its packages"):
+        commit_snapshot(blob_store, RepodataStore(str(target), blob_store), staged)
+    assert not (target / "linux-64" / "repodata.json").exists()
+
+
+def test_import_snapshot_rejects_package_index_files(tmp_path: Path):
+    manifest = json.dumps(
+        {
+            "format": 1,
+            "packages": {},
+            "index_files": {"linux-64/a-1.0-0.conda": 1},
+        }
+    ).encode()
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w") as tar:
+        info = tarfile.TarInfo("snapshot.json")
+        info.size = len(manifest)
+        tar.addfile(info, io.BytesIO(manifest))
+    blob_store = BlobStore(str(tmp_path / "target-blobs"))
+
+    # Package files must go through the packages, which are inspected
+    with pytest.raises(ValueError, match="listed as an index file"):
+        stage_snapshot(blob_store, str(tmp_path), io.BytesIO(buffer.getvalue()))
@@ -0,0 +1,38 @@
+import pytest
+
+from conda_server.uploads import UploadLimiter, UploadsBusy, upload_subdir
+
+
+def test_upload_limiter():
+    upload_limiter = UploadLimiter(max_concurrent=2, max_bytes=100)
+    first = upload_limiter.acquire(60)
+    with pytest.raises(UploadsBusy):
+        upload_limiter.acquire(50)
+    # Uploads of unknown size reserve their bytes as they arrive
+    second = upload_limiter.acquire()
+    second.reserve(30)
+    with pytest.raises(UploadsBusy):
+        second.reserve(50)
+    assert upload_limiter.bytes_in_flight == 90
+    with pytest.raises(UploadsBusy):
+        upload_limiter.acquire()
+
+    first.release()
+    second.release()
+    assert upload_limiter.active == 0
+    assert upload_limiter.bytes_in_flight == 0
+
+
+@pytest.mark.parametrize(
+    "method, path, expected",
+    [
+        ("PUT", "/linux-64/tool-1.0-0.conda", "linux-64"),
+        ("PUT", "/dev/noarch/tool-1.0-0.conda", "noarch"),
+        ("POST", "/dev/osx-arm64/batch", "osx-arm64"),
+        ("POST", "/linux-64/batch/delete", None),
+        ("GET", "/linux-64/tool-1.0-0.conda", None),
+        ("PUT", "/dev/tool-1.0-0.conda", None),
+    ],
+)
+def test_upload_subdir(method, path, expected):
+    assert upload_subdir(method, path) == expected
@@ -1,7 +1,4 @@
-import os
-
 import pytest
-from fastapi import HTTPException
 
 
 @pytest.mark.parametrize(
@@ -29,34 +26,70 @@ from fastapi import HTTPException
             ("testpkg", "0.0.1+20240605140000", "py311_0", "tar.bz2"),
         ),
         ("testpkg-0.0.1-py311_0.conda", ("testpkg", "0.0.1", "py311_0", "conda")),
-        ("te$tpkg-0.0.1-py311_0.tar.bz2", HTTPException),
-        ("testpkg-0.1-py311_0.tar.bz2", HTTPException),
-        ("testpkg-0.1.-py311_0.tar.bz2", HTTPException),
-        ("testpkg-0..1-py311_0.tar.bz2", HTTPException),
-        ("testpkg-0.a.1-py311_0.tar.bz2", HTTPException),
-        ("testpkg-0.0.1.0-py311_0.tar.bz2", HTTPException),
-        ("testpkg-00.0.1-py311_0.tar.bz2", HTTPException),
-        ("testpkg-0.0.1--py311_0.tar.bz2", HTTPException),
-        ("testpkg-0.0.1+-py311_0.tar.bz2", HTTPException),
-        ("testpkg-0.0.1-alpha.-py311_0.tar.bz2", HTTPException),
-        ("testpkg-0.0.1+20240605140000!-py311_0.tar.bz2", HTTPException),
-        ("testpkg-v0.0.1-py311_0.tar.bz2", HTTPException),
-        ("testpkg-0.0.1-py311_0.zip", HTTPException),
+        ("te$tpkg-0.0.1-py311_0.tar.bz2", ValueError),
+        ("testpkg-0.1-py311_0.tar.bz2", ValueError),
+        ("testpkg-0.1.-py311_0.tar.bz2", ValueError),
+        ("testpkg-0..1-py311_0.tar.bz2", ValueError),
+        ("testpkg-0.a.1-py311_0.tar.bz2", ValueError),
+        ("testpkg-0.0.1.0-py311_0.tar.bz2", ValueError),
+        ("testpkg-00.0.1-py311_0.tar.bz2", ValueError),
+        ("testpkg-0.0.1--py311_0.tar.bz2", ValueError),
+        ("testpkg-0.0.1+-py311_0.tar.bz2", ValueError),
+        ("testpkg-0.0.1-alpha.-py311_0.tar.bz2", ValueError),
+        ("testpkg-0.0.1+20240605140000!-py311_0.tar.bz2", ValueError),
+        ("testpkg-v0.0.1-py311_0.tar.bz2", ValueError),
+        ("testpkg-0.0.1-py311_0.zip", ValueError),
+    ],
+)
+def test_parse_package_filename_semver(package_name, expected, monkeypatch):
+    from conda_server import validation
+
+    monkeypatch.setattr(validation, "VERSION_REGEX", validation.SEMVER_REGEX)
+    if isinstance(expected, tuple):
+        assert validation.parse_package_filename(package_name) == expected
+    else:
+        with pytest.raises(ValueError):
+            validation.parse_package_filename(package_name)
+
+
+@pytest.mark.parametrize(
+    "versions",
+    [
+        ["0.9.0", "1.0.0a1", "1.0.0", "1.0.0.post1", "1.2.0", "1.10.0"],
+        ["1.0.0+build.1", "1.0.1", "2.0.0"],
     ],
 )
-def test_validate_package_name(package_name, expected):
-    current_use_semver = os.getenv("CONDA_SERVER_USE_SEMVER")
-    os.environ["CONDA_SERVER_USE_SEMVER"] = "1"
-    from conda_server.validation import validate_package_name
-
-    try:
-        if isinstance(expected, tuple):
-            assert validate_package_name(package_name) == expected
-        else:
-            with pytest.raises(HTTPException):
-                validate_package_name(package_name)
-    finally:
-        if current_use_semver is not None:
-            os.environ["CONDA_SERVER_USE_SEMVER"] = current_use_semver
-        else:
-            del os.environ["CONDA_SERVER_USE_SEMVER"]
+def test_version_key(versions, monkeypatch):
+    from conda_server import validation
+
+    monkeypatch.setattr(validation, "VERSION_REGEX", validation.PEP440_VERSION_REGEX)
+    assert sorted(reversed(versions), key=validation.version_key) == versions
+
+
+def test_semver_version_key(monkeypatch):
+    from conda_server import validation
+
+    monkeypatch.setattr(validation, "VERSION_REGEX", validation.SEMVER_REGEX)
+    versions = ["1.0.0-alpha", "1.0.0-alpha.1", "1.0.0-beta", "1.0.0", "1.10.0"]
+    assert sorted(reversed(versions), key=validation.version_key) == versions
+    with pytest.raises(ValueError):
+        validation.version_key("1.0")
+
+
+def test_parse_package_filename(monkeypatch):
+    from conda_server import validation
+
+    monkeypatch.setattr(validation, "VERSION_REGEX", validation.PEP440_VERSION_REGEX)
+    parsed = validation.parse_package_filename("test-pkg-1.0.0a1-py311_0.conda")
+    assert parsed == ("test-pkg", "1.0.0a1", "py311_0", "conda")
+    assert parsed.name == "test-pkg" and parsed.file_extension == "conda"
+    hits = validation._parse_package_filename.cache_info().hits
+    assert validation.parse_package_filename("test-pkg-1.0.0a1-py311_0.conda") is parsed
+    assert validation._parse_package_filename.cache_info().hits == hits + 1
+    with pytest.raises(ValueError):
+        validation.parse_package_filename("Test-1.0-0.conda")
+
+    # Results are cached per versioning scheme
+    monkeypatch.setattr(validation, "VERSION_REGEX", validation.SEMVER_REGEX)
+    with pytest.raises(ValueError):
+        validation.parse_package_filename("test-pkg-1.0.0a1-py311_0.conda")
@@ -0,0 +1,99 @@
+import asyncio
+import os
+from pathlib import Path
+from unittest.mock import AsyncMock, patch
+
+from conda_server.channels import Channel
+from conda_server.downloads import DownloadCounter
+from conda_server.warmup import CacheWarmer
+
+
+def make_channel(tmp_path: Path) -> Channel:
+    channel_dir = tmp_path / "channel"
+    for subdir in "linux-64", "noarch":
+        (channel_dir / subdir).mkdir(parents=True)
+        (channel_dir / subdir / "repodata.json").write_bytes(b"{}")
+        (channel_dir / subdir / "repodata.json.zst").write_bytes(b"z")
+    (channel_dir / "linux-64" / "popular-1.0-0.conda").write_bytes(b"p" * 100)
+    (channel_dir / "linux-64" / "large-1.0-0.conda").write_bytes(b"l" * 10000)
+    return Channel(None, str(channel_dir))
+
+
+async def test_select_files(tmp_path: Path):
+    channel = make_channel(tmp_path)
+    download_counter = DownloadCounter(str(tmp_path / "downloads.db"))
+    for _ in range(2):
+        download_counter.record(None, "linux-64", "popular-1.0-0.conda")
+    download_counter.record(None, "linux-64", "large-1.0-0.conda")
+    await download_counter.flush()
+
+    cache_warmer = CacheWarmer(download_counter, budget=2**20, rate=2**30)
+    paths = [
+        os.path.relpath(path, channel.directory)
+        for path in cache_warmer.select_files(channel)
+    ]
+    assert paths == [
+        "linux-64/repodata.json.zst",
+        "noarch/repodata.json.zst",
+        "linux-64/current_repodata.json",
+        "noarch/current_repodata.json",
+        "linux-64/repodata.json",
+        "noarch/repodata.json",
+        "linux-64/popular-1.0-0.conda",
+        "linux-64/large-1.0-0.conda",
+    ]
+
+
+@patch("conda_server.warmup.asyncio.sleep", new_callable=AsyncMock)
+@patch("conda_server.warmup.os.posix_fadvise", create=True)
+async def test_prefetch_within_budget(mock_fadvise, mock_sleep, tmp_path: Path):
+    channel = make_channel(tmp_path)
+    download_counter = DownloadCounter(str(tmp_path / "downloads.db"))
+    cache_warmer = CacheWarmer(download_counter, budget=1000, rate=100, chunk_size=64)
+    paths = [
+        os.path.join(channel.directory, "linux-64", filename)
+        for filename in (
+            "large-1.0-0.conda",
+            "missing-1.0-0.conda",
+            "popular-1.0-0.conda",
+            "repodata.json",
+        )
+    ]
+
+    # The large package doesn't fit the budget and is skipped
+    assert await cache_warmer.prefetch(paths) == 102
+    assert [call.args[1:3] for call in mock_fadvise.call_args_list] == [
+        (0, 64),
+        (64, 36),
+        (0, 2),
+    ]
+    # Reads are paced to the rate limit
+    assert sum(call.args[0] for call in mock_sleep.call_args_list) > 0.9
+
+
+async def test_generation_warms_again(tmp_path: Path):
+    channel = make_channel(tmp_path)
+    download_counter = DownloadCounter(str(tmp_path / "downloads.db"))
+    cache_warmer = CacheWarmer(download_counter, budget=2**20, rate=2**30)
+    warmed = asyncio.Event()
+    runs = []
+
+    async def warm(channel: Channel) -> int:
+        runs.append(channel)
+        await warmed.wait()
+        return 0
+
+    with patch.object(cache_warmer, "warm", side_effect=warm):
+        async with cache_warmer:
+            cache_warmer.attach(channel)
+            await asyncio.sleep(0)
+            # Generations during a run coalesce into one more run
+            for listener in channel.index_manager._generation_listeners:
+                listener({"linux-64"})
+                listener(None)
+            warmed.set()
+            for _ in range(100):
+                await asyncio.sleep(0.01)
+                if not cache_warmer._tasks:
+                    break
+    assert runs == [channel, channel]
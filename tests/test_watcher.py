@@ -0,0 +1,181 @@
+import asyncio
+import os
+from pathlib import Path
+from unittest.mock import patch
+
+import pytest
+from watchfiles import Change
+
+from conda_server.watcher import (
+    ChangeQueue,
+    ChannelWatcher,
+    FileExtensionFilter,
+    diff_snapshots,
+    merge_change,
+    scan_channel_dir,
+)
+
+
+@pytest.mark.parametrize(
+    "previous, change, merged",
+    [
+        (None, Change.added, Change.added),
+        (Change.added, Change.modified, Change.added),
+        (Change.added, Change.deleted, None),
+        (Change.deleted, Change.added, Change.modified),
+        (Change.modified, Change.deleted, Change.deleted),
+        (Change.modified, Change.modified, Change.modified),
+    ],
+)
+def test_merge_change(previous, change, merged):
+    assert merge_change(previous, change) == merged
+
+
+async def test_change_queue():
+    queue = ChangeQueue()
+    queue.put(Change.added, "/channel/linux-64/a-1.0-0.conda")
+    queue.put(Change.modified, "/channel/linux-64/a-1.0-0.conda")
+    queue.put(Change.added, "/channel/linux-64/b-1.0-0.conda")
+    queue.put(Change.deleted, "/channel/linux-64/b-1.0-0.conda")
+    queue.put(Change.deleted, "/channel/noarch/c-1.0-0.conda")
+    assert len(queue) == 2
+    assert await queue.get() == {
+        (Change.added, "/channel/linux-64/a-1.0-0.conda"),
+        (Change.deleted, "/channel/noarch/c-1.0-0.conda"),
+    }
+
+    # Waits for changes, and drains them after the queue is closed
+    get = asyncio.create_task(queue.get())
+    await asyncio.sleep(0)
+    assert not get.done()
+    queue.put(Change.added, "/channel/noarch/d-1.0-0.conda")
+    queue.close()
+    assert await get == {(Change.added, "/channel/noarch/d-1.0-0.conda")}
+    assert await queue.get() is None
+
+
+def test_file_extension_filter(tmp_path: Path):
+    watch_filter = FileExtensionFilter((".conda",), str(tmp_path))
+    assert watch_filter(Change.added, str(tmp_path / "linux-64" / "a-1.0-0.conda"))
+    assert not watch_filter(Change.added, str(tmp_path / "linux-64" / "index.html"))
+    # Blobs and snapshot pins live in dot-directories
+    assert not watch_filter(
+        Change.added, str(tmp_path / ".blobs" / "snapshots" / "a-1.0-0.conda")
+    )
+    assert watch_filter.seen == 3
+
+
+def test_scan_and_diff(tmp_path: Path):
+    (tmp_path / "linux-64").mkdir()
+    (tmp_path / "linux-64" / "a-1.0-0.conda").write_bytes(b"a")
+    (tmp_path / "linux-64" / "b-1.0-0.tar.bz2").write_bytes(b"b")
+    (tmp_path / "linux-64" / "repodata.json").write_bytes(b"{}")
+    (tmp_path / "other").mkdir()
+    (tmp_path / "other" / "c-1.0-0.conda").write_bytes(b"c")
+    before = scan_channel_dir(str(tmp_path))
+    assert sorted(os.path.basename(path) for path in before) == [
+        "a-1.0-0.conda",
+        "b-1.0-0.tar.bz2",
+    ]
+
+    (tmp_path / "linux-64" / "a-1.0-0.conda").unlink()
+    (tmp_path / "linux-64" / "b-1.0-0.tar.bz2").write_bytes(b"bb")
+    (tmp_path / "noarch").mkdir()
+    (tmp_path / "noarch" / "d-1.0-0.conda").write_bytes(b"d")
+    assert diff_snapshots(before, scan_channel_dir(str(tmp_path))) == {
+        (Change.deleted, str(tmp_path / "linux-64" / "a-1.0-0.conda")),
+        (Change.modified, str(tmp_path / "linux-64" / "b-1.0-0.tar.bz2")),
+        (Change.added, str(tmp_path / "noarch" / "d-1.0-0.conda")),
+    }
+
+
+async def test_poll_mode(tmp_path: Path):
+    (tmp_path / "linux-64").mkdir()
+    (tmp_path / "linux-64" / "a-1.0-0.conda").write_bytes(b"a")
+    watcher = ChannelWatcher(str(tmp_path), mode="poll", poll_interval=0.01)
+    queue = ChangeQueue()
+    stop_event = asyncio.Event()
+    task = asyncio.create_task(watcher.run(queue, stop_event))
+    while watcher._snapshot == {}:
+        await asyncio.sleep(0.01)
+
+    (tmp_path / "linux-64" / "b-1.0-0.conda").write_bytes(b"b")
+    assert await asyncio.wait_for(queue.get(), 5) == {
+        (Change.added, str(tmp_path / "linux-64" / "b-1.0-0.conda"))
+    }
+    stop_event.set()
+    await task
+    assert await queue.get() is None
+
+
+async def test_rescan_after_watcher_fails(tmp_path: Path):
+    (tmp_path / "linux-64").mkdir()
+    path = tmp_path / "linux-64" / "a-1.0-0.conda"
+    calls = 0
+
+    async def awatch(*args, stop_event, **kwargs):
+        nonlocal calls
+        calls += 1
+        if calls == 1:
+            # The package is added while no watcher is running
+            path.write_bytes(b"a")
+            raise RuntimeError("watcher failed")
+        yield set()
+        await stop_event.wait()
+
+    watcher = ChannelWatcher(str(tmp_path))
+    queue = ChangeQueue()
+    stop_event = asyncio.Event()
+    with patch("conda_server.watcher.awatch", awatch):
+        task = asyncio.create_task(watcher.run(queue, stop_event))
+        assert await asyncio.wait_for(queue.get(), 5) == {(Change.added, str(path))}
+        stop_event.set()
+        await task
+    assert calls == 2
+
+
+async def test_rescan_after_overflow(tmp_path: Path):
+    (tmp_path / "linux-64").mkdir()
+    paths = [tmp_path / "linux-64" / f"{name}-1.0-0.conda" for name in "abc"]
+
+    async def awatch(*args, stop_event, watch_filter, **kwargs):
+        # Only one of the changes makes it through the overflowed queue
+        for path in paths:
+            path.write_bytes(b"x")
+            watch_filter(Change.added, str(path))
+        yield {(Change.added, str(paths[0]))}
+        await stop_event.wait()
+
+    watcher = ChannelWatcher(str(tmp_path), overflow_threshold=3)
+    queue = ChangeQueue()
+    stop_event = asyncio.Event()
+    with patch("conda_server.watcher.awatch", awatch):
+        task = asyncio.create_task(watcher.run(queue, stop_event))
+        await asyncio.sleep(0.1)
+        stop_event.set()
+        await task
+    assert await queue.get() == {(Change.added, str(path)) for path in paths}
+
+
+async def test_rescan_skips_delivered_changes(tmp_path: Path):
+    (tmp_path / "linux-64").mkdir()
+    path = tmp_path / "linux-64" / "a-1.0-0.conda"
+    delivered = asyncio.Event()
+
+    async def awatch(*args, stop_event, **kwargs):
+        path.write_bytes(b"a")
+        yield {(Change.added, str(path))}
+        delivered.set()
+        await stop_event.wait()
+
+    watcher = ChannelWatcher(str(tmp_path), rescan_interval=0)
+    queue = ChangeQueue()
+    stop_event = asyncio.Event()
+    with patch("conda_server.watcher.awatch", awatch):
+        task = asyncio.create_task(watcher.run(queue, stop_event))
+        await asyncio.wait_for(delivered.wait(), 5)
+        assert await queue.get() == {(Change.added, str(path))}
+        await watcher.rescan(queue)
+        assert len(queue) == 0
+        stop_event.set()
+        await task